@@ -1,18 +1,49 @@
 # -*- coding: utf-8 -*-
 import datetime
+import hashlib
+import json
 import os
+import requests
+import shutil
+import socket
 import sys
+import tempfile
+import threading
 import time
+from io import BytesIO
 from unittest import TestCase
-from u115.api import API, Torrent, Directory, File, TaskError
-from u115.utils import pjoin
+from requests.packages.urllib3.filepost import encode_multipart_formdata
+from u115.api import (API, Torrent, Directory, File, TaskError, Response,
+                      APIError, RequestFailure, Request, RequestHandler,
+                      RetryPolicy, CircuitBreaker)
+from u115.cache import MemoryCache, SQLiteCache, PathCache
+from u115.downloader import SegmentedDownloader, ChecksumError
+from u115.manager import DownloadManager
+from u115.multipart import MultipartEncoder
+from u115.pipeline import TaskFollower, Journal
+from u115.sync import SyncDown
+from u115.utils import RateLimiter
+from u115.utils import pjoin, mkdir_p
 from u115 import conf
 
 PY3 = sys.version_info[0] == 3
 if PY3:
-    from unittest.mock import Mock
+    from unittest.mock import Mock, patch
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
 else:
-    from mock import Mock
+    from mock import Mock, patch
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
+
+
+def make_tmpdir(test):
+    """Create a temporary directory that is removed after ``test``"""
+    path = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, path, True)
+    return path
 
 
 LARGE_COUNT = 999
@@ -613,3 +644,1554 @@ class PrivateAPITests(TestCase):
     def test_load_upload_url(self):
         url = self.api._load_upload_url()
         assert url
+
+
+class DirectoryListingTests(TestCase):
+    """Test paged directory listing without network access"""
+    def setUp(self):
+        self.api = Mock()
+        self.api.max_workers = 1
+        self.total = 100
+        self.api._req_directory.return_value = {
+            'cid': '1', 'name': 'test', 'pid': '0', 'count': self.total,
+        }
+        self.api._req_files.side_effect = self._req_files
+        self.directory = Directory(self.api, cid='1', name='test', pid='0',
+                                   count=self.total)
+
+    def _req_files(self, offset, limit, **kwargs):
+        data = [{'fid': str(i), 'cid': '1', 'n': str(i), 'ico': 'txt',
+                 't': '2015-07-01 12:00', 'pc': 'pc%d' % i, 's': i,
+                 'sha': 'SHA%d' % i}
+                for i in range(offset, min(offset + limit, self.total))]
+        return {'data': data, 'count': self.total}
+
+    def test_load_entries_concurrently(self):
+        entries = self.directory._load_entries(func=self._req_files,
+                                               count=self.total,
+                                               max_workers=4)
+        assert [e['fid'] for e in entries] == \
+            [str(i) for i in range(self.total)]
+
+    def test_load_entries_concurrently_partial(self):
+        serial = self.directory._load_entries(func=self._req_files, count=50)
+        concurrent = self.directory._load_entries(func=self._req_files,
+                                                  count=50, max_workers=3)
+        assert len(concurrent) == 50
+        assert serial == concurrent
+
+    def test_iter_entries(self):
+        entries = list(self.directory.iter_entries())
+        assert len(entries) == self.total
+        assert all(isinstance(e, File) for e in entries)
+        assert [e.fid for e in entries] == [str(i) for i in range(self.total)]
+
+    def test_iter_entries_stop_early(self):
+        it = self.directory.iter_entries(count=60, prefetch=False)
+        first = next(it)
+        assert first.fid == '0'
+        it.close()
+        # Only the first page is requested
+        assert self.api._req_files.call_count == 1
+
+    def test_list_without_reload(self):
+        directory = Directory(self.api, cid='1', name='test', pid='0')
+        entries = directory.list(count=1000, max_workers=2)
+        assert [e.fid for e in entries] == [str(i) for i in range(self.total)]
+        # The count comes from the first page
+        assert not self.api._req_directory.called
+        assert directory.count == self.total
+        assert self.api._req_files.call_count == 5
+
+
+class FakeTree(object):
+    """
+    In-memory directory tree that serves :meth:`API._req_files` and
+    :meth:`API._req_directory` for an :class:`API` without network access
+    """
+    def __init__(self, api, patch_directory=True):
+        self.api = api
+        self.dirs = {'1': {'cid': '1', 'name': 'top', 'pid': '0'}}
+        self.entries = {'1': []}
+        self.next_id = 100
+        api._req_files = Mock(side_effect=self._req_files)
+        if patch_directory:
+            api._req_directory = self._req_directory
+        api._receiver_directory = Directory(api, cid='-1', name='receiver',
+                                            pid='0')
+
+    def mkdir(self, pid, name):
+        cid = str(self.next_id)
+        self.next_id += 1
+        self.dirs[cid] = {'cid': cid, 'name': name, 'pid': pid}
+        self.entries[cid] = []
+        self.entries[pid].append({'cid': cid, 'pid': pid, 'n': name,
+                                  't': '1435752000'})
+        return cid
+
+    def add_file(self, cid, name, size=1, sha='SHA'):
+        fid = str(self.next_id)
+        self.next_id += 1
+        self.entries[cid].append({'fid': fid, 'cid': cid, 'n': name,
+                                  'ico': 'txt', 't': '2015-07-01 12:00',
+                                  'pc': 'pc' + fid, 's': size, 'sha': sha})
+        return fid
+
+    def directory(self, cid='1'):
+        return Directory(self.api, **self._req_directory(cid))
+
+    def _req_files(self, cid, offset, limit, **kwargs):
+        data = self.entries[str(cid)][offset:offset + limit]
+        return {'data': [dict(e) for e in data],
+                'count': len(self.entries[str(cid)]),
+                'path': [self.dirs[str(cid)]]}
+
+    def _req_directory(self, cid, refresh=False):
+        res = dict(self.dirs[str(cid)])
+        res['count'] = len(self.entries[str(cid)])
+        return res
+
+
+class WalkTests(TestCase):
+    """Test API.walk without network access"""
+    def setUp(self):
+        self.api = API(max_workers=4)
+        self.tree = FakeTree(self.api)
+        a = self.tree.mkdir('1', 'a')
+        b = self.tree.mkdir('1', 'b')
+        c = self.tree.mkdir(a, 'c')
+        self.tree.add_file('1', 'top.txt')
+        for i in range(30):
+            self.tree.add_file(a, 'a%d.txt' % i)
+        self.tree.add_file(b, 'b.txt')
+        self.tree.add_file(c, 'c.txt')
+
+    def test_walk(self):
+        res = dict((dirpath, (dirs, files)) for dirpath, dirs, files
+                   in self.api.walk(self.tree.directory()))
+        assert sorted(res.keys()) == ['top', 'top/a', 'top/a/c', 'top/b']
+        assert len(res['top/a'][1]) == 30
+        assert [f.name for f in res['top/a/c'][1]] == ['c.txt']
+
+    def test_walk_max_depth_and_filter(self):
+        paths = [dirpath for dirpath, dirs, files in self.api.walk(
+            self.tree.directory(), max_depth=1,
+            dir_filter=lambda d: d.name != 'b')]
+        assert paths == ['top', 'top/a']
+
+    def test_walk_prune(self):
+        paths = []
+        for dirpath, dirs, files in self.api.walk(self.tree.directory()):
+            paths.append(dirpath)
+            dirs[:] = [d for d in dirs if d.name != 'a']
+        assert paths == ['top', 'top/b']
+
+
+class PathTests(TestCase):
+    """Test path-based addressing without network access"""
+    def setUp(self):
+        self.api = API(max_workers=4)
+        self.tree = FakeTree(self.api)
+        self.tree.dirs['0'] = {'cid': '0', 'name': 'root', 'pid': '0'}
+        self.tree.entries['0'] = [{'cid': '1', 'pid': '0', 'n': 'top',
+                                   't': '1435752000'}]
+        # Serve listings through the real API._req_files
+        del self.api._req_files
+        self.api.http.send = Mock(side_effect=lambda req: Response(
+            True, self.tree._req_files(**req.params)))
+        self.a = self.tree.mkdir('1', 'a')
+        b = self.tree.mkdir('1', 'b')
+        c = self.tree.mkdir(self.a, 'c')
+        for i in range(30):
+            self.tree.add_file(self.a, 'a%d.txt' % i)
+        self.tree.add_file(b, 'b.txt')
+        self.tree.add_file(c, 'c.txt')
+
+    def test_get_paths(self):
+        paths = ['/top/a/c/c.txt', '/top/a/a1.txt', 'top/b/b.txt',
+                 '/top/missing/x.txt', '/top/a/', '/top/b/c.txt']
+        res = self.api.get_paths(paths)
+        assert list(res) == paths
+        assert res['/top/a/c/c.txt'].name == 'c.txt'
+        assert res['/top/a/a1.txt'].cid == self.a
+        assert res['top/b/b.txt'].name == 'b.txt'
+        assert res['/top/missing/x.txt'] is None
+        assert res['/top/b/c.txt'] is None
+        assert res['/top/a/'].cid == self.a
+        # Each directory is listed once: root, top, a (2 pages), b and c
+        assert self.api.http.send.call_count == 6
+        # Cached directories are resolved without requests
+        d = self.api.get_path('/top/a/c')
+        assert (d.name, d.pid) == ('c', self.a)
+        assert self.api.http.send.call_count == 6
+        with self.assertRaises(APIError):
+            self.api.get_path('/top/missing')
+
+    def test_list_all_bounded_by_count(self):
+        for i in range(17):
+            self.tree.add_file(self.a, 'x%d.txt' % i)
+        # 48 entries, exactly two pages
+        assert len(self.api._list_all(self.a)) == 48
+        assert self.api.http.send.call_count == 2
+        # A server that keeps returning the last full page
+        self.api._req_files = Mock(
+            side_effect=lambda **kwargs: self.tree._req_files(self.a, 24, 24))
+        assert len(self.api._list_all(self.a)) == 48
+        assert self.api._req_files.call_count == 2
+
+    def test_makedirs(self):
+        self.api._req_files_add = Mock(side_effect=lambda pid, cname: {
+            'cid': self.tree.mkdir(pid, cname)})
+        d = self.api.makedirs('/top/a/x/y')
+        assert d.name == 'y'
+        assert self.api._req_files_add.call_count == 2
+        assert self.api._req_files_add.call_args[0][1] == 'y'
+        with self.assertRaises(APIError):
+            self.api.makedirs('/top/a/x')
+        count = self.api.http.send.call_count
+        assert self.api.makedirs('/top/a/x/y', exist_ok=True).cid == d.cid
+        assert self.api.get_path('top/a/x/y').cid == d.cid
+        assert self.api.http.send.call_count == count
+
+    def test_invalidation(self):
+        a = self.api.get_path('/top/a')
+        assert self.api.get_path('/top/a/c').pid == self.a
+        self.api._req_files_edit = Mock(return_value=True)
+        self.api.edit_many([(a, 'renamed')])
+        self.tree.dirs[self.a]['name'] = 'renamed'
+        self.tree.entries['1'][0]['n'] = 'renamed'
+        assert self.api.get_paths(['/top/a/c'])['/top/a/c'] is None
+        assert self.api.get_path('/top/renamed/c').pid == self.a
+
+
+class CacheTests(TestCase):
+    """Test metadata caches"""
+    def setUp(self):
+        self.tmpdir = make_tmpdir(self)
+        self.filename = pjoin(self.tmpdir, '115cache')
+
+    def test_memory_cache_lru(self):
+        cache = MemoryCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert cache.get('a') == 1
+        cache.set('c', 3)
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+
+    def test_memory_cache_ttl(self):
+        cache = MemoryCache()
+        cache.set('a', 1, ttl=-1)
+        assert cache.get('a') is None
+
+    def test_sqlite_cache_persistent(self):
+        cache = SQLiteCache(self.filename)
+        cache.set('directory:1', {'cid': '1', 'name': 'test'})
+        cache.set('directory:2', {'cid': '2'}, ttl=-1)
+        cache.close()
+        cache = SQLiteCache(self.filename)
+        assert cache.get('directory:1') == {'cid': '1', 'name': 'test'}
+        assert cache.get('directory:2') is None
+        cache.delete('directory:1')
+        assert cache.get('directory:1') is None
+        cache.close()
+
+    def test_sqlite_cache_eviction(self):
+        cache = SQLiteCache(self.filename, max_entries=10)
+        cache.eviction_interval = 1
+        for i in range(20):
+            cache.set(str(i), i)
+        assert len(cache) == 10
+        assert cache.get('19') == 19
+        cache.close()
+
+    def test_path_cache(self):
+        cache = PathCache()
+        cache.add('1', 'a', '0')
+        cache.add('2', 'b', '1')
+        cache.add('3', 'c', '2')
+        assert cache.resolve(['a', 'b', 'x']) == ('2', 2)
+        assert cache.resolve(['a', 'b', 'c']) == ('3', 3)
+        # Renaming updates the parent
+        cache.add('2', 'd', '1')
+        assert cache.resolve(['a', 'b']) == ('1', 1)
+        cache.discard('2')
+        assert cache.resolve(['a', 'd', 'c']) == ('1', 1)
+        assert len(cache) == 1
+
+    def test_api_cache(self):
+        api = API(cache=MemoryCache())
+        api._user_id = '123'
+        tree = FakeTree(api, patch_directory=False)
+        tree.add_file('1', 'a.txt')
+        assert api._req_directory('1')['count'] == 1
+        # Only name and pid are cached
+        assert api._req_directory('1') == {'cid': '1', 'name': 'top',
+                                           'pid': '0', 'count': -1}
+        assert api._req_files.call_count == 1
+        # Files added elsewhere are listed
+        tree.add_file('1', 'b.txt')
+        d = Directory(api, **api._req_directory('1'))
+        assert len(d.list()) == 2
+        # Creating a directory invalidates its parent
+        api._req_files_add = Mock(side_effect=lambda pid, name: {
+            'cid': tree.mkdir(pid, name)})
+        api.mkdir(d, 'new')
+        count = api._req_files.call_count
+        assert api._req_directory('1')['count'] == 3
+        assert api._req_files.call_count == count + 1
+        # Keys are namespaced by user
+        assert api.cache.get('123:directory:1')['name'] == 'top'
+        api._user_id = '456'
+        api._req_directory('1')
+        assert api._req_files.call_count == count + 2
+
+
+class UploadConfigTests(TestCase):
+    """Test upload URL caching without network access"""
+    SOURCE = ('<html><script>var UPLOAD_CONFIG_H5 = '
+              '{"url": "http://upload.115.com/%d"};</script></html>')
+
+    def setUp(self):
+        self.api = API()
+        self.pages = 0
+        self.api.http.get = Mock(side_effect=self._get)
+        self.api.http.send = Mock(return_value=Response(
+            True, {'state': True, 'data': {'file_id': '1'}}))
+        self.directory = Directory(self.api, cid='1', name='top', pid='0')
+
+    def _get(self, url, params=None):
+        if url == 'http://115.com':
+            self.pages += 1
+            return Response(True, self.SOURCE % self.pages)
+        return Response(True, '')
+
+    def test_upload_url_cached(self):
+        for _ in range(3):
+            self.api._req_upload(BytesIO(b'data'), self.directory)
+        # Source page and crossdomain.xml are loaded once per session
+        assert self.api.http.get.call_count == 2
+        assert self.api._load_upload_url() == 'http://upload.115.com/1'
+        self.api._upload_url_expiry = 0
+        assert self.api._load_upload_url() == 'http://upload.115.com/2'
+
+    def test_upload_url_rejected(self):
+        self.api._load_upload_url()
+        sent = []
+
+        def send(req):
+            sent.append((req.url, req.data.read()))
+            if len(sent) == 1:
+                raise requests.HTTPError(response=Mock(status_code=403))
+            return Response(True, {'state': True})
+        self.api.http.send.side_effect = send
+        self.api._req_upload(BytesIO(b'data'), self.directory)
+        assert [url for url, body in sent] == ['http://upload.115.com/1',
+                                               'http://upload.115.com/2']
+        assert b'\r\n\r\ndata\r\n' in sent[1][1]
+
+    def test_parse_src_js_var(self):
+        self.SOURCE = ('<p>UPLOAD_CONFIG_H5 = {"url": "markup"}</p>'
+                       '<script>if (UPLOAD_CONFIG_H5 == null) {}</script>'
+                       '<script>var UPLOAD_CONFIG_H5 = {"url": "u;%d"}; '
+                       'var OTHER = 1;</script><script>f();</script>')
+        assert self.api._parse_src_js_var('upload_config_h5') == \
+            {'url': 'u;1'}
+        self.SOURCE = '<script>var UPLOAD_CONFIG_H5 = {url: %d};</script>'
+        with self.assertRaises(APIError):
+            self.api._parse_src_js_var('upload_config_h5')
+
+
+class MultipartEncoderTests(TestCase):
+    """Test streaming multipart encoding without network access"""
+    def setUp(self):
+        self.content = os.urandom(300 * 1024)
+        self.path = pjoin(make_tmpdir(self), 'file.bin')
+        with open(self.path, 'wb') as f:
+            f.write(self.content)
+
+    def test_encode(self):
+        progress = []
+        with open(self.path, 'rb') as f:
+            fields = [('target', 'U_1_0'),
+                      ('Filedata', ('file.bin', f, None))]
+            body = MultipartEncoder(fields, boundary='xyz',
+                                    callback=lambda n, t: progress.append(n))
+            chunks = list(body)
+        expected, _ = encode_multipart_formdata(
+            [('target', 'U_1_0'),
+             ('Filedata', ('file.bin', self.content,
+                           'application/octet-stream'))], boundary='xyz')
+        assert b''.join(chunks) == expected
+        assert body.len == len(expected)
+        assert max(len(c) for c in chunks) <= MultipartEncoder.chunk_size
+        assert progress[-1] == len(expected)
+
+    def test_content_length(self):
+        with open(self.path, 'rb') as f:
+            body = MultipartEncoder([('Filedata', ('file.bin', f, None))])
+            req = requests.Request('POST', 'http://127.0.0.1/', data=body,
+                                   headers={'Content-Type':
+                                            body.content_type}).prepare()
+        assert req.headers['Content-Length'] == str(body.len)
+        assert 'Transfer-Encoding' not in req.headers
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serve ``server.content`` with support of range requests, unless the path
+    ends with /norange
+    """
+    def do_GET(self):
+        if self.path.endswith('/expired'):
+            self.send_response(403)
+            self.end_headers()
+            return
+        content = self.server.content
+        self.server.requests.append(self.headers.get('Range'))
+        r = self.headers.get('Range')
+        if r is None or self.path.endswith('/norange'):
+            self.send_response(200)
+            body = content
+        else:
+            start, end = r.split('=')[1].split('-')
+            body = content[int(start):int(end) + 1]
+            self.send_response(206)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, content, handler=RangeRequestHandler):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.content = content
+        self.requests = []
+        self.url = 'http://127.0.0.1:%d/file' % self.server_address[1]
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+
+
+class SlowRequestHandler(BaseHTTPRequestHandler):
+    """Respond after ``server.content`` seconds"""
+    def do_GET(self):
+        time.sleep(self.server.content)
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+class RequestHandlerTests(TestCase):
+    """Test connection pools against a local server"""
+    def setUp(self):
+        self.server = LocalHTTPServer(b'content')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_endpoint_adapters(self):
+        api = API(max_workers=16, endpoint_options={
+            'aps': {'pool_maxsize': 4, 'timeout': 5}})
+        adapters = api.http.adapters
+        session = api.http.session
+        assert session.get_adapter('http://web.api.115.com/files') is \
+            adapters['web.api']
+        assert session.get_adapter('http://uplb.115.com/3.0/') is \
+            adapters['upload']
+        assert session.get_adapter('http://cdn.example.com/') is \
+            adapters['default']
+        assert adapters['web.api'].stats()['pool_maxsize'] == 16
+        assert adapters['aps'].stats()['pool_maxsize'] == 4
+        assert adapters['aps'].timeout == 5
+        assert adapters['upload'].timeout == (10, 600)
+        assert adapters['passport'].timeout == (10, 60)
+
+    def test_stats_without_pool_internals(self):
+        adapter = API().http.adapters['default']
+        with patch.object(adapter.poolmanager, 'pools', None):
+            stats = adapter.stats()
+        assert stats == {'requests': 0, 'active': 0, 'peak': 0,
+                         'pool_maxsize': 10}
+
+    def test_resize_pools(self):
+        api = API()
+        DownloadManager(api, max_workers=4, connections=5,
+                        show_progress=False)
+        adapters = api.http.adapters
+        assert adapters['default'].stats()['pool_maxsize'] == 20
+        assert adapters['web.api'].stats()['pool_maxsize'] == 20
+        assert adapters['upload'].stats()['pool_maxsize'] == 10
+        # Pools are never shrunk
+        api.http.resize_pools(2)
+        assert adapters['default'].stats()['pool_maxsize'] == 20
+        for _ in range(2):
+            assert api.http.get(self.server.url).content == 'content'
+        assert adapters['default'].stats()['connections'] == 1
+
+    def test_stats_and_keepalive(self):
+        handler = API().http
+        for _ in range(3):
+            assert handler.get(self.server.url).content == 'content'
+        stats = handler.stats()['default']
+        assert stats['requests'] == 3
+        assert stats['active'] == 0
+        assert stats['peak'] == 1
+        # The connection is kept in the pool
+        assert stats['connections'] == 1
+        assert stats['idle'] == 1
+        assert handler.stats()['web.api']['requests'] == 0
+        pool = list(handler.adapters['default'].poolmanager.pools._container
+                    .values())[0]
+        conn = [c for c in pool.pool.queue if c is not None][0]
+        assert (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1) in \
+            conn.socket_options
+
+    def test_timeout(self):
+        self.server.content = 1
+        self.server.RequestHandlerClass = SlowRequestHandler
+        handler = API(timeout=(1, 0.2)).http
+        with self.assertRaises(requests.exceptions.Timeout):
+            handler.get(self.server.url)
+
+
+class ScriptedRequestHandler(BaseHTTPRequestHandler):
+    """Respond with ``(status, headers, body)`` popped from
+    ``server.content``"""
+    def do_GET(self):
+        self.server.requests.append(self.command)
+        status, headers, body = self.server.content.pop(0)
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+class RetryTests(TestCase):
+    """Test retries of requests against a local server"""
+    def setUp(self):
+        self.server = LocalHTTPServer([], ScriptedRequestHandler)
+        self.http = RequestHandler(
+            retry_policy=RetryPolicy(max_retries=2, backoff_factor=0.01),
+            circuit_breaker=CircuitBreaker(threshold=3, cooldown=0.2))
+        self.ok = (200, {}, b'{"state": true}')
+        self.busy = (503, {}, b'')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_retry_idempotent(self):
+        self.server.content = [self.busy, (500, {}, b''), self.ok]
+        res = self.http.send(Request(self.server.url))
+        assert res.state
+        assert self.server.requests == ['GET'] * 3
+        self.server.content = [self.busy] * 3
+        with self.assertRaises(requests.HTTPError):
+            self.http.send(Request(self.server.url))
+        # Consecutive failures open the circuit
+        assert self.http.circuit_breaker.is_open
+
+    def test_no_retry_non_idempotent(self):
+        self.server.content = [self.busy, self.ok]
+        with self.assertRaises(requests.HTTPError):
+            self.http.send(Request(self.server.url, method='POST', data={}))
+        assert self.server.requests == ['POST']
+        res = self.http.send(Request(self.server.url, method='POST',
+                                     data={}, idempotent=True))
+        assert res.state
+
+    def test_retry_after(self):
+        self.server.content = [(429, {'Retry-After': '1'}, b''), self.ok]
+        with patch('u115.api.time.sleep', side_effect=time.sleep) as sleep:
+            start = time.time()
+            assert self.http.send(Request(self.server.url)).state
+        assert time.time() - start >= 1
+        assert sleep.call_args_list[0][0][0] >= 1
+
+    def test_retry_on_failure(self):
+        failure = (200, {}, b'{"state": false}')
+        self.server.content = [failure, failure, self.ok]
+        assert not self.http.send(Request(self.server.url)).state
+        assert self.http.send(Request(self.server.url,
+                                      retry_on_failure=True)).state
+        assert len(self.server.requests) == 3
+        api = API()
+        api.http.send = Mock(return_value=Response(True, {'data': []}))
+        api._req_files(cid=1, offset=0, limit=24)
+        assert api.http.send.call_args[0][0].retry_on_failure
+        api._req_files(cid=1, offset=0, limit=24, o='file_name')
+        assert not api.http.send.call_args[0][0].retry_on_failure
+
+    def test_retry_connect_error(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        url = 'http://127.0.0.1:%d/' % sock.getsockname()[1]
+        sock.close()
+        with patch('u115.api.time.sleep') as sleep:
+            with self.assertRaises(requests.ConnectionError):
+                self.http.send(Request(url, method='POST', data={}))
+        assert sleep.call_count == 2
+
+    def test_no_retry_invalid_request(self):
+        with patch('u115.api.time.sleep') as sleep:
+            for _ in range(3):
+                with self.assertRaises(requests.exceptions.MissingSchema):
+                    self.http.send(Request('127.0.0.1/file'))
+        assert not sleep.called
+        # Invalid requests do not open the circuit
+        assert not self.http.circuit_breaker.is_open
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(threshold=2, cooldown=0.2)
+        breaker.record_failure()
+        assert not breaker.is_open
+        breaker.record_failure()
+        assert breaker.is_open
+        start = time.time()
+        breaker.wait()
+        assert time.time() - start >= 0.1
+        assert not breaker.is_open
+        breaker.record_success()
+        breaker.record_failure(retry_after=0.5)
+        assert breaker.is_open
+
+
+class SegmentedDownloaderTests(TestCase):
+    """Test multi-connection downloads against a local server"""
+    def setUp(self):
+        self.content = os.urandom(5 * 1024 * 1024 + 123)
+        self.server = LocalHTTPServer(self.content)
+        self.path = pjoin(make_tmpdir(self), 'file.bin')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_download(self):
+        d = SegmentedDownloader(self.server.url, self.path,
+                                len(self.content), connections=4,
+                                show_progress=False)
+        d.start()
+        assert len(self.server.requests) == 4
+        assert open(self.path, 'rb').read() == self.content
+        assert not os.path.exists(d.state_path)
+
+    def test_resume(self):
+        d = SegmentedDownloader(self.server.url, self.path,
+                                len(self.content), connections=2,
+                                show_progress=False)
+        d._init_state()
+        # Pretend that the first segment is finished
+        segment = d.segments[0]
+        with open(self.path, 'r+b') as f:
+            f.write(self.content[segment[0]:segment[1]])
+        segment[2] = segment[1] - segment[0]
+        d._save_state(force=True)
+        d = SegmentedDownloader(self.server.url, self.path,
+                                len(self.content), connections=2,
+                                show_progress=False)
+        d.start()
+        assert self.server.requests == ['bytes=%d-%d' % (
+            segment[1], len(self.content) - 1)]
+        assert open(self.path, 'rb').read() == self.content
+
+    def test_saved_state_is_flushed(self):
+        d = SegmentedDownloader(self.server.url, self.path,
+                                len(self.content), connections=2,
+                                show_progress=False)
+        d.state_save_interval = 0
+        save_state = d._save_state
+        checked = []
+
+        def check_state(force=False):
+            save_state(force)
+            with open(d.state_path) as f:
+                segments = json.load(f)['segments']
+            with open(self.path, 'rb') as f:
+                data = f.read()
+            for start, end, done in segments:
+                assert data[start:start + done] == \
+                    self.content[start:start + done]
+            checked.append(segments)
+
+        d._save_state = check_state
+        d.start()
+        assert len(checked) > 2
+        assert open(self.path, 'rb').read() == self.content
+
+    def test_existing_file(self):
+        sha = hashlib.sha1(self.content).hexdigest()
+        with open(self.path, 'wb') as f:
+            f.write(b'0' * len(self.content))
+        # A file of the same size is only kept if it matches the SHA1
+        for sha1 in (None, sha, sha):
+            d = SegmentedDownloader(self.server.url, self.path,
+                                    len(self.content), connections=2,
+                                    show_progress=False, sha1=sha1)
+            d.start()
+            assert open(self.path, 'rb').read() == self.content
+        assert len(self.server.requests) == 2
+        with open(self.path, 'wb') as f:
+            f.write(b'0' * len(self.content))
+        d = SegmentedDownloader(self.server.url, self.path,
+                                len(self.content), connections=2,
+                                show_progress=False, sha1=sha)
+        d.start()
+        assert open(self.path, 'rb').read() == self.content
+
+    def test_range_not_supported(self):
+        sha = hashlib.sha1(self.content).hexdigest()
+        d = SegmentedDownloader(self.server.url + '/norange', self.path,
+                                len(self.content), connections=1,
+                                show_progress=False, sha1=sha)
+        d._init_state()
+        # A resumed segment is downloaded again from the first byte
+        d.segments[0][2] = 1024
+        d._save_state(force=True)
+        d.start()
+        assert open(self.path, 'rb').read() == self.content
+        assert not os.path.exists(d.state_path)
+        # Segments fall back to a single request
+        os.remove(self.path)
+        d = SegmentedDownloader(self.server.url + '/norange', self.path,
+                                len(self.content), connections=4,
+                                show_progress=False, sha1=sha)
+        d.start()
+        assert open(self.path, 'rb').read() == self.content
+        assert len(d.segments) == 1
+
+    def test_verify(self):
+        sha = hashlib.sha1(self.content).hexdigest().upper()
+        d = SegmentedDownloader(self.server.url, self.path,
+                                len(self.content), connections=3,
+                                show_progress=False, sha1=sha)
+        d.start()
+        assert open(self.path, 'rb').read() == self.content
+        # Bytes of the first segment are hashed in-stream
+        assert d.segments[0][1] <= d._hashed
+        d = SegmentedDownloader(self.server.url, self.path,
+                                len(self.content), show_progress=False,
+                                sha1='0' * 40)
+        with self.assertRaises(ChecksumError):
+            d.start()
+
+    def test_verify_resume(self):
+        sha = hashlib.sha1(self.content).hexdigest()
+        d = SegmentedDownloader(self.server.url, self.path,
+                                len(self.content), connections=1,
+                                show_progress=False, sha1=sha)
+        d._init_state()
+        # Pretend that half of the only segment is finished
+        half = len(self.content) // 2
+        with open(self.path, 'r+b') as f:
+            f.write(self.content[:half])
+        d.segments[0][2] = half
+        d._save_state(force=True)
+        d = SegmentedDownloader(self.server.url, self.path,
+                                len(self.content), connections=1,
+                                show_progress=False, sha1=sha)
+        d.start()
+        assert open(self.path, 'rb').read() == self.content
+
+    def test_verify_local(self):
+        api = API()
+        with open(self.path, 'wb') as f:
+            f.write(self.content)
+        sha = hashlib.sha1(self.content).hexdigest().upper()
+        f = File(api, fid='1', cid='1', name='file.bin',
+                 size=len(self.content), file_type='bin', sha=sha,
+                 date_created=None, thumbnail=None, pickcode='pc')
+        assert api.verify_local(f, os.path.dirname(self.path))
+        f.sha = '0' * 40
+        assert not api.verify_local(f, self.path)
+
+    def test_api_download_refreshes_url(self):
+        api = API()
+        api._req_files_download_url = Mock(
+            side_effect=[self.server.url + '/expired', self.server.url])
+        f = File(api, fid='1', cid='1', name='file.bin',
+                 size=len(self.content), file_type='bin', sha=None,
+                 date_created=None, thumbnail=None, pickcode='pc')
+        api.download(f, self.path, show_progress=False)
+        assert api._req_files_download_url.call_count == 2
+        assert open(self.path, 'rb').read() == self.content
+
+
+class DownloadManagerTests(TestCase):
+    """Test concurrent downloads against a local server"""
+    def setUp(self):
+        self.content = os.urandom(256 * 1024)
+        self.server = LocalHTTPServer(self.content)
+        self.tmpdir = make_tmpdir(self)
+        self.api = API()
+        self.tree = FakeTree(self.api)
+        self.api._req_files_download_url = Mock(return_value=self.server.url)
+        self.api._req_file_userfile = Mock()
+        sub = self.tree.mkdir('1', 'sub')
+        for i in range(3):
+            self.tree.add_file('1', '%d.bin' % i, size=len(self.content))
+            self.tree.add_file(sub, 's%d.bin' % i, size=len(self.content))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_download_directory(self):
+        manager = DownloadManager(self.api, max_workers=3,
+                                  max_host_connections=2,
+                                  show_progress=False)
+        jobs = manager.add(self.tree.directory(), self.tmpdir)
+        assert len(jobs) == 6
+        stats = manager.run()
+        assert stats.files == 6
+        assert stats.failed == 0
+        assert stats.bytes == 6 * len(self.content)
+        path = pjoin(self.tmpdir, 'top', 'sub', 's1.bin')
+        assert open(path, 'rb').read() == self.content
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(1000)
+        start = time.time()
+        for _ in range(3):
+            limiter.consume(1000)
+        assert time.time() - start >= 1.9
+
+    def test_download_url_cache(self):
+        files = [e for e in self.tree.directory().iter_entries()
+                 if isinstance(e, File)]
+        urls = self.api.prefetch_download_urls(files, max_workers=3)
+        assert urls == [self.server.url] * 3
+        assert self.api._req_files_download_url.call_count == 3
+        # Cached until expiry
+        assert files[0].get_download_url() == self.server.url
+        assert self.api._req_files_download_url.call_count == 3
+        files[0].get_download_url(refresh=True)
+        assert self.api._req_files_download_url.call_count == 4
+
+    def test_download_url_expiry(self):
+        expired = 'http://cdn.115.com/file?t=%d' % (time.time() + 30)
+        assert self.api._get_url_expiry(expired) < time.time()
+        self.api._req_files_download_url.return_value = expired
+        f = next(self.api.walk(self.tree.directory()))[2][0]
+        f.get_download_url()
+        f.get_download_url()
+        assert self.api._req_files_download_url.call_count == 2
+
+    def test_refresh_expired_url(self):
+        path = pjoin(self.tmpdir, 'file.bin')
+        refresher = Mock(return_value=self.server.url)
+        d = SegmentedDownloader(self.server.url + '/expired', path,
+                                len(self.content), show_progress=False,
+                                url_refresher=refresher)
+        d.start()
+        assert refresher.call_count == 1
+        assert open(path, 'rb').read() == self.content
+
+
+class SyncTests(TestCase):
+    """Test incremental mirroring against a local server"""
+    def setUp(self):
+        self.content = os.urandom(64 * 1024)
+        self.sha = hashlib.sha1(self.content).hexdigest().upper()
+        self.server = LocalHTTPServer(self.content)
+        self.tmpdir = make_tmpdir(self)
+        self.api = API()
+        self.tree = FakeTree(self.api)
+        self.api._req_files_download_url = Mock(return_value=self.server.url)
+        self.api._req_file_userfile = Mock()
+        sub = self.tree.mkdir('1', 'sub')
+        self.tree.add_file('1', 'a.bin', len(self.content), self.sha)
+        self.tree.add_file(sub, 'b.bin', len(self.content), self.sha)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def sync(self, **kwargs):
+        manager = DownloadManager(self.api, show_progress=False)
+        return SyncDown(self.api, self.tree.directory(), self.tmpdir,
+                        manager=manager, **kwargs).run()
+
+    def test_sync_unchanged(self):
+        report = self.sync()
+        assert sorted(report.new) == ['a.bin', 'sub/b.bin']
+        path = pjoin(self.tmpdir, 'sub', 'b.bin')
+        assert open(path, 'rb').read() == self.content
+        self.server.requests = []
+        with patch('u115.sync.sha1_file') as sha1_file:
+            report = self.sync()
+        # Unchanged files are neither downloaded nor hashed
+        assert sorted(report.unchanged) == ['a.bin', 'sub/b.bin']
+        assert self.server.requests == []
+        assert not sha1_file.called
+
+    def test_sync_changed_and_extras(self):
+        self.sync()
+        path = pjoin(self.tmpdir, 'a.bin')
+        with open(path, 'wb') as f:
+            f.write(b'0' * len(self.content))
+        with open(pjoin(self.tmpdir, 'extra.txt'), 'w') as f:
+            f.write('extra')
+        report = self.sync(dry_run=True)
+        assert report.changed == ['a.bin']
+        assert report.extras == ['extra.txt']
+        assert report.deleted == []
+        report = self.sync(delete=True)
+        assert report.changed == ['a.bin']
+        assert report.deleted == ['extra.txt']
+        assert open(path, 'rb').read() == self.content
+        assert not os.path.exists(pjoin(self.tmpdir, 'extra.txt'))
+
+    def test_sync_failed_download_keeps_local_file(self):
+        self.sync()
+        path = pjoin(self.tmpdir, 'a.bin')
+        with open(path, 'wb') as f:
+            f.write(b'0' * len(self.content))
+        self.api._download_urls = {}
+        self.api._req_files_download_url.return_value = \
+            self.server.url + '/expired'
+        report = self.sync()
+        assert report.changed == ['a.bin']
+        assert report.failed == ['a.bin']
+        assert open(path, 'rb').read() == b'0' * len(self.content)
+        assert report.extras == []
+
+
+class InstantUploadHandler(BaseHTTPRequestHandler):
+    """Stand-in for the instant upload API, backed by ``server.tree``"""
+    def do_GET(self):
+        self._reply({'state': True, 'user_id': 42, 'userkey': 'KEY'})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length'))
+        body = self.rfile.read(length).decode('utf-8')
+        form = dict((k, v[0]) for k, v in parse_qs(body).items())
+        self.server.requests.append(form)
+        inner = hashlib.sha1((form['userid'] + form['fileid'] +
+                              form['target'] + '0').encode()).hexdigest()
+        sig = hashlib.sha1(('KEY' + inner + '000000').encode()).hexdigest()
+        content = self.server.content
+        if form['sig'] != sig.upper():
+            self._reply({'status': 0, 'statuscode': 1})
+        elif form['fileid'] != hashlib.sha1(content).hexdigest().upper():
+            self._reply({'status': 1, 'statuscode': 0})
+        elif self.server.sign_check and 'sign_val' not in form:
+            self._reply({'status': 7, 'statuscode': 701, 'sign_key': 'sk',
+                         'sign_check': self.server.sign_check})
+        else:
+            if 'sign_val' in form:
+                start, end = map(int, self.server.sign_check.split('-'))
+                expected = hashlib.sha1(content[start:end + 1]).hexdigest()
+                assert form['sign_val'] == expected.upper()
+            fid = self.server.tree.add_file(
+                form['target'][4:], form['filename'], int(form['filesize']),
+                form['fileid'])
+            res = {'status': 2, 'statuscode': 0, 'pickcode': 'pc' + fid}
+            if self.server.with_file_id:
+                res['file_id'] = fid
+            self._reply(res)
+
+    def _reply(self, content):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class InstantUploadTests(TestCase):
+    """Test instant upload against a local stand-in server"""
+    def setUp(self):
+        self.content = os.urandom(200 * 1024)
+        self.path = pjoin(make_tmpdir(self), 'file.bin')
+        with open(self.path, 'wb') as f:
+            f.write(self.content)
+        self.api = API()
+        self.tree = FakeTree(self.api)
+        self.server = LocalHTTPServer(self.content, InstantUploadHandler)
+        self.server.tree = self.tree
+        self.server.sign_check = None
+        self.server.with_file_id = True
+        self.api._req_file = Mock(side_effect=self._req_file)
+        self.api.upload_info_url = self.server.url + '/uploadinfo'
+        self.api.init_upload_url = self.server.url + '/initupload'
+        self.api._req_upload = Mock(side_effect=RequestFailure('transfer'))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _req_file(self, file_id):
+        for entries in self.tree.entries.values():
+            for e in entries:
+                if e.get('fid') == file_id:
+                    return {'data': [{'file_id': file_id, 'file_name': e['n'],
+                                      'pick_code': e['pc'], 'sha1': e['sha'],
+                                      'file_size': e['s']}]}
+
+    def test_instant_upload(self):
+        f = self.api.upload(self.path, self.tree.directory())
+        assert isinstance(f, File)
+        assert f.name == 'file.bin'
+        assert f.size == len(self.content)
+        assert f.pickcode == 'pc' + f.fid
+        assert not self.api._req_upload.called
+        # The file is looked up by its id instead of listing the directory
+        assert not self.api._req_files.called
+        form = self.server.requests[0]
+        assert form['preid'] == hashlib.sha1(
+            self.content[:API.preid_size]).hexdigest().upper()
+
+    def test_instant_upload_without_file_id(self):
+        self.server.with_file_id = False
+        f = self.api.upload(self.path, self.tree.directory())
+        assert isinstance(f, File)
+        assert f.name == 'file.bin'
+        assert f.size == len(self.content)
+        assert not self.api._req_file.called
+        assert self.api._req_files.called
+
+    def test_instant_upload_digests(self):
+        digests = self.api._upload_digests(BytesIO(self.content))
+        with patch('u115.api.hash_stream') as hash_stream:
+            f = self.api.upload(self.path, self.tree.directory(),
+                                digests=digests)
+        assert isinstance(f, File)
+        assert not hash_stream.called
+
+    def test_instant_upload_sign_check(self):
+        self.server.sign_check = '1000-5999'
+        f = self.api.upload(self.path, self.tree.directory())
+        assert isinstance(f, File)
+        assert len(self.server.requests) == 2
+
+    def test_fallback_to_transfer(self):
+        self.server.content = b'other content'
+        with self.assertRaises(RequestFailure):
+            self.api.upload(self.path, self.tree.directory())
+        # The file is transferred from its original position
+        file = self.api._req_upload.call_args[0][0]
+        assert file.tell() == 0
+
+
+class UploadTreeTests(TestCase):
+    """Test directory upload without network access"""
+    def setUp(self):
+        self.local_dir = pjoin(make_tmpdir(self), 'album')
+        for rel in ['a.txt', 'sub/b.txt', 'sub/deep/c.txt', 'sub2/d.txt']:
+            path = pjoin(self.local_dir, *rel.split('/'))
+            mkdir_p(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(rel)
+        self.api = API()
+        self.tree = FakeTree(self.api)
+        self.api._req_files_add = lambda pid, cname: {
+            'cid': self.tree.mkdir(pid, cname)}
+        self.api.upload = Mock(side_effect=self._upload)
+
+    def _upload(self, file, directory, progress_callback, instant, digests):
+        content = file.read()
+        # The file is hashed once by upload_tree
+        assert digests[0] == hashlib.sha1(content).hexdigest().upper()
+        progress_callback(len(content), len(content))
+        fid = self.tree.add_file(directory.cid, os.path.basename(file.name),
+                                 len(content),
+                                 hashlib.sha1(content).hexdigest())
+        return File(self.api, fid=fid, cid=directory.cid,
+                    name=os.path.basename(file.name), size=len(content),
+                    file_type='txt', sha=hashlib.sha1(content).hexdigest(),
+                    date_created=None, thumbnail=None, pickcode='pc' + fid)
+
+    def test_upload_tree(self):
+        manifest = pjoin(os.path.dirname(self.local_dir), 'result.json')
+        res = self.api.upload_tree(self.local_dir, self.tree.directory(),
+                                   show_progress=False, manifest=manifest)
+        assert [f['status'] for f in res['files']] == ['uploaded'] * 4
+        assert res['stats']['bytes'] == len('a.txtsub/b.txtsub/deep/c.txt'
+                                            'sub2/d.txt')
+        paths = []
+        for dirpath, dirs, files in self.api.walk(self.tree.directory()):
+            paths.extend(dirpath + '/' + f.name for f in files)
+        assert sorted(paths) == ['top/album/a.txt', 'top/album/sub/b.txt',
+                                 'top/album/sub/deep/c.txt',
+                                 'top/album/sub2/d.txt']
+        with open(manifest) as f:
+            assert json.load(f)['files'] == res['files']
+        # Existing files are skipped and directories are reused
+        res = self.api.upload_tree(self.local_dir, self.tree.directory(),
+                                   show_progress=False)
+        assert [f['status'] for f in res['files']] == ['skipped'] * 4
+        assert self.api.upload.call_count == 4
+        assert len(self.tree.dirs) == 5
+
+    def test_upload_tree_failure(self):
+        self.api.upload.side_effect = RequestFailure('Upload failed.')
+        res = self.api.upload_tree(self.local_dir, self.tree.directory(),
+                                   max_retries=0, show_progress=False)
+        assert [f['status'] for f in res['files']] == ['failed'] * 4
+        assert res['files'][0]['error'] == 'Upload failed.'
+        assert res['stats']['failed'] == 4
+
+
+class SignatureTests(TestCase):
+    """Test caching of lixian signatures without network access"""
+    def setUp(self):
+        self.api = API()
+        self.api._user_id = '42'
+        self.sent = []
+        self.valid_sign = 'sign1'
+        self.api.http.send = Mock(side_effect=self._send)
+
+    def _send(self, req):
+        self.sent.append(req.params['ac'])
+        if req.params['ac'] == 'space':
+            self.valid_sign = 'sign%d' % len(self.sent)
+            return Response(True, {'sign': self.valid_sign, 'time': 1})
+        if req.data['sign'] != self.valid_sign:
+            return Response(False, {'error_msg': 'Invalid sign.'})
+        return Response(True, {'count': 1, 'quota': 100, 'tasks': []})
+
+    def test_signatures_cached(self):
+        assert self.api.task_count == 1
+        assert self.api.task_quota == 100
+        assert self.sent == ['space', 'task_lists', 'task_lists']
+        self.api._signatures_expiry = 0
+        self.api.task_count
+        assert self.sent[3:] == ['space', 'task_lists']
+
+    def test_signatures_rejected(self):
+        self.api.task_count
+        # The server no longer accepts the cached signature
+        self.valid_sign = 'expired'
+        assert self.api.task_quota == 100
+        assert self.sent == ['space', 'task_lists', 'task_lists', 'space',
+                             'task_lists']
+
+    def test_other_failures_not_resent(self):
+        self.api.task_count
+        self.api.http.send = Mock(return_value=Response(
+            False, {'error_msg': 'Task already exists.'}))
+        res = self.api._req_lixian('add_task_url', {'url': 'magnet:?'})
+        assert not res.state
+        assert self.api.http.send.call_count == 1
+
+    def test_signatures_reloaded_once(self):
+        self.api.task_count
+        # Another thread has replaced the rejected signature
+        assert self.api._load_signatures(force=True, rejected='old')
+        assert self.sent == ['space', 'task_lists']
+
+
+class AddTasksTests(TestCase):
+    """Test batch task submission without network access"""
+    EXISTING = 'c12fe1c06bba254a9dc9f519b335aa7c1367a88a'
+
+    def setUp(self):
+        self.api = API()
+        self.api.iter_tasks = Mock(return_value=iter([
+            Mock(info_hash=self.EXISTING.upper())]))
+        self.api._req_lixian = Mock(side_effect=self._req_lixian)
+        self.urls = [
+            'magnet:?xt=urn:btih:%s' % self.EXISTING,
+            # Base32-encoded form of the same info hash
+            'magnet:?xt=urn:btih:YEX6DQDLXISUVHOJ6UM3GNNKPQJWPKEK',
+            'http://example.com/a.iso',
+            'http://example.com/bad.iso',
+            'http://example.com/a.iso',
+            'magnet:?xt=urn:btih:%s' % ('1' * 40),
+        ]
+
+    def _req_lixian(self, ac, data):
+        if ac == 'add_task_urls':
+            urls = [data['url[%d]' % i] for i in range(len(data))]
+            return Response(True, {'state': True, 'result': [
+                {'state': 'bad' not in url, 'info_hash': 'h', 'url': url,
+                 'error_msg': 'Invalid link.'} for url in urls]})
+        if 'bad' in data['url']:
+            return Response(False, {'error_msg': 'Invalid link.'})
+        return Response(True, {'state': True})
+
+    def test_add_tasks_url_batch(self):
+        self.api.add_task_urls_batch_size = 2
+        results = self.api.add_tasks_url(self.urls)
+        assert [r['status'] for r in results] == [
+            'duplicate', 'duplicate', 'added', 'failed', 'duplicate',
+            'added']
+        assert results[3]['error'] == 'Invalid link.'
+        # 3 URLs in 2 batches
+        assert self.api._req_lixian.call_count == 2
+
+    def test_add_tasks_url_serially(self):
+        def unavailable(ac, data):
+            if ac == 'add_task_urls':
+                return Response(False, {'error_msg': 'Unknown action.'})
+            return self._req_lixian(ac, data)
+        self.api._req_lixian.side_effect = unavailable
+        self.api.add_task_rate = 100
+        results = self.api.add_tasks_url(self.urls, dedup=False)
+        assert [r['status'] for r in results] == [
+            'added', 'added', 'added', 'failed', 'added', 'added']
+        assert results[0]['info_hash'] == self.EXISTING
+
+    def test_add_tasks_url_partly_failed(self):
+        def partly_failed(ac, data):
+            if ac == 'add_task_urls':
+                res = self._req_lixian(ac, data)
+                res.content['result'][0]['state'] = False
+                return Response(False, res.content)
+            return self._req_lixian(ac, data)
+        self.api._req_lixian.side_effect = partly_failed
+        self.api.add_task_rate = 100
+        results = self.api.add_tasks_url(self.urls[2:4] + self.urls[5:])
+        assert [r['status'] for r in results] == ['added', 'failed', 'added']
+        assert 'error' not in results[0]
+        # Only the failed URLs are submitted again
+        submitted = [c[0][1]['url'] for c in
+                     self.api._req_lixian.call_args_list[1:]]
+        assert sorted(submitted) == sorted(self.urls[2:4])
+
+
+class FakeTasks(object):
+    """Serve :meth:`API._req_lixian_task_lists` from ``self.tasks``"""
+    def setUp(self):
+        self.api = API()
+        self.api._downloads_directory = Directory(self.api, cid='2',
+                                                  name='downloads', pid='1')
+        self.tasks = [self._task(i) for i in range(95)]
+        self.api._req_lixian_task_lists = Mock(side_effect=self._task_lists)
+
+    def _task(self, i):
+        return {'file_id': str(i), 'info_hash': 'h%d' % i, 'name': str(i),
+                'add_time': 1435752000, 'last_update': 1435752000,
+                'left_time': 0, 'move': 1, 'peers': 0, 'percentDone': 100,
+                'rateDownload': 0, 'size': 1, 'status': 2}
+
+    def _task_lists(self, page=1):
+        self.api._task_count = len(self.tasks)
+        per_page = self.api.num_tasks_per_page
+        return [dict(t) for t in
+                self.tasks[(page - 1) * per_page:page * per_page]] or None
+
+
+class TaskListingTests(FakeTasks, TestCase):
+    """Test task paging without network access"""
+    def test_get_tasks_concurrently(self):
+        tasks = self.api.get_tasks(count=1000, max_workers=4)
+        assert [t.name for t in tasks] == [str(i) for i in range(95)]
+        pages = sorted(c[0][0] for c in
+                       self.api._req_lixian_task_lists.call_args_list)
+        assert pages == [1, 2, 3, 4]
+        assert len(self.api.get_tasks(count=40)) == 40
+
+    def test_iter_tasks(self):
+        tasks = self.api.iter_tasks(count=35)
+        assert next(tasks).name == '0'
+        assert len(list(tasks)) == 34
+        assert len(list(self.api.iter_tasks(prefetch=False))) == 95
+
+
+class TaskWatcherTests(FakeTasks, TestCase):
+    """Test task watching without network access"""
+    def setUp(self):
+        super(TaskWatcherTests, self).setUp()
+        self.tasks[0].update(status=1, move=0, percentDone=10)
+        self.watcher = self.api.watch_tasks(min_interval=1, max_interval=8)
+
+    def pages(self):
+        pages = [c[0][0] for c in
+                 self.api._req_lixian_task_lists.call_args_list]
+        self.api._req_lixian_task_lists.reset_mock()
+        return pages
+
+    def test_events(self):
+        received = []
+        self.watcher.add_callback(received.append)
+        assert self.watcher.poll() == []
+        assert self.pages() == [1, 2, 3, 4]
+        self.tasks[0].update(percentDone=50, last_update=1435752060)
+        self.tasks.insert(0, self._task(100))
+        events = self.watcher.poll()
+        assert [(e.type, e.task.name) for e in events] == [
+            ('added', '100'), ('transferred', '100'), ('progress', '0')]
+        assert received == events
+        # Finished tasks on older pages are not fetched again
+        assert self.pages() == [1, 2]
+        self.tasks[1].update(status=2, move=1)
+        events = self.watcher.poll()
+        assert [(e.type, e.task.name) for e in events] == [
+            ('transferred', '0')]
+        assert self.pages() == [1]
+
+    def test_deleted_and_interval(self):
+        self.watcher.full_poll_interval = 1
+        self.watcher.poll()
+        assert self.watcher.interval == 1
+        del self.tasks[50]
+        self.tasks[0].update(status=-1)
+        events = self.watcher.poll()
+        assert [(e.type, e.task.name) for e in events] == [
+            ('failed', '0'), ('deleted', '50')]
+        assert events[1].task.is_deleted
+        # Back off while nothing changes
+        self.watcher.poll()
+        self.watcher.poll()
+        assert self.watcher.interval == 4
+
+    def test_events_timeout(self):
+        self.watcher.min_interval = 0.1
+        events = list(self.watcher.events(timeout=0.3))
+        assert events == []
+        assert self.api._req_lixian_task_lists.call_count >= 8
+
+    def test_stopped_before_events(self):
+        self.watcher.stop()
+        assert list(self.watcher.events(timeout=1)) == []
+        assert not self.api._req_lixian_task_lists.called
+
+
+class TaskFollowerTests(FakeTasks, TestCase):
+    """Test downloading transferred tasks against a local server"""
+    def setUp(self):
+        super(TaskFollowerTests, self).setUp()
+        self.content = os.urandom(64 * 1024)
+        self.server = LocalHTTPServer(self.content)
+        self.tmpdir = make_tmpdir(self)
+        self.tree = FakeTree(self.api)
+        self.api._req_files_download_url = Mock(return_value=self.server.url)
+        cid = self.tree.mkdir('1', 'show')
+        for i in range(3):
+            self.tree.add_file(cid, '%d.mkv' % i, size=len(self.content))
+        task = self._task(0)
+        task.update(file_id=cid, name='show', status=1, move=0)
+        self.tasks = [task]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def follower(self):
+        manager = DownloadManager(self.api, show_progress=False)
+        return TaskFollower(self.api, self.tmpdir, manager=manager,
+                            min_interval=0.05)
+
+    def test_follow(self):
+        follower = self.follower()
+
+        def transfer():
+            self.tasks[0].update(status=2, move=1)
+        threading.Timer(0.1, transfer).start()
+        follower.run(timeout=0.5)
+        path = pjoin(self.tmpdir, 'show', '2.mkv')
+        assert open(path, 'rb').read() == self.content
+        entry = Journal(pjoin(self.tmpdir, '.115journal')).tasks['h0']
+        assert entry['status'] == 'done'
+        assert entry['done'] == 3
+
+    def test_resume(self):
+        self.tasks[0].update(status=2, move=1)
+        journal = Journal(pjoin(self.tmpdir, '.115journal'))
+        journal.tasks['h0'] = {'name': 'show', 'status': 'queued',
+                               'files': 3, 'done': 1, 'failed': 0}
+        journal.save()
+        self.follower().run(timeout=0.1)
+        assert os.path.exists(pjoin(self.tmpdir, 'show', '0.mkv'))
+        entry = Journal(pjoin(self.tmpdir, '.115journal')).tasks['h0']
+        assert entry['status'] == 'done'
+
+    def test_transferred_while_stopped(self):
+        self.follower().run(timeout=0.1)
+        entry = Journal(pjoin(self.tmpdir, '.115journal')).tasks['h0']
+        assert entry['status'] == 'pending'
+        self.tasks[0].update(status=2, move=1)
+        self.follower().run(timeout=0.1)
+        assert os.path.exists(pjoin(self.tmpdir, 'show', '0.mkv'))
+        entry = Journal(pjoin(self.tmpdir, '.115journal')).tasks['h0']
+        assert entry['status'] == 'done'
+
+
+class FakeSend(object):
+    """
+    Record the data of requests sent by ``self.api`` in ``self.requests``,
+    and answer them with ``self.responses`` or success once exhausted
+    """
+    def setUp(self):
+        self.api = API()
+        self.requests = []
+        self.responses = []
+        self.api.http.send = Mock(side_effect=self._send)
+
+    def _file(self, fid, cid='1'):
+        return File(self.api, fid=str(fid), cid=cid, name='%d.txt' % fid,
+                    size=1, file_type='txt', sha='SHA', date_created=None,
+                    thumbnail=None, pickcode='pc')
+
+    def _send(self, req):
+        self.requests.append(req.data)
+        if self.responses:
+            return self.responses.pop(0)
+        return Response(True, {'state': True})
+
+
+class DeleteTests(FakeSend, TestCase):
+    """Test bulk deletion without network access"""
+    def setUp(self):
+        super(DeleteTests, self).setUp()
+        self.files = [self._file(i, '1') for i in range(250)]
+        self.files += [self._file(i, '2') for i in range(250, 252)]
+
+    def test_delete_batches(self):
+        assert self.api.delete(self.files)
+        assert [len(data) - 1 for data in self.requests] == [100, 100, 50, 2]
+        assert self.requests[3] == {'pid': '2', 'fid[0]': '250',
+                                    'fid[1]': '251'}
+        assert all(f.is_deleted for f in self.files)
+        with self.assertRaises(APIError):
+            self.files[0].delete()
+
+    def test_delete_job_error(self):
+        busy = Response(False, {'errno': 990005, 'error': 'Busy.'})
+        failure = Response(False, {'errno': 1, 'error': 'Failed.'})
+        self.responses = [busy, busy, Response(True, {}), failure]
+        with patch('u115.api.time.sleep') as sleep:
+            with self.assertRaises(APIError):
+                self.api.delete(self.files)
+        assert sleep.call_count == 2
+        # Only the first batch is confirmed
+        assert [f.is_deleted for f in self.files[99:101]] == [True, False]
+        assert self.files[251].delete()
+        assert self.requests[-1] == {'pid': '2', 'fid[0]': '251'}
+
+
+class MoveTests(FakeSend, TestCase):
+    """Test bulk moving without network access"""
+    def setUp(self):
+        super(MoveTests, self).setUp()
+        self.api.move_batch_size = 100
+        self.files = [self._file(i) for i in range(250)]
+        self.dir = Directory(self.api, cid='3', name='sub', pid='1')
+        self.dest = Directory(self.api, cid='2', name='dest', pid='0')
+
+    def test_move_batches(self):
+        assert self.api.move(self.files + [self.dir], self.dest,
+                             max_workers=3)
+        # No reload requests are sent
+        assert sorted(len(data) - 1 for data in self.requests) == \
+            [51, 100, 100]
+        assert all(data['pid'] == '2' for data in self.requests)
+        assert all(f.cid == '2' for f in self.files)
+        assert self.files[0].directory is self.dest
+        assert self.dir.pid == '2'
+        assert self.dir.parent is self.dest
+
+    def test_move_failure(self):
+        busy = Response(False, {'errno': 990005, 'error': 'Busy.'})
+        failure = Response(False, {'errno': 1, 'error': 'Failed.'})
+        self.responses = [busy, Response(True, {}), failure]
+        with patch('u115.api.time.sleep') as sleep:
+            with self.assertRaises(APIError):
+                self.api.move(self.files, self.dest)
+        assert sleep.call_count == 1
+        assert [f.cid for f in self.files[99:101]] == ['2', '1']
+        assert self.files[249].cid == '2'
+
+
+class EditManyTests(TestCase):
+    """Test bulk editing without network access"""
+    def setUp(self):
+        self.api = API()
+        self.api._req_files_edit = Mock(side_effect=self._edit)
+        self.files = [File(self.api, fid=str(i), cid='1', name='%d.txt' % i,
+                           size=1, file_type='txt', sha='SHA',
+                           date_created=None, thumbnail=None, pickcode='pc')
+                      for i in range(10)]
+        self.remote = dict((f.fid, f.name) for f in self.files)
+
+    def _edit(self, fid, file_name=None, is_mark=0):
+        if fid == '3':
+            raise RequestFailure('Failed to access files API.')
+        if fid != '5':
+            # The server silently ignores the edit of 5
+            self.remote[fid] = file_name
+        return True
+
+    def _iter_entries(self):
+        # The listing may carry ids as integers
+        for fid, name in sorted(self.remote.items()):
+            yield File(self.api, fid=int(fid), cid='1', name=name, size=1,
+                       file_type='txt', sha='SHA', date_created=None,
+                       thumbnail=None, pickcode='pc')
+
+    def test_edit_many(self):
+        edits = [(f, 'new%s.txt' % f.fid) for f in self.files]
+        edits[0] += (True,)
+        res = self.api.edit_many(edits, max_workers=3)
+        assert self.api._req_files_edit.call_count == 10
+        assert self.api._req_files_edit.call_args_list[0][0] == \
+            ('0', 'new0.txt', 1)
+        assert res['failed'] == [self.files[3]]
+        assert len(res['edited']) == 9
+        assert self.files[3].name == '3.txt'
+        assert self.files[5].name == 'new5.txt'
+
+    def test_edit_many_verify(self):
+        self.api._req_directory = Mock(return_value={
+            'cid': '1', 'name': 'dir', 'pid': '0', 'count': 10})
+        edits = [(f, 'new%s.txt' % f.fid) for f in self.files]
+        with patch.object(Directory, 'iter_entries',
+                          lambda d, prefetch=True: self._iter_entries()):
+            res = self.api.edit_many(edits, verify=True)
+        # Each parent directory is listed once
+        assert self.api._req_directory.call_count == 1
+        assert res['failed'] == [self.files[3], self.files[5]]
+        assert self.files[5].name == '5.txt'
+        assert [f.name for f in res['edited']] == \
+            ['new%d.txt' % i for i in (0, 1, 2, 4, 6, 7, 8, 9)]
+
+
+class DeleteTasksTests(FakeTasks, TestCase):
+    """Test bulk task deletion without network access"""
+    def setUp(self):
+        super(DeleteTasksTests, self).setUp()
+        for task in self.tasks[::3]:
+            task['status'] = -1
+        self.api._req_lixian = Mock(return_value=Response(True, {}))
+
+    def test_delete_tasks_by_status(self):
+        tasks = self.api.get_tasks(count=95)
+        self.api.delete_tasks_batch_size = 20
+        res = self.api.delete_tasks(tasks, status='failed')
+        assert res['deleted'] == ['h%d' % i for i in range(0, 95, 3)]
+        assert res['failed'] == []
+        assert self.api._req_lixian.call_count == 2
+        data = self.api._req_lixian.call_args_list[1][0][1]
+        assert data == dict(('hash[%d]' % i, 'h%d' % (60 + 3 * i))
+                            for i in range(12))
+        assert tasks[3].is_deleted and not tasks[1].is_deleted
+
+    def test_delete_tasks_failure(self):
+        self.api._req_lixian.return_value = Response(False, {})
+        res = self.api.delete_tasks(status=['TRANSFERRED'])
+        assert len(res['failed']) == 63
+        assert res['deleted'] == []
@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
 # flake8: noqa
 __version__ = '0.7.5'
-from u115.api import (API, Passport, RequestHandler, Request, Response,
+from u115.api import (API, Passport, RequestHandler, PoolAdapter,
+                      RetryPolicy, CircuitBreaker, Request, Response,
                       RequestsLWPCookieJar, RequestsMozillaCookieJar,
-                      Torrent, Task, TorrentFile, File, Directory,
+                      Torrent, Task, TaskWatcher, TaskEvent, TorrentFile,
+                      File, Directory,
                       APIError, TaskError, AuthenticationError,
                       InvalidAPIAccess, RequestFailure, JobError)
+from u115.cache import BaseCache, MemoryCache, SQLiteCache, PathCache
+from u115.downloader import (SegmentedDownloader, DownloadError,
+                             ChecksumError)
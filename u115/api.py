@@ -7,16 +7,31 @@ import json
 import logging
 import os
 import binascii
+import random
+import copy
+import email.utils
+import itertools
 import re
 import requests
+import socket
+import threading
 import time
+from collections import OrderedDict
 from hashlib import sha1
-from bs4 import BeautifulSoup
+from six.moves.urllib.parse import urlparse, parse_qs
+from requests.adapters import HTTPAdapter
 from requests.cookies import RequestsCookieJar
+from requests.packages.urllib3.connection import HTTPConnection
+from requests.packages.urllib3.exceptions import NewConnectionError
 from u115 import conf
+from u115.cache import PathCache
+from u115.downloader import SegmentedDownloader
+from u115.multipart import MultipartEncoder
 from u115.utils import (get_timestamp, get_utcdatetime, string_to_datetime,
-                        eval_path, quote, unquote, utf8_encode, txt_type, PY3)
-from homura import download
+                        eval_path, quote, unquote, utf8_encode, txt_type, PY3,
+                        str_types, threaded_map, threaded_imap, prefetched,
+                        sha1_file, hash_stream, STREAM, TransferStats,
+                        RateLimiter, get_magnet_info_hash)
 
 if PY3:
     from http import cookiejar as cookielib
@@ -42,17 +57,354 @@ class RequestsMozillaCookieJar(cookielib.MozillaCookieJar, RequestsCookieJar):
     pass
 
 
+class PoolAdapter(HTTPAdapter):
+    """
+    Transport adapter with a default timeout, TCP keep-alive and
+    utilization stats
+
+    :ivar timeout: default timeout of requests, either seconds or a
+        ``(connect, read)`` tuple, no timeout if None
+    :ivar bool keepalive: whether to enable TCP keep-alive on connections
+    :cvar int keepalive_idle: seconds a connection is idle before keep-alive
+        probes are sent
+    :cvar int keepalive_interval: seconds between keep-alive probes
+    :cvar int keepalive_count: number of unanswered probes before a
+        connection is dropped
+    """
+
+    __attrs__ = HTTPAdapter.__attrs__ + ['timeout', 'keepalive']
+    keepalive_idle = 60
+    keepalive_interval = 10
+    keepalive_count = 6
+
+    def __init__(self, pool_maxsize=10, timeout=None, keepalive=True,
+                 **kwargs):
+        """
+        :param int pool_maxsize: maximum number of connections kept per host
+        :param timeout: default timeout of requests, either seconds or a
+            ``(connect, read)`` tuple, no timeout if None
+        :param bool keepalive: whether to enable TCP keep-alive
+        :param kwargs: other arguments of
+            :class:`requests.adapters.HTTPAdapter`
+        """
+        # Set before HTTPAdapter.__init__, which initializes the pool manager
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self._active = 0
+        self._peak = 0
+        self._requests = 0
+        self._lock = threading.Lock()
+        super(PoolAdapter, self).__init__(pool_maxsize=pool_maxsize,
+                                          **kwargs)
+
+    def __setstate__(self, state):
+        self._active = 0
+        self._peak = 0
+        self._requests = 0
+        self._lock = threading.Lock()
+        super(PoolAdapter, self).__setstate__(state)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.keepalive:
+            kwargs['socket_options'] = self._keepalive_options()
+        super(PoolAdapter, self).init_poolmanager(*args, **kwargs)
+
+    def _keepalive_options(self):
+        options = list(HTTPConnection.default_socket_options)
+        options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+        # Not every platform allows tuning keep-alive probes
+        for name, value in (('TCP_KEEPIDLE', self.keepalive_idle),
+                            ('TCP_KEEPINTVL', self.keepalive_interval),
+                            ('TCP_KEEPCNT', self.keepalive_count)):
+            if hasattr(socket, name):
+                options.append((socket.IPPROTO_TCP, getattr(socket, name),
+                                value))
+        return options
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        with self._lock:
+            self._requests += 1
+            self._active += 1
+            self._peak = max(self._peak, self._active)
+        try:
+            return super(PoolAdapter, self).send(request, **kwargs)
+        finally:
+            with self._lock:
+                self._active -= 1
+
+    def resize(self, pool_maxsize):
+        """
+        Grow the pool of each host to keep at least ``pool_maxsize``
+        connections. Idle connections of the current pools are closed.
+
+        :param int pool_maxsize: maximum number of connections kept per host
+        """
+        if pool_maxsize <= self._pool_maxsize:
+            return
+        self.poolmanager.clear()
+        self.init_poolmanager(self._pool_connections, pool_maxsize,
+                              block=self._pool_block)
+
+    def stats(self):
+        """
+        Return utilization stats of this adapter
+
+        :return: a dict of ``requests``, the number of requests sent,
+            ``active`` and ``peak``, the current and maximum numbers of
+            requests in flight, and ``pool_maxsize``, along with ``pools``,
+            the number of host pools, ``connections``, the number of
+            connections opened, and ``idle``, the number of idle connections
+            kept for reuse, if the installed urllib3 exposes them
+        """
+        with self._lock:
+            stats = {
+                'requests': self._requests,
+                'active': self._active,
+                'peak': self._peak,
+                'pool_maxsize': self._pool_maxsize,
+            }
+        stats.update(self._pool_stats())
+        return stats
+
+    def _pool_stats(self):
+        """
+        Return stats of host pools, which are read from urllib3 internals,
+        or an empty dict if they are unavailable
+        """
+        try:
+            pools = self.poolmanager.pools
+            with pools.lock:
+                host_pools = list(pools._container.values())
+            idle = 0
+            for pool in host_pools:
+                if pool.pool is not None:
+                    idle += sum(1 for conn in list(pool.pool.queue)
+                                if conn is not None)
+            return {
+                'pools': len(host_pools),
+                'connections': sum(pool.num_connections
+                                   for pool in host_pools),
+                'idle': idle,
+            }
+        except (AttributeError, TypeError):
+            return {}
+
+
+class RetryPolicy(object):
+    """
+    Policy of retrying failed requests with exponential backoff and jitter
+
+    Idempotent requests (see :attr:`.Request.idempotent`) are retried upon
+    :attr:`retry_exceptions` and :attr:`status_forcelist` responses. Other
+    requests are only retried if they failed to connect, i.e. they were never
+    sent. Other errors, e.g. an invalid URL, are never retried.
+
+    :ivar int max_retries: maximum number of retries of a request
+    :ivar float backoff_factor: the n-th retry is delayed by a random
+        duration up to ``backoff_factor * 2 ** n`` seconds
+    :ivar float max_backoff: maximum delay in seconds
+    :cvar tuple status_forcelist: HTTP status codes that are retried
+    :cvar tuple retry_exceptions: transient errors of the connection that
+        are retried
+    """
+
+    status_forcelist = (429, 500, 502, 503, 504)
+    retry_exceptions = (requests.ConnectionError, requests.Timeout,
+                        requests.exceptions.ChunkedEncodingError)
+
+    def __init__(self, max_retries=3, backoff_factor=0.5, max_backoff=30):
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+
+    def can_retry(self, request, retries, error=None, status_code=None):
+        """
+        Whether ``request`` can be retried after failing with ``error`` or
+        ``status_code`` for ``retries`` times
+        """
+        if retries >= self.max_retries:
+            return False
+        if error is not None and not self.is_transient(error):
+            return False
+        if error is not None and _is_connect_error(error):
+            return True
+        if not request.idempotent:
+            return False
+        if status_code is not None:
+            return status_code in self.status_forcelist
+        return True
+
+    def is_transient(self, error):
+        """Whether ``error`` is one of :attr:`retry_exceptions`"""
+        return isinstance(error, self.retry_exceptions)
+
+    def backoff(self, retries, retry_after=None):
+        """
+        Return the delay in seconds before the next retry, which is at least
+        ``retry_after`` seconds if the server specifies it
+        """
+        delay = min(self.max_backoff, self.backoff_factor * 2 ** retries)
+        delay = random.uniform(0, delay)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+
+class CircuitBreaker(object):
+    """
+    Pause all requests of a :class:`.RequestHandler` when the service is
+    shedding load
+
+    The circuit opens after :attr:`threshold` consecutive failures, or
+    when the server asks to retry after some time (via ``Retry-After``),
+    and all requests wait until it closes again.
+
+    :ivar int threshold: number of consecutive failures that open the
+        circuit
+    :ivar float cooldown: seconds the circuit stays open after
+        :attr:`threshold` failures
+    """
+
+    def __init__(self, threshold=5, cooldown=30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self._open_until = 0
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self._open_until > time.time()
+
+    def wait(self):
+        """Block until the circuit is closed"""
+        while True:
+            with self._lock:
+                delay = self._open_until - time.time()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+
+    def record_failure(self, retry_after=None):
+        """
+        Record a failure, opening the circuit for at least ``retry_after``
+        seconds if specified
+        """
+        with self._lock:
+            self.failures += 1
+            pause = retry_after or 0
+            if self.failures >= self.threshold:
+                pause = max(pause, self.cooldown)
+            if pause > 0:
+                self._open_until = max(self._open_until, time.time() + pause)
+                logger = logging.getLogger(conf.LOGGING_API_LOGGER)
+                logger.warning('Pausing requests for %.1f seconds.', pause)
+
+
 class RequestHandler(object):
     """
     Request handler that maintains session
 
-    :ivar session: underlying :class:`requests.Session` instance
+    Each endpoint in :attr:`RequestHandler.endpoints` has its own
+    :class:`.PoolAdapter`, so that its connection pool and timeout can be
+    tuned separately; requests to other hosts (e.g. download servers) use
+    the `default` adapter.
+
+    Requests sent by :meth:`send` are retried according to
+    :attr:`retry_policy`, and paused by :attr:`circuit_breaker`.
 
+    :ivar session: underlying :class:`requests.Session` instance
+    :ivar dict adapters: :class:`.PoolAdapter` objects by endpoint name
+    :ivar retry_policy: :class:`.RetryPolicy` object
+    :ivar circuit_breaker: :class:`.CircuitBreaker` object shared by all
+        threads
+    :cvar dict endpoints: hosts of each endpoint by name
+    :cvar int pool_maxsize: default maximum number of connections kept per
+        host
+    :cvar tuple timeout: default ``(connect, read)`` timeout in seconds
+    :cvar dict endpoint_options: default adapter options that override the
+        global ones by endpoint name
     """
 
-    def __init__(self):
+    endpoints = {
+        'web.api': ['web.api.115.com'],
+        'aps': ['aps.115.com'],
+        'proapi': ['proapi.115.com'],
+        'passport': ['passport.115.com'],
+        'upload': ['upload.115.com', 'uplb.115.com'],
+    }
+    pool_maxsize = 10
+    timeout = (10, 60)
+    endpoint_options = {
+        # The response only arrives after the whole file is processed
+        'upload': {'timeout': (10, 600)},
+    }
+
+    def __init__(self, pool_maxsize=None, timeout=None, keepalive=True,
+                 endpoint_options=None, retry_policy=None,
+                 circuit_breaker=None):
+        """
+        :param int pool_maxsize: maximum number of connections kept per
+            host, defaults to :attr:`RequestHandler.pool_maxsize` if None
+        :param timeout: ``(connect, read)`` timeout or seconds, defaults to
+            :attr:`RequestHandler.timeout` if None
+        :param bool keepalive: whether to enable TCP keep-alive
+        :param dict endpoint_options: options of :class:`.PoolAdapter` by
+            endpoint name (or `default`), which override the global ones,
+            e.g. ``{'upload': {'timeout': (10, 1200)}}``
+        :param retry_policy: :class:`.RetryPolicy` object, a default one is
+            created if None
+        :param circuit_breaker: :class:`.CircuitBreaker` object, a default
+            one is created if None
+        """
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
         self.session = requests.Session()
         self.session.headers['User-Agent'] = USER_AGENT
+        defaults = {
+            'pool_maxsize': pool_maxsize or self.pool_maxsize,
+            'timeout': timeout or self.timeout,
+            'keepalive': keepalive,
+        }
+        self.adapters = {}
+        for name in ['default'] + sorted(self.endpoints):
+            options = dict(defaults)
+            options.update(self.endpoint_options.get(name, {}))
+            options.update((endpoint_options or {}).get(name, {}))
+            self.adapters[name] = PoolAdapter(**options)
+        for scheme in ('http://', 'https://'):
+            self.session.mount(scheme, self.adapters['default'])
+            for name, hosts in self.endpoints.items():
+                for host in hosts:
+                    self.session.mount('%s%s/' % (scheme, host),
+                                       self.adapters[name])
+
+    def resize_pools(self, pool_maxsize, endpoints=None):
+        """
+        Grow connection pools to keep at least ``pool_maxsize`` connections
+        per host, e.g. before downloading with many connections
+
+        :param int pool_maxsize: maximum number of connections kept per host
+        :param list endpoints: endpoint names (or `default`) of the pools,
+            all pools if None
+        """
+        for name in endpoints or list(self.adapters):
+            self.adapters[name].resize(pool_maxsize)
+
+    def stats(self):
+        """
+        Return utilization stats of connection pools
+
+        :return: a dict of :meth:`.PoolAdapter.stats` by endpoint name
+        """
+        return dict((name, adapter.stats())
+                    for name, adapter in self.adapters.items())
 
     def get(self, url, params=None):
         """
@@ -79,13 +431,56 @@ class RequestHandler(object):
         :param bool ignore_content: whether to ignore setting content of the
             Response object
         """
-        r = self.session.request(method=request.method,
-                                 url=request.url,
-                                 params=request.params,
-                                 data=request.data,
-                                 files=request.files,
-                                 headers=request.headers)
-        return self._response_parser(r, expect_json, ignore_content)
+        policy = self.retry_policy
+        retries = 0
+        while True:
+            self.circuit_breaker.wait()
+            retry_after = None
+            try:
+                r = self.session.request(method=request.method,
+                                         url=request.url,
+                                         params=request.params,
+                                         data=request.data,
+                                         files=request.files,
+                                         headers=request.headers)
+            except requests.RequestException as e:
+                if not policy.is_transient(e):
+                    # e.g. an invalid URL, which says nothing about the
+                    # service
+                    raise
+                self.circuit_breaker.record_failure()
+                if not policy.can_retry(request, retries, error=e):
+                    raise
+                reason = e
+            else:
+                retry = False
+                if r.status_code in policy.status_forcelist:
+                    retry_after = _parse_retry_after(
+                        r.headers.get('Retry-After'))
+                    self.circuit_breaker.record_failure(retry_after)
+                    retry = policy.can_retry(request, retries,
+                                             status_code=r.status_code)
+                else:
+                    self.circuit_breaker.record_success()
+                if retry:
+                    reason = 'HTTP %d' % r.status_code
+                    r.close()
+                else:
+                    res = self._response_parser(r, expect_json,
+                                                ignore_content)
+                    if res.state or not request.retry_on_failure or \
+                            retries >= policy.max_retries:
+                        return res
+                    reason = 'API failure'
+            self._wait_retry(request, retries, reason, retry_after)
+            retries += 1
+
+    def _wait_retry(self, request, retries, reason, retry_after=None):
+        delay = self.retry_policy.backoff(retries, retry_after)
+        logger = logging.getLogger(conf.LOGGING_API_LOGGER)
+        logger.info('Retrying %s in %.1f seconds (%s): %s',
+                    request.url, delay, retries + 1, reason)
+        time.sleep(delay)
 
     def _response_parser(self, r, expect_json=True, ignore_content=False):
         """
@@ -117,10 +512,19 @@ class RequestHandler(object):
 
 
 class Request(object):
-    """Formatted API request class"""
+    """
+    Formatted API request class
+
+    :ivar bool idempotent: whether the request can be sent more than once
+        without side effects, which allows it to be retried after it may
+        have reached the server
+    :ivar bool retry_on_failure: whether to retry the request if the API
+        responds with a failure state
+    """
 
     def __init__(self, url, method='GET', params=None, data=None,
-                 files=None, headers=None):
+                 files=None, headers=None, idempotent=None,
+                 retry_on_failure=False):
         """
         Create a Request object
 
@@ -130,6 +534,10 @@ class Request(object):
         :param dict data: form data
         :param dict files: mulitpart form data
         :param dict headers: custom request headers
+        :param bool idempotent: whether the request is idempotent, defaults
+            to whether ``method`` is `GET` or `HEAD` if None
+        :param bool retry_on_failure: whether to retry the request if the
+            API responds with a failure state
 
         """
         self.url = url
@@ -138,6 +546,10 @@ class Request(object):
         self.data = data
         self.files = files
         self.headers = headers
+        if idempotent is None:
+            idempotent = method.upper() in ('GET', 'HEAD')
+        self.idempotent = idempotent
+        self.retry_on_failure = retry_on_failure
         self._debug()
 
     def _debug(self):
@@ -179,20 +591,65 @@ class API(object):
     :ivar passport: :class:`.Passport` object associated with this interface
     :ivar http: :class:`.RequestHandler` object associated with this
         interface
+    :ivar int max_workers: default number of concurrent requests for
+        operations that can be parallelized (e.g. listing large directories)
+    :ivar cache: metadata cache (:class:`u115.cache.BaseCache` object) of
+        directories and files, or None if disabled
+    :ivar path_cache: :class:`u115.cache.PathCache` object of directories
+        resolved by path
     :cvar int num_tasks_per_page: default number of tasks per page/request
     :cvar str web_api_url: files API url
     :cvar str aps_natsort_url: natural sort files API url
     :cvar str proapi_url: pro API url for downloads
+    :cvar int download_url_ttl: seconds a download URL is cached if the
+        server does not specify its expiry
+    :cvar int upload_url_ttl: seconds the upload URL scraped from the source
+        page is cached
+    :cvar str upload_info_url: upload info API url for instant uploads
+    :cvar str init_upload_url: instant upload API url
+    :cvar int preid_size: number of leading bytes hashed as the pre-ID of
+        an instant upload
+    :cvar int signature_ttl: seconds the signatures of lixian (offline
+        task) requests are reused before being reloaded
+    :cvar signature_error_pattern: regular expression matching error
+        messages of lixian requests rejected for their signatures
+    :cvar int add_task_urls_batch_size: maximum number of URLs submitted in
+        one batch request
+    :cvar float add_task_rate: maximum number of URL tasks submitted per
+        second when batch requests are unavailable
+    :cvar int delete_batch_size: maximum number of entries deleted in one
+        request
+    :cvar int max_job_retries: maximum number of retries of a request that
+        fails with :class:`.JobError`
+    :cvar int delete_tasks_batch_size: maximum number of tasks deleted in
+        one request
+    :cvar int move_batch_size: maximum number of entries moved in one
+        request
     """
 
     num_tasks_per_page = 30
+    download_url_ttl = 1800
+    upload_url_ttl = 3600
+    upload_info_url = 'http://proapi.115.com/app/uploadinfo'
+    init_upload_url = 'http://uplb.115.com/3.0/initupload.php'
+    preid_size = 128 * 1024
+    signature_ttl = 600
+    signature_error_pattern = re.compile(u'sign|\u7b7e\u540d', re.I)
+    add_task_urls_batch_size = 15
+    add_task_rate = 2
+    delete_batch_size = 100
+    max_job_retries = 5
+    delete_tasks_batch_size = 100
+    move_batch_size = 1000
     web_api_url = 'http://web.api.115.com/files'
     aps_natsort_url = 'http://aps.115.com/natsort/files.php'
     proapi_url = 'http://proapi.115.com/app/chrome/down'
     referer_url = 'http://115.com'
 
     def __init__(self, persistent=False,
-                 cookies_filename=None, cookies_type='LWPCookieJar'):
+                 cookies_filename=None, cookies_type='LWPCookieJar',
+                 max_workers=1, cache=None, pool_maxsize=None, timeout=None,
+                 keepalive=True, endpoint_options=None, retry_policy=None):
         """
         :param bool auto_logout: whether to logout automatically when
             :class:`.API` object is destroyed
@@ -207,18 +664,44 @@ class API(object):
         :param str cookies_type: a string representing
             :class:`cookielib.FileCookieJar` subclass,
             `LWPCookieJar` (default) or `MozillaCookieJar`
+        :param int max_workers: default number of concurrent requests for
+            parallelizable operations, 1 (default) means serial requests
+        :param cache: metadata cache of directories and files, e.g.
+            :class:`u115.cache.MemoryCache` or :class:`u115.cache.SQLiteCache`.
+            No cache is used if None
+        :param int pool_maxsize: maximum number of connections kept per
+            host, defaults to the larger of ``max_workers`` and
+            :attr:`.RequestHandler.pool_maxsize` if None
+        :param timeout: ``(connect, read)`` timeout or seconds of requests,
+            defaults to :attr:`.RequestHandler.timeout` if None
+        :param bool keepalive: whether to enable TCP keep-alive
+        :param dict endpoint_options: connection options by endpoint name,
+            see :class:`.RequestHandler`
+        :param retry_policy: :class:`.RetryPolicy` object of failed
+            requests, a default one is used if None
         """
         self.persistent = persistent
         self.cookies_filename = cookies_filename
         self.cookies_type = cookies_type
+        self.max_workers = max_workers
+        self.cache = cache
+        self.path_cache = PathCache()
         self.passport = None
-        self.http = RequestHandler()
+        if pool_maxsize is None:
+            pool_maxsize = max(max_workers, RequestHandler.pool_maxsize)
+        self.http = RequestHandler(pool_maxsize, timeout, keepalive,
+                                   endpoint_options, retry_policy)
         self.logger = logging.getLogger(conf.LOGGING_API_LOGGER)
         # Cache attributes to decrease API hits
         self._user_id = None
         self._username = None
         self._signatures = {}
+        self._signatures_expiry = 0
+        self._signatures_lock = threading.Lock()
         self._upload_url = None
+        self._upload_url_expiry = 0
+        self._upload_crossdomain_loaded = False
+        self._upload_info = None
         self._lixian_timestamp = None
         self._root_directory = None
         self._downloads_directory = None
@@ -226,6 +709,8 @@ class API(object):
         self._torrents_directory = None
         self._task_count = None
         self._task_quota = None
+        self._download_urls = {}
+        self._download_urls_lock = threading.Lock()
         if self.persistent:
             self.load_cookies()
 
@@ -233,7 +718,11 @@ class API(object):
         self._user_id = None
         self._username = None
         self._signatures = {}
+        self._signatures_expiry = 0
         self._upload_url = None
+        self._upload_url_expiry = 0
+        self._upload_crossdomain_loaded = False
+        self._upload_info = None
         self._lixian_timestamp = None
         self._root_directory = None
         self._downloads_directory = None
@@ -241,6 +730,8 @@ class API(object):
         self._torrents_directory = None
         self._task_count = None
         self._task_quota = None
+        self._download_urls = {}
+        self.path_cache.clear()
 
     def _init_cookies(self):
         # RequestsLWPCookieJar or RequestsMozillaCookieJar
@@ -409,15 +900,45 @@ class API(object):
         self._req_lixian_task_lists()
         return self._task_quota
 
-    def get_tasks(self, count=30):
+    def get_tasks(self, count=30, max_workers=None):
         """
         Get ``count`` number of tasks
 
         :param int count: number of tasks to get
+        :param int max_workers: number of pages to fetch concurrently,
+            defaults to :attr:`.API.max_workers` if None
         :return: a list of :class:`.Task` objects
         """
 
-        return self._load_tasks(count)
+        return self._load_tasks(count, max_workers=max_workers)
+
+    def iter_tasks(self, count=None, prefetch=True):
+        """
+        Iterate over tasks lazily, page by page
+
+        :param int count: number of tasks to be iterated, all tasks if None
+        :param bool prefetch: whether to request the next page while the
+            current one is being consumed
+
+        Yield :class:`.Task` objects
+        """
+        first_page = self._req_lixian_task_lists(1)
+        if first_page is None:
+            return
+        if count is None or self._task_count < count:
+            count = self._task_count
+        pages = self._task_pages(count)
+        if prefetch:
+            rest = prefetched(self._req_lixian_task_lists, pages)
+        else:
+            rest = (self._req_lixian_task_lists(page) for page in pages)
+        n = 0
+        for tasks in itertools.chain([first_page], rest):
+            for t in tasks or []:
+                if n >= count:
+                    return
+                n += 1
+                yield _instantiate_task(self, t)
 
     def add_task_bt(self, file, select=False):
         """
@@ -447,6 +968,79 @@ class API(object):
         """
         return self._req_lixian_add_task_url(target_url)
 
+    def add_tasks_url(self, urls, dedup=True, max_workers=4):
+        """
+        Add new URL tasks in batches
+
+        URLs are submitted with batch requests. If batch requests are
+        unavailable, they are submitted one by one by a pool of worker
+        threads, limited to :attr:`.API.add_task_rate` requests per second.
+        If a batch request partly fails, only the URLs it reports as failed
+        are submitted again one by one.
+
+        :param list urls: URLs of the files to be downloaded
+        :param bool dedup: whether to skip magnet links whose info hash
+            matches an existing task, and URLs that are repeated
+        :param int max_workers: number of worker threads if URLs are
+            submitted one by one
+        :return: a list of dicts, one for each URL in order, with ``url``,
+            ``info_hash`` (None if unknown), ``status`` (`added`,
+            `duplicate` or `failed`) and ``error`` (if failed)
+        """
+        results = [{'url': url, 'info_hash': get_magnet_info_hash(url)}
+                   for url in urls]
+        pending = results
+        if dedup:
+            seen = set(t.info_hash.lower()
+                       for t in self.iter_tasks() if t.info_hash)
+            pending = []
+            for res in results:
+                key = res['info_hash'] or res['url']
+                if key in seen:
+                    res['status'] = 'duplicate'
+                else:
+                    seen.add(key)
+                    pending.append(res)
+        size = self.add_task_urls_batch_size
+        batches = [pending[i:i + size] for i in range(0, len(pending), size)]
+        failed = []
+        for i, batch in enumerate(batches):
+            try:
+                state, items = self._req_lixian_add_task_urls(
+                    [res['url'] for res in batch])
+            except (APIError, requests.RequestException) as e:
+                self.logger.info('Batch task submission is unavailable: %s',
+                                 e)
+                failed.extend(itertools.chain(*batches[i:]))
+                break
+            for res, item in zip(batch, items):
+                if item.get('state'):
+                    res['status'] = 'added'
+                    res['info_hash'] = item.get('info_hash') or \
+                        res['info_hash']
+                else:
+                    res['status'] = 'failed'
+                    res['error'] = item.get('error_msg')
+                    if not state:
+                        failed.append(res)
+        if failed:
+            self._add_tasks_url_serially(failed, max_workers)
+        return results
+
+    def _add_tasks_url_serially(self, results, max_workers):
+        limiter = RateLimiter(self.add_task_rate)
+
+        def add(res):
+            limiter.consume(1)
+            try:
+                self._req_lixian_add_task_url(res['url'])
+                res['status'] = 'added'
+                res.pop('error', None)
+            except (APIError, requests.RequestException) as e:
+                res['status'] = 'failed'
+                res['error'] = str(e)
+        threaded_map(add, results, max_workers)
+
     def get_storage_info(self, human=False):
         """
         Get storage info
@@ -462,13 +1056,26 @@ class API(object):
             res['used'] = humanize.naturalsize(res['used'], binary=True)
         return res
 
-    def upload(self, file, directory=None):
+    def upload(self, file, directory=None, progress_callback=None,
+               instant=True, digests=None):
         """
         Upload a file ``file`` to ``directory``
 
+        If ``instant`` is True, the SHA1 of the file is sent first, and if
+        the server already stores a file with the same content, it is added
+        without transferring the content. Otherwise, the file is streamed
+        from disk in chunks, so memory usage does not grow with file size.
+
         :param obj file: the file to upload
         :param directory: destionation :class:`.Directory`, defaults to
             :attribute:`.API.downloads_directory` if None
+        :param function progress_callback: a function called with the number
+            of bytes sent so far and the total number of bytes
+        :param bool instant: whether to try instant upload before
+            transferring the file
+        :param tuple digests: SHA1 of ``file`` and of its first
+            :attr:`.API.preid_size` bytes as uppercase hex digests, which are
+            computed for instant upload if None
         :return: the uploaded file
         :rtype: :class:`.File`
         """
@@ -478,8 +1085,14 @@ class API(object):
         if directory is None:
             directory = self.downloads_directory
 
+        if instant:
+            f = self._upload_instantly(file, directory, digests)
+            if f is not None:
+                return f
+
         # First request
-        res1 = self._req_upload(file, directory)
+        res1 = self._req_upload(file, directory, progress_callback)
+        self._invalidate_directories([directory.cid])
         data1 = res1['data']
         file_id = data1['file_id']
 
@@ -489,8 +1102,232 @@ class API(object):
         data2.update(**data1)
         return _instantiate_uploaded_file(self, data2)
 
+    def upload_tree(self, local_dir, directory=None, max_workers=4,
+                    max_retries=3, instant=True, show_progress=True,
+                    manifest=None):
+        """
+        Upload a local directory and its contents into ``directory``
+
+        The local hierarchy is recreated under a remote directory of the same
+        name, level by level. Files are uploaded by a bounded number of
+        worker threads and retried upon failures. Files that already exist
+        remotely with the same size and SHA1 are skipped.
+
+        :param str local_dir: path to the local directory
+        :param directory: destination :class:`.Directory`, defaults to
+            :attr:`.API.downloads_directory` if None
+        :param int max_workers: number of files uploaded concurrently
+        :param int max_retries: maximum number of retries of a file
+        :param bool instant: whether to try instant upload for each file
+        :param bool show_progress: whether to show aggregate progress
+        :param str manifest: path to write the result as JSON, if not None
+        :return: a dict of the result, where ``files`` is a list of dicts
+            with ``path`` (relative to ``local_dir``), ``size``, ``status``
+            (`uploaded`, `skipped` or `failed`), and ``fid`` and ``sha`` or
+            ``error``, and ``stats`` is the aggregate statistics
+        """
+        local_dir = eval_path(local_dir).rstrip(os.sep)
+        if directory is None:
+            directory = self.downloads_directory
+        remote_dirs = {'': self._get_or_mkdir(
+            directory, self._list_names(directory),
+            os.path.basename(local_dir))}
+        levels = []
+        local_files = []
+        for root, dirnames, filenames in os.walk(local_dir):
+            rel = os.path.relpath(root, local_dir).replace(os.sep, '/')
+            rel = '' if rel == '.' else rel
+            if rel:
+                depth = rel.count('/')
+                if len(levels) <= depth:
+                    levels.append([])
+                levels[depth].append(rel)
+            for name in sorted(filenames):
+                local_files.append((rel, name))
+
+        # Remote entries of each directory by name
+        listings = {'': self._list_names(remote_dirs[''])}
+        for level in levels:
+            parents = dict((rel, rel.rpartition('/')) for rel in level)
+            missing = []
+            for rel, (parent, _, name) in parents.items():
+                entry = listings[parent].get(name)
+                if isinstance(entry, Directory):
+                    remote_dirs[rel] = entry
+                else:
+                    missing.append(rel)
+            existing = [rel for rel in level if rel not in missing]
+            created = threaded_map(
+                lambda rel: self.mkdir(remote_dirs[parents[rel][0]],
+                                       parents[rel][2]),
+                missing, max_workers)
+            for rel, d in zip(missing, created):
+                remote_dirs[rel] = d
+                listings[rel] = {}
+            names = threaded_map(lambda rel: self._list_names(
+                remote_dirs[rel]), existing, max_workers)
+            listings.update(zip(existing, names))
+
+        stats = TransferStats()
+        total = len(local_files)
+
+        def upload_file(item):
+            rel, name = item
+            relpath = '/'.join([rel, name]) if rel else name
+            res = self._upload_tree_file(
+                os.path.join(local_dir, *relpath.split('/')),
+                remote_dirs[rel], listings[rel].get(name), max_retries,
+                instant, stats, total if show_progress else None)
+            res['path'] = relpath
+            return res
+
+        files = list(threaded_imap(upload_file, local_files, max_workers))
+        if show_progress:
+            stats.report(total, force=True)
+            print(file=STREAM)
+        result = {'directory': remote_dirs[''].cid, 'files': files,
+                  'stats': stats.to_dict()}
+        if manifest is not None:
+            with open(eval_path(manifest), 'w') as f:
+                json.dump(result, f, indent=2)
+        return result
+
+    def _upload_tree_file(self, path, directory, existing, max_retries,
+                          instant, stats, total):
+        """Upload a file of :meth:`.API.upload_tree`"""
+        res = {'size': os.path.getsize(path)}
+        same_size = isinstance(existing, File) and \
+            existing.size == res['size']
+        digests = None
+        if same_size or instant:
+            # Hashed once for the comparison and all upload attempts
+            with open(path, 'rb') as f:
+                digests = self._upload_digests(f)
+        if same_size and existing.sha.upper() == digests[0]:
+            res.update(status='skipped', fid=existing.fid, sha=existing.sha)
+            stats.add_file()
+            return res
+        sent = [0]
+
+        def progress(n, _):
+            stats.add_bytes(n - sent[0])
+            sent[0] = n
+            if total is not None:
+                stats.report(total)
+
+        retries = 0
+        while True:
+            sent[0] = 0
+            try:
+                with open(path, 'rb') as f:
+                    u = self.upload(f, directory, progress, instant,
+                                    digests)
+                res.update(status='uploaded', fid=u.fid, sha=u.sha)
+                stats.add_file()
+                return res
+            except (APIError, requests.RequestException, IOError) as e:
+                if retries >= max_retries:
+                    self.logger.error('Failed to upload %s: %s', path, e)
+                    res.update(status='failed', error=str(e))
+                    stats.add_file(False)
+                    return res
+                retries += 1
+                self.logger.warning('Retrying upload of %s: %s', path, e)
+                time.sleep(min(2 ** retries, 30))
+
+    def _list_names(self, directory):
+        """Return entries of ``directory`` by name"""
+        return dict((entry.name, entry)
+                    for entry in directory.iter_entries(prefetch=False))
+
+    def _get_or_mkdir(self, parent, entries, name):
+        """Return the directory ``name`` in ``entries`` of ``parent``,
+        creating one if it does not exist"""
+        entry = entries.get(name)
+        if isinstance(entry, Directory):
+            return entry
+        return self.mkdir(parent, name)
+
+    def _upload_digests(self, file):
+        """
+        Return the SHA1 of ``file`` from its current position, and the SHA1
+        of its first :attr:`.API.preid_size` bytes, as uppercase hex digests
+        """
+        hasher, head_hasher = sha1(), sha1()
+        hash_stream(hasher, file, head_hasher=head_hasher,
+                    head_size=self.preid_size)
+        return hasher.hexdigest().upper(), head_hasher.hexdigest().upper()
+
+    def _upload_instantly(self, file, directory, digests=None):
+        """
+        Try to upload ``file`` by its SHA1 without transferring its content
+
+        :param tuple digests: digests of ``file`` returned by
+            :meth:`.API._upload_digests`, computed if None
+        :return: the uploaded :class:`.File`, or None if the server does not
+            store the file or instant upload is unavailable
+        """
+        try:
+            pos = file.tell()
+            file.seek(0, os.SEEK_END)
+            size = file.tell() - pos
+            file.seek(pos)
+        except (AttributeError, IOError, OSError, ValueError):
+            # Not seekable, so the content cannot be read twice
+            return None
+        if digests is None:
+            digests = self._upload_digests(file)
+        fileid, preid = digests
+        name = self._get_upload_filename(file)
+        try:
+            res = self._req_init_upload(name, size, fileid, preid, directory)
+            if res.get('status') == 7:
+                # The server asks for the SHA1 of a byte range to prove
+                # that the content is available
+                start, end = map(int, res['sign_check'].split('-'))
+                file.seek(pos + start)
+                range_hasher = sha1()
+                hash_stream(range_hasher, file, end - start + 1)
+                res = self._req_init_upload(
+                    name, size, fileid, preid, directory,
+                    sign_key=res['sign_key'],
+                    sign_val=range_hasher.hexdigest().upper())
+        except (APIError, requests.RequestException, KeyError,
+                ValueError) as e:
+            self.logger.warning('Instant upload is unavailable: %s', e)
+            return None
+        finally:
+            file.seek(pos)
+        if res.get('status') != 2 or res.get('statuscode') != 0:
+            return None
+        self._invalidate_directories([directory.cid])
+        pickcode = res.get('pickcode')
+        data = res.get('data')
+        file_id = res.get('file_id') or (
+            data.get('file_id') if isinstance(data, dict) else None)
+        if file_id is not None:
+            data = self._req_file(file_id)['data'][0]
+            _, ft = os.path.splitext(data.get('file_name', name))
+            ptime = data.get('file_ptime') or data.get('user_ptime')
+            return File(self, fid=str(file_id), cid=directory.cid,
+                        name=data.get('file_name', name),
+                        size=int(data.get('file_size', size)),
+                        file_type=ft[1:], sha=data.get('sha1', fileid),
+                        date_created=(get_utcdatetime(int(ptime))
+                                      if ptime else None),
+                        thumbnail=None,
+                        pickcode=data.get('pick_code', pickcode))
+        # Older responses carry no file id, so look the file up by its
+        # pickcode or SHA1
+        for entry in directory.iter_entries(show_dir=False, prefetch=False):
+            if isinstance(entry, File) and (
+                    entry.pickcode == pickcode or
+                    pickcode is None and entry.sha.upper() == fileid):
+                return entry
+        raise APIError('Instantly uploaded file is not found.')
+
     def download(self, obj, path=None, show_progress=True, resume=True,
-                 auto_retry=True, proapi=False):
+                 auto_retry=True, proapi=False, connections=1, verify=False):
         """
         Download a file
 
@@ -502,11 +1339,110 @@ class API(object):
         :param bool auto_retry: whether to retry automatically upon closed
             transfer until the file's download is finished
         :param bool proapi: whether to use pro API
+        :param int connections: number of parallel connections. If greater
+            than 1, the file is split into byte ranges that are downloaded
+            in parallel
+        :param bool verify: whether to verify the downloaded bytes against
+            :attr:`.File.sha`, raising
+            :class:`u115.downloader.ChecksumError` on mismatch. The SHA1 is
+            computed while the file is being written
+
+        The file is downloaded by
+        :class:`u115.downloader.SegmentedDownloader`, which requests a new
+        download URL when the current one expires.
         """
         url = obj.get_download_url(proapi)
-        download(url, path=path, session=self.http.session,
-                 show_progress=show_progress, resume=resume,
-                 auto_retry=auto_retry)
+        path = self._get_download_path(obj, path)
+        self.http.resize_pools(connections, ['default'])
+        downloader = SegmentedDownloader(
+            url, path, obj.size, session=self.http.session,
+            connections=connections, show_progress=show_progress,
+            resume=resume, auto_retry=auto_retry,
+            url_refresher=lambda: obj.get_download_url(proapi, True),
+            sha1=obj.sha if verify else None)
+        downloader.start()
+
+    def verify_local(self, obj, path=None):
+        """
+        Verify a local copy of a file against its SHA1 on the server
+
+        :param obj: :class:`.File` object
+        :param str path: local path of the file, or the directory that holds
+            it. Defaults to the current working directory if None
+        :return: whether the local file exists and matches :attr:`.File.sha`
+        :rtype: bool
+        """
+        path = self._get_download_path(obj, path)
+        if not os.path.isfile(path) or os.path.getsize(path) != obj.size:
+            return False
+        return sha1_file(path) == obj.sha.upper()
+
+    def _get_download_path(self, obj, path=None):
+        """
+        Get the local file path to download ``obj`` to. If ``path`` is None
+        or a directory, the file is named after ``obj``.
+        """
+        if path is None:
+            return os.path.join(os.getcwd(), obj.name)
+        path = eval_path(path)
+        if os.path.isdir(path):
+            return os.path.join(path, obj.name)
+        return path
+
+    def prefetch_download_urls(self, files, proapi=False, max_workers=None):
+        """
+        Resolve download URLs of many files concurrently, so that they are
+        cached before a bulk download starts
+
+        :param list files: a list of :class:`.File` objects
+        :param bool proapi: whether to use pro API
+        :param int max_workers: number of concurrent requests, defaults to
+            :attr:`.API.max_workers` if None
+        :return: a list of download URLs in the order of ``files``
+        """
+        if max_workers is None:
+            max_workers = self.max_workers
+        # Warm up cookies once instead of in every concurrent request
+        if '_115_curtime' not in self.cookies:
+            self._req_file_userfile()
+        return threaded_map(lambda f: f.get_download_url(proapi), files,
+                            max_workers)
+
+    def _get_download_url(self, pickcode, proapi=False, refresh=False):
+        """
+        Get a download URL from the cache of this session, or request a new
+        one if it is missing, expired or ``refresh`` is True
+        """
+        key = (pickcode, proapi)
+        now = time.time()
+        with self._download_urls_lock:
+            cached = self._download_urls.get(key)
+        if cached is not None and not refresh and cached[1] > now:
+            return cached[0]
+        url = self._req_files_download_url(pickcode, proapi)
+        with self._download_urls_lock:
+            self._download_urls[key] = (url, self._get_url_expiry(url))
+        return url
+
+    def _get_url_expiry(self, url):
+        """
+        Get the timestamp a download URL expires at. The URL's `t` parameter
+        is used if it is a timestamp in the future, otherwise the URL expires
+        in :attr:`.API.download_url_ttl` seconds
+        """
+        now = time.time()
+        expiry = now + self.download_url_ttl
+        t = parse_qs(urlparse(url).query).get('t')
+        if t:
+            try:
+                t = int(t[0])
+            except ValueError:
+                pass
+            else:
+                if t > now:
+                    # Leave a margin for downloads to start
+                    expiry = min(expiry, t - 60)
+        return expiry
 
     def search(self, keyword, count=30):
         """
@@ -520,25 +1456,248 @@ class API(object):
         root = self.root_directory
         entries = root._load_entries(func=self._req_files_search,
                                      count=count, page=1, **kwargs)
-
-        res = []
+        return [_instantiate_entry(self, entry) for entry in entries]
+
+    def walk(self, directory=None, max_depth=None, max_workers=None,
+             dir_filter=None, file_filter=None):
+        """
+        Traverse a directory tree breadth-first, similar to :func:`os.walk`
+
+        Directories of the same level are listed concurrently, and a 3-tuple
+        ``(dirpath, dirs, files)`` is yielded for each directory as soon as
+        its listing arrives. ``dirpath`` is a slash-separated path starting
+        with the name of ``directory``. Like :func:`os.walk`, the caller can
+        modify ``dirs`` in-place to prune the traversal.
+
+        :param directory: :class:`.Directory` to start with, defaults to
+            :attr:`.API.root_directory` if None
+        :param int max_depth: maximum depth to descend, where 0 means only
+            ``directory`` itself is listed. No limit if None
+        :param int max_workers: number of directories to list concurrently,
+            defaults to :attr:`.API.max_workers` if None
+        :param function dir_filter: a function that takes a
+            :class:`.Directory` and returns whether it is included and
+            descended into
+        :param function file_filter: a function that takes a :class:`.File`
+            and returns whether it is included
+        """
+        if directory is None:
+            directory = self.root_directory
+        if max_workers is None:
+            max_workers = self.max_workers
+
+        def list_directory(item):
+            dirpath, d = item
+            dirs = []
+            files = []
+            for entry in d.iter_entries(prefetch=False):
+                if isinstance(entry, Directory):
+                    if dir_filter is None or dir_filter(entry):
+                        dirs.append(entry)
+                elif file_filter is None or file_filter(entry):
+                    files.append(entry)
+            return dirpath, dirs, files
+
+        level = [(directory.name, directory)]
+        depth = 0
+        while level:
+            next_level = []
+            for dirpath, dirs, files in threaded_imap(list_directory, level,
+                                                      max_workers):
+                yield dirpath, dirs, files
+                if max_depth is None or depth < max_depth:
+                    next_level.extend(
+                        ('%s/%s' % (dirpath, d.name), d) for d in dirs)
+            level = next_level
+            depth += 1
+
+    def get_path(self, path):
+        """
+        Get a file or directory by its slash-separated path from the root
+        directory, e.g. ``/Movies/2016/movie.mkv``
+
+        Directories resolved before are cached in :attr:`.API.path_cache`,
+        so that only uncached path components are listed.
+
+        :param str path: path of the entry
+        :return: :class:`.File` or :class:`.Directory` object
+        :raise: :class:`.APIError` if the path does not exist
+        """
+        entry = self.get_paths([path])[path]
+        if entry is None:
+            raise APIError('No such file or directory: %s' % path)
+        return entry
+
+    def get_paths(self, paths, max_workers=None):
+        """
+        Get many files or directories by their paths
+
+        Paths are resolved level by level, and each uncached directory is
+        listed at most once, with directories of the same level listed
+        concurrently.
+
+        :param list paths: paths of the entries
+        :param int max_workers: number of directories to list concurrently,
+            defaults to :attr:`.API.max_workers` if None
+        :return: a dict of :class:`.File` or :class:`.Directory` objects by
+            path, with None for paths that do not exist
+        """
+        if max_workers is None:
+            max_workers = self.max_workers
+        results = OrderedDict((path, None) for path in paths)
+        pending = [(path, _split_path(path)) for path in results]
+        listings = {}
+        while pending:
+            unresolved = []
+            for path, names in pending:
+                cid, n = self.path_cache.resolve(names)
+                if n == len(names):
+                    results[path] = self._get_cached_directory(cid)
+                else:
+                    unresolved.append((path, names, cid, n))
+            cids = list(OrderedDict.fromkeys(
+                cid for _, _, cid, _ in unresolved if cid not in listings))
+            listings.update(zip(cids, threaded_map(self._list_all, cids,
+                                                   max_workers)))
+            pending = []
+            for path, names, cid, n in unresolved:
+                if self.path_cache.resolve(names)[1] > n:
+                    # The listing contains the next directory
+                    pending.append((path, names))
+                elif n == len(names) - 1:
+                    for entry in listings[cid]:
+                        if isinstance(entry, File) and \
+                                entry.name == names[-1]:
+                            results[path] = entry
+                            break
+        return results
+
+    def makedirs(self, path, exist_ok=False):
+        """
+        Create a directory by its path from the root directory, along with
+        all missing intermediate directories, similar to :func:`os.makedirs`
+
+        :param str path: path of the directory
+        :param bool exist_ok: whether to return the directory if it already
+            exists, instead of raising :class:`.APIError`
+        :return: the directory
+        :rtype: :class:`.Directory`
+        """
+        names = _split_path(path)
+        cid, n = self.path_cache.resolve(names)
+        while n < len(names):
+            # List the deepest known directory until the next one is missing
+            self._list_all(cid)
+            next_cid, next_n = self.path_cache.resolve(names)
+            if next_n == n:
+                break
+            cid, n = next_cid, next_n
+        if n == len(names):
+            if not exist_ok:
+                raise APIError('Directory already exists: %s' % path)
+            return self._get_cached_directory(cid)
+        directory = self._get_cached_directory(cid)
+        for name in names[n:]:
+            directory = self.mkdir(directory, name)
+        return directory
+
+    def _get_cached_directory(self, cid):
+        """Return the directory ``cid`` in :attr:`.API.path_cache`"""
+        if cid == PathCache.root_cid:
+            return self.root_directory
+        name, pid = self.path_cache.get(cid)
+        return Directory(api=self, cid=cid, name=name, pid=pid)
+
+    def _list_all(self, cid):
+        """List all entries of the directory ``cid`` without loading it"""
+        limit = Directory.max_entries_per_load
+        entries = []
+        offset = 0
+        count = None
+        # The count of the first page bounds the listing, even if the server
+        # keeps returning full pages beyond it
+        while count is None or offset < count:
+            res = self._req_files(cid=cid, offset=offset, limit=limit)
+            if count is None:
+                count = int(res['count'])
+            data = res['data'][:limit]
+            entries.extend(_instantiate_entry(self, entry) for entry in data)
+            if len(data) < limit:
+                break
+            offset += limit
+        return entries
+
+    def delete(self, entries):
+        """
+        Delete one or more entries (file or directory)
+
+        Entries in the same directory are deleted in batches of at most
+        :attr:`.API.delete_batch_size` entries per request. Requests that
+        fail with :class:`.JobError` are retried with backoff. An entry is
+        marked deleted only after its request succeeds.
+
+        :param list entries: a list of entries (:class:`.BaseFile` object)
+        :return: whether the action is successful
+        :raise: :class:`.APIError` if something bad happened, in which case
+            entries of the previous requests remain deleted
+        """
+        groups = OrderedDict()
         for entry in entries:
-            if 'pid' in entry:
-                res.append(_instantiate_directory(self, entry))
+            if isinstance(entry, File):
+                fcid, pid = entry.fid, entry.cid
+            elif isinstance(entry, Directory):
+                fcid, pid = entry.cid, entry.pid
             else:
-                res.append(_instantiate_file(self, entry))
-        return res
+                raise APIError('Invalid BaseFile instance for an entry.')
+            if entry.is_deleted:
+                raise APIError('This file or directory is already deleted.')
+            groups.setdefault(pid, []).append((fcid, entry))
+        size = self.delete_batch_size
+        for pid, items in groups.items():
+            for i in range(0, len(items), size):
+                batch = items[i:i + size]
+                self._retry_job(self._req_rb_delete,
+                                [fcid for fcid, _ in batch], pid)
+                batch_entries = [entry for _, entry in batch]
+                self._invalidate_entries(batch_entries)
+                for entry in batch_entries:
+                    entry._deleted = True
+        return True
 
-    def move(self, entries, directory):
+    def _retry_job(self, func, *args):
+        """
+        Call ``func`` with ``args``, retrying with exponential backoff
+        upon :class:`.JobError`
+        """
+        retries = 0
+        while True:
+            try:
+                return func(*args)
+            except JobError:
+                if retries >= self.max_job_retries:
+                    raise
+                retries += 1
+                self.logger.info('A similar job is running, retrying.')
+                time.sleep(min(2 ** retries, 30))
+
+    def move(self, entries, directory, max_workers=None):
         """
         Move one or more entries (file or directory) to the destination
         directory
 
+        Entries are moved in batches of at most :attr:`.API.move_batch_size`
+        entries per request, and batches are sent concurrently. Moved
+        entries are not reloaded; their parent directories are updated
+        locally.
+
         :param list entries: a list of source entries (:class:`.BaseFile`
             object)
         :param directory: destination directory
+        :param int max_workers: number of concurrent requests, defaults to
+            :attr:`.API.max_workers` if None
         :return: whether the action is successful
-        :raise: :class:`.APIError` if something bad happened
+        :raise: :class:`.APIError` if something bad happened, in which case
+            entries of the successful batches remain moved
         """
         fcids = []
         for entry in entries:
@@ -551,14 +1710,38 @@ class API(object):
             fcids.append(fcid)
         if not isinstance(directory, Directory):
             raise APIError('Invalid destination directory.')
-        if self._req_files_move(directory.cid, fcids):
-            for entry in entries:
+        if max_workers is None:
+            max_workers = self.max_workers
+        size = self.move_batch_size
+        batches = [(fcids[i:i + size], entries[i:i + size])
+                   for i in range(0, len(fcids), size)]
+
+        def move(batch):
+            try:
+                self._retry_job(self._req_files_move, directory.cid, batch[0])
+            except (APIError, requests.RequestException) as e:
+                return e
+
+        errors = threaded_map(move, batches, max_workers)
+        self._invalidate_directories([directory.cid])
+        for (_, batch_entries), error in zip(batches, errors):
+            if error is not None:
+                continue
+            # Invalidate the source directories before they are updated
+            self._invalidate_entries(batch_entries)
+            for entry in batch_entries:
                 if isinstance(entry, File):
                     entry.cid = directory.cid
-                entry.reload()
-            return True
-        else:
-            raise APIError('Error moving entries.')
+                    entry._directory = directory
+                else:
+                    entry.pid = directory.cid
+                    entry._parent = directory
+        for error in errors:
+            if error is not None:
+                if isinstance(error, APIError):
+                    raise error
+                raise APIError('Error moving entries: %s' % error)
+        return True
 
     def edit(self, entry, name, mark=False):
         """
@@ -579,11 +1762,93 @@ class API(object):
         if mark is True:
             is_mark = 1
         if self._req_files_edit(fcid, name, is_mark):
+            self._invalidate_entries([entry])
             entry.reload()
             return True
         else:
             raise APIError('Error editing the entry.')
 
+    def edit_many(self, edits, max_workers=None, verify=False):
+        """
+        Edit many entries concurrently
+
+        Unlike :meth:`.API.edit`, entries are not reloaded after being
+        edited; their new names are applied locally on success.
+
+        :param list edits: a list of ``(entry, name)`` or ``(entry, name,
+            mark)`` tuples, where ``entry`` is a :class:`.BaseFile` object,
+            ``name`` is its new name and ``mark`` is whether to bookmark it
+        :param int max_workers: number of concurrent requests, defaults to
+            :attr:`.API.max_workers` if None
+        :param bool verify: whether to list each parent directory once at
+            the end to verify the new names. Entries whose names do not
+            match are reported as failed, with their names reset to the
+            actual ones
+        :return: a dict with ``edited``, a list of the edited entries, and
+            ``failed``, a list of the entries that failed to be edited
+        """
+        if max_workers is None:
+            max_workers = self.max_workers
+        edits = [tuple(edit) + (False,) * (3 - len(edit)) for edit in edits]
+        for entry, _, _ in edits:
+            if not isinstance(entry, (File, Directory)):
+                raise APIError('Invalid BaseFile instance for an entry.')
+
+        def edit(args):
+            entry, name, mark = args
+            fcid = entry.fid if isinstance(entry, File) else entry.cid
+            try:
+                self._req_files_edit(fcid, name, 1 if mark is True else 0)
+            except (APIError, requests.RequestException) as e:
+                self.logger.error('Failed to edit %s: %s', entry.name, e)
+                return False
+            entry.name = name
+            return True
+
+        results = threaded_map(edit, edits, max_workers)
+        edited = [e[0] for e, ok in zip(edits, results) if ok]
+        failed = [e[0] for e, ok in zip(edits, results) if not ok]
+        self._invalidate_entries([e[0] for e in edits])
+        if verify and edited:
+            mismatched = self._verify_names(edited, max_workers)
+            edited = [e for e in edited if e not in mismatched]
+            failed.extend(mismatched)
+        return {'edited': edited, 'failed': failed}
+
+    def _verify_names(self, entries, max_workers):
+        """
+        List each parent directory of ``entries`` once, and return entries
+        whose names differ from the listed ones, which are then applied
+        """
+        parents = OrderedDict()
+        for entry in entries:
+            pid = entry.cid if isinstance(entry, File) else entry.pid
+            parents.setdefault(str(pid), []).append(entry)
+
+        def key_of(e):
+            # Listings may carry ids as integers while entries hold strings
+            if isinstance(e, File):
+                return ('f', str(e.fid))
+            return ('d', str(e.cid))
+
+        def list_names(pid):
+            parent = Directory(api=self, **self._req_directory(pid))
+            names = {}
+            for e in parent.iter_entries(prefetch=False):
+                names[key_of(e)] = e.name
+            return names
+
+        mismatched = []
+        listings = threaded_map(list_names, list(parents), max_workers)
+        for children, names in zip(parents.values(), listings):
+            for entry in children:
+                name = names.get(key_of(entry))
+                if name != entry.name:
+                    mismatched.append(entry)
+                    if name is not None:
+                        entry.name = name
+        return mismatched
+
     def mkdir(self, parent, name):
         """
         Create a directory
@@ -601,6 +1866,8 @@ class API(object):
         else:
             raise('Invalid Directory instance.')
         cid = self._req_files_add(pid, name)['cid']
+        self._invalidate_directories([pid])
+        self.path_cache.add(cid, name, pid)
         return self._load_directory(cid)
 
     def _req_offline_space(self):
@@ -625,26 +1892,58 @@ class API(object):
         if r.state:
             self._signatures['offline_space'] = r.content['sign']
             self._lixian_timestamp = r.content['time']
+            self._signatures_expiry = time.time() + self.signature_ttl
         else:
             msg = 'Failed to retrieve signatures.'
             raise RequestFailure(msg)
 
+    def _req_lixian(self, ac, data, idempotent=False):
+        """
+        Send a lixian request signed with the cached signatures
+
+        If the request is rejected because of expired cached signatures (see
+        :attr:`.API.signature_error_pattern`), they are reloaded and the
+        request is sent once more. Other failures are returned as is.
+
+        :param str ac: lixian action
+        :param dict data: form data without signatures
+        :param bool idempotent: whether the action has no side effects, so
+            that it can be retried
+        :return: :class:`.Response` object
+        """
+        url = 'http://115.com/lixian/'
+        params = {'ct': 'lixian', 'ac': ac}
+        fresh = self._load_signatures()
+        while True:
+            with self._signatures_lock:
+                sign = self._signatures['offline_space']
+                timestamp = self._lixian_timestamp
+            signed = dict(data)
+            signed['uid'] = self.user_id
+            signed['sign'] = sign
+            signed['time'] = timestamp
+            req = Request(method='POST', url=url, params=params, data=signed,
+                          idempotent=idempotent)
+            res = self.http.send(req)
+            if res.state or fresh or not self._is_signature_error(res):
+                return res
+            self.logger.info('Lixian request %s is rejected, reloading '
+                             'signatures.', ac)
+            fresh = self._load_signatures(force=True, rejected=sign)
+
+    def _is_signature_error(self, res):
+        """Whether a lixian response is a rejection of its signature"""
+        content = res.content if isinstance(res.content, dict) else {}
+        msg = content.get('error_msg') or content.get('error') or ''
+        return bool(self.signature_error_pattern.search(msg))
+
     def _req_lixian_task_lists(self, page=1):
         """
         This request will cause the system to create a default downloads
         directory if it does not exist
         """
-        url = 'http://115.com/lixian/'
-        params = {'ct': 'lixian', 'ac': 'task_lists'}
-        self._load_signatures()
-        data = {
-            'page': page,
-            'uid': self.user_id,
-            'sign': self._signatures['offline_space'],
-            'time': self._lixian_timestamp,
-        }
-        req = Request(method='POST', url=url, params=params, data=data)
-        res = self.http.send(req)
+        res = self._req_lixian('task_lists', {'page': page},
+                               idempotent=True)
         if res.state:
             self._task_count = res.content['count']
             self._task_quota = res.content['quota']
@@ -670,22 +1969,11 @@ class API(object):
         """
         :param u: uploaded torrent file
         """
-
-        self._load_signatures()
-        url = 'http://115.com/lixian/'
-        params = {
-            'ct': 'lixian',
-            'ac': 'torrent',
-        }
         data = {
             'pickcode': u.pickcode,
             'sha1': u.sha,
-            'uid': self.user_id,
-            'sign': self._signatures['offline_space'],
-            'time': self._lixian_timestamp,
         }
-        req = Request(method='POST', url=url, params=params, data=data)
-        res = self.http.send(req)
+        res = self._req_lixian('torrent', data)
         if res.state:
             return res.content
         else:
@@ -694,10 +1982,6 @@ class API(object):
             raise RequestFailure('Failed to open torrent.')
 
     def _req_lixian_add_task_bt(self, t):
-
-        self._load_signatures()
-        url = 'http://115.com/lixian/'
-        params = {'ct': 'lixian', 'ac': 'add_task_bt'}
         _wanted = []
         for i, b in enumerate(t.files):
             if b.selected:
@@ -707,12 +1991,8 @@ class API(object):
             'info_hash': t.info_hash,
             'wanted': wanted,
             'savepath': t.name,
-            'uid': self.user_id,
-            'sign': self._signatures['offline_space'],
-            'time': self._lixian_timestamp,
         }
-        req = Request(method='POST', url=url, params=params, data=data)
-        res = self.http.send(req)
+        res = self._req_lixian('add_task_bt', data)
         if res.state:
             return True
         else:
@@ -721,18 +2001,7 @@ class API(object):
             raise RequestFailure(msg)
 
     def _req_lixian_add_task_url(self, target_url):
-
-        self._load_signatures()
-        url = 'http://115.com/lixian/'
-        params = {'ct': 'lixian', 'ac': 'add_task_url'}
-        data = {
-            'url': target_url,
-            'uid': self.user_id,
-            'sign': self._signatures['offline_space'],
-            'time': self._lixian_timestamp,
-        }
-        req = Request(method='POST', url=url, params=params, data=data)
-        res = self.http.send(req)
+        res = self._req_lixian('add_task_url', {'url': target_url})
         if res.state:
             return True
         else:
@@ -740,19 +2009,33 @@ class API(object):
             self.logger.error(msg)
             raise RequestFailure(msg)
 
-    def _req_lixian_task_del(self, t):
+    def _req_lixian_add_task_urls(self, target_urls):
+        """
+        Add URL tasks in one request
 
-        self._load_signatures()
-        url = 'http://115.com/lixian/'
-        params = {'ct': 'lixian', 'ac': 'task_del'}
-        data = {
-            'hash[0]': t.info_hash,
-            'uid': self.user_id,
-            'sign': self._signatures['offline_space'],
-            'time': self._lixian_timestamp,
-        }
-        req = Request(method='POST', url=url, params=params, data=data)
-        res = self.http.send(req)
+        :return: a tuple of whether the whole request succeeded, and a list
+            of results (with ``state``, ``info_hash`` and ``error_msg``) of
+            each URL. Results are also returned if the request partly failed
+        """
+        data = dict(('url[%d]' % i, target_url)
+                    for i, target_url in enumerate(target_urls))
+        res = self._req_lixian('add_task_urls', data)
+        result = res.content.get('result')
+        if result is None or len(result) != len(target_urls):
+            msg = res.content.get('error_msg') or \
+                'Failed to add tasks in batch.'
+            raise RequestFailure(msg)
+        return res.state, result
+
+    def _req_lixian_task_del(self, tasks):
+        """
+        :param tasks: a :class:`.Task` object or a list of them
+        """
+        if not isinstance(tasks, (list, tuple)):
+            tasks = [tasks]
+        data = dict(('hash[%d]' % i, t.info_hash)
+                    for i, t in enumerate(tasks))
+        res = self._req_lixian('task_del', data)
         if res.state:
             return True
         else:
@@ -782,9 +2065,11 @@ class API(object):
         """
         params = locals()
         del params['self']
-        req = Request(method='GET', url=self.aps_natsort_url, params=params)
+        req = Request(method='GET', url=self.aps_natsort_url, params=params,
+                      retry_on_failure=True)
         res = self.http.send(req)
         if res.state:
+            self._cache_paths(res.content)
             return res.content
         else:
             raise RequestFailure('Failed to access files API.')
@@ -809,9 +2094,14 @@ class API(object):
         """
         params = locals()
         del params['self']
-        req = Request(method='GET', url=self.web_api_url, params=params)
+        # The failure with o='file_name' and natsort=1 is permanent, see
+        # API._req_aps_natsort_files
+        retry = not (o == 'file_name' and natsort == 1)
+        req = Request(method='GET', url=self.web_api_url, params=params,
+                      retry_on_failure=retry)
         res = self.http.send(req)
         if res.state:
+            self._cache_paths(res.content)
             return res.content
         else:
             raise RequestFailure('Failed to access files API.')
@@ -834,7 +2124,8 @@ class API(object):
         url = self.web_api_url + '/edit'
         data = locals()
         del data['self']
-        req = Request(method='POST', url=url, data=data)
+        # Renaming to the same name again has no further effect
+        req = Request(method='POST', url=url, data=data, idempotent=True)
         res = self.http.send(req)
         if res.state:
             return True
@@ -868,25 +2159,47 @@ class API(object):
         data['pid'] = pid
         for i, fid in enumerate(fids):
             data['fid[%d]' % i] = fid
-        req = Request(method='POST', url=url, data=data)
+        # Moving to the same directory again has no further effect
+        req = Request(method='POST', url=url, data=data, idempotent=True)
         res = self.http.send(req)
         if res.state:
             return True
         else:
+            if res.content.get('errno') == 990005:
+                raise JobError()
             raise RequestFailure('Failed to access files API.')
 
     def _req_file(self, file_id):
+        key = 'file:%s' % file_id
+        res = self._cache_get(key)
+        if res is not None:
+            return res
         url = self.web_api_url + '/file'
         data = {'file_id': file_id}
         req = Request(method='POST', url=url, data=data)
         res = self.http.send(req)
         if res.state:
+            self._cache_set(key, res.content)
             return res.content
         else:
             raise RequestFailure('Failed to access files API.')
 
-    def _req_directory(self, cid):
-        """Return name and pid of by cid"""
+    def _req_directory(self, cid, refresh=False):
+        """
+        Return name, pid and count of a directory by cid
+
+        Only name and pid are cached, since entries may be added to the
+        directory elsewhere (e.g. by offline tasks); the count of a cached
+        directory is -1, i.e. unknown.
+
+        :param bool refresh: whether to bypass the cache to get the count
+        """
+        key = 'directory:%s' % cid
+        if not refresh:
+            res = self._cache_get(key)
+            if res is not None:
+                res['count'] = -1
+                return res
         res = self._req_files(cid=cid, offset=0, limit=1, show_dir=1)
         path = res['path']
         count = res['count']
@@ -896,8 +2209,9 @@ class API(object):
                     'cid': d['cid'],
                     'name': d['name'],
                     'pid': d['pid'],
-                    'count': count,
                 }
+                self._cache_set(key, res)
+                res['count'] = count
                 return res
         else:
             raise RequestFailure('No directory found.')
@@ -937,22 +2251,45 @@ class API(object):
         res = self.http.send(req)
         return res.content['1']
 
-    def _req_upload(self, file, directory):
-        """Raw request to upload a file ``file``"""
-        self._upload_url = self._load_upload_url()
-        self.http.get('http://upload.115.com/crossdomain.xml')
-        if hasattr(file, 'name'):
-            b = os.path.basename(file.name)
-        else:
-            b = binascii.b2a_hex(os.urandom(16))
+    def _req_upload(self, file, directory, progress_callback=None):
+        """
+        Raw request to upload a file ``file``
+
+        If the cached upload URL is rejected, it is scraped again and the
+        upload is retried once, provided that ``file`` is seekable.
+        """
+        cached = self._upload_url is not None and \
+            self._upload_url_expiry > time.time()
+        try:
+            pos = file.tell()
+        except (AttributeError, IOError, OSError):
+            pos = None
+        try:
+            return self._req_upload_file(file, directory, progress_callback)
+        except (requests.HTTPError, InvalidAPIAccess) as e:
+            if not cached or pos is None:
+                raise
+            self.logger.info('Upload URL rejected, reloading: %s', e)
+            self._load_upload_url(force=True)
+            file.seek(pos)
+            return self._req_upload_file(file, directory, progress_callback)
+
+    def _req_upload_file(self, file, directory, progress_callback=None):
+        url = self._load_upload_url()
+        if not self._upload_crossdomain_loaded:
+            self.http.get('http://upload.115.com/crossdomain.xml')
+            self._upload_crossdomain_loaded = True
+        b = self._get_upload_filename(file)
         target = 'U_1_' + str(directory.cid)
-        files = {
-            'Filename': ('', quote(b), ''),
-            'target': ('', target, ''),
-            'Filedata': (quote(b), file, ''),
-            'Upload': ('', 'Submit Query', ''),
-        }
-        req = Request(method='POST', url=self._upload_url, files=files)
+        fields = [
+            ('Filename', quote(b)),
+            ('target', target),
+            ('Filedata', (quote(b), file, None)),
+            ('Upload', 'Submit Query'),
+        ]
+        body = MultipartEncoder(fields, callback=progress_callback)
+        headers = {'Content-Type': body.content_type}
+        req = Request(method='POST', url=url, data=body, headers=headers)
         res = self.http.send(req)
         if res.state:
             return res.content
@@ -964,13 +2301,53 @@ class API(object):
                 msg = 'Torrent upload failed. Please try again later.'
             raise RequestFailure(msg)
 
-    def _req_rb_delete(self, fcid, pid):
+    def _req_upload_info(self):
+        req = Request(method='GET', url=self.upload_info_url)
+        res = self.http.send(req)
+        if res.state:
+            return res.content
+        else:
+            raise RequestFailure('Failed to get upload info.')
 
-        url = 'http://web.api.115.com/rb/delete'
+    def _req_init_upload(self, filename, filesize, fileid, preid, directory,
+                         sign_key=None, sign_val=None):
+        """Raw request to upload a file by its SHA1 ``fileid``"""
+        self._load_upload_info()
+        user_id = str(self._upload_info['user_id'])
+        target = 'U_1_' + str(directory.cid)
         data = {
-            'pid': pid,
-            'fid[0]': fcid,
+            'appid': 0,
+            'appfrom': 10,
+            'appversion': '2.0.0.0',
+            'isp': 0,
+            'userid': user_id,
+            'filename': filename,
+            'filesize': filesize,
+            'fileid': fileid,
+            'preid': preid,
+            'target': target,
+            'sig': self._get_upload_sig(user_id, fileid, target),
         }
+        if sign_key is not None:
+            data['sign_key'] = sign_key
+            data['sign_val'] = sign_val
+        req = Request(method='POST', url=self.init_upload_url, data=data)
+        res = self.http.send(req)
+        return res.content
+
+    def _req_rb_delete(self, fcids, pid):
+        """
+        Delete files or directories
+        :param list fcids: a list of ids of files or directories in the same
+            directory, or a single id
+        :param str pid: id of their parent directory
+        """
+        url = 'http://web.api.115.com/rb/delete'
+        if not isinstance(fcids, (list, tuple)):
+            fcids = [fcids]
+        data = {'pid': pid}
+        for i, fcid in enumerate(fcids):
+            data['fid[%d]' % i] = fcid
         req = Request(method='POST', url=url, data=data)
         res = self.http.send(req)
         if res.state:
@@ -994,24 +2371,161 @@ class API(object):
         if res.state:
             return res.content
 
-    def _load_signatures(self, force=True):
-        if not self._signatures or force:
-            self._req_offline_space()
+    def _cache_key(self, key):
+        """
+        Namespace ``key`` by the current user, so that a persistent cache
+        never serves metadata of another account
+        """
+        return '%s:%s' % (self.user_id, key)
+
+    def _cache_get(self, key):
+        """Get a copy of the cached metadata of ``key``, if any"""
+        if self.cache is None:
+            return None
+        return copy.deepcopy(self.cache.get(self._cache_key(key)))
+
+    def _cache_set(self, key, value):
+        if self.cache is not None:
+            self.cache.set(self._cache_key(key), value)
+
+    def _cache_delete(self, keys):
+        if self.cache is not None:
+            self.cache.delete(*[self._cache_key(key) for key in keys])
+
+    def _invalidate_directories(self, cids):
+        """Invalidate cached metadata of directories with ``cids``"""
+        self._cache_delete(['directory:%s' % cid for cid in cids])
+
+    def _cache_paths(self, res):
+        """
+        Add directories of a listing and its ancestor path to
+        :attr:`.API.path_cache`
+        """
+        for d in res.get('path', []):
+            self.path_cache.add(d['cid'], d['name'], d['pid'])
+        for entry in res.get('data', []):
+            if 'pid' in entry:
+                self.path_cache.add(entry['cid'], entry['n'], entry['pid'])
+
+    def _invalidate_entries(self, entries):
+        """
+        Invalidate cached metadata of ``entries`` and their parent
+        directories
+        """
+        for entry in entries:
+            if isinstance(entry, Directory):
+                self.path_cache.discard(entry.cid)
+        if self.cache is None:
+            return
+        keys = []
+        for entry in entries:
+            if isinstance(entry, File):
+                keys.append('file:%s' % entry.fid)
+                keys.append('directory:%s' % entry.cid)
+            elif isinstance(entry, Directory):
+                keys.append('directory:%s' % entry.cid)
+                keys.append('directory:%s' % entry.pid)
+        self._cache_delete(keys)
+
+    def _load_signatures(self, force=False, rejected=None):
+        """
+        Load signatures of lixian requests, unless the cached ones are
+        younger than :attr:`.API.signature_ttl` seconds
+
+        :param bool force: whether to reload the signatures anyway
+        :param str rejected: the signature rejected by the server, which is
+            not reloaded again if another thread already replaced it
+        :return: whether the signatures are reloaded
+        """
+        with self._signatures_lock:
+            if rejected is not None and \
+                    self._signatures.get('offline_space') != rejected:
+                return True
+            if force or not self._signatures or \
+                    self._signatures_expiry <= time.time():
+                self._req_offline_space()
+                return True
+            return False
+
+    def delete_tasks(self, tasks=None, status=None):
+        """
+        Delete tasks in batches (does not influence their corresponding
+        directories)
 
-    def _load_tasks(self, count, page=1, tasks=None):
+        :param list tasks: a list of :class:`.Task` objects, all tasks if
+            None
+        :param status: only delete tasks of this :attr:`.Task.status_human`
+            (e.g. `FAILED` or `TRANSFERRED`), or of any of a list of them.
+            Tasks are filtered locally without listing them again
+        :return: a dict with ``deleted``, info hashes of the deleted tasks,
+            and ``failed``, info hashes of the tasks that failed to be
+            deleted
+        """
         if tasks is None:
-            tasks = []
-        req_tasks = self._req_lixian_task_lists(page)
-        loaded_tasks = []
-        if req_tasks is not None:
-            loaded_tasks = [
-                _instantiate_task(self, t) for t in req_tasks[:count]
-            ]
-        if count <= self.num_tasks_per_page or req_tasks is None:
-            return tasks + loaded_tasks
-        else:
-            return self._load_tasks(count - self.num_tasks_per_page,
-                                    page + 1, tasks + loaded_tasks)
+            tasks = self.iter_tasks()
+        if status is not None:
+            if isinstance(status, str_types):
+                status = [status]
+            status = set(s.upper() for s in status)
+        tasks = [t for t in tasks if not t.is_deleted and
+                 (status is None or t.status_human in status)]
+        res = {'deleted': [], 'failed': []}
+        size = self.delete_tasks_batch_size
+        for i in range(0, len(tasks), size):
+            batch = tasks[i:i + size]
+            hashes = [t.info_hash for t in batch]
+            try:
+                self._req_lixian_task_del(batch)
+            except (APIError, requests.RequestException) as e:
+                self.logger.error('Failed to delete %d tasks: %s',
+                                  len(batch), e)
+                res['failed'].extend(hashes)
+                continue
+            for t in batch:
+                t._deleted = True
+            res['deleted'].extend(hashes)
+        return res
+
+    def watch_tasks(self, callback=None, **kwargs):
+        """
+        Create a :class:`.TaskWatcher` that emits events of task changes
+
+        :param function callback: a function called with each
+            :class:`.TaskEvent`
+        :param kwargs: other arguments of :class:`.TaskWatcher`
+        :return: a :class:`.TaskWatcher` object
+        """
+        watcher = TaskWatcher(self, **kwargs)
+        if callback is not None:
+            watcher.add_callback(callback)
+        return watcher
+
+    def _load_tasks(self, count, page=1, max_workers=None):
+        """
+        Load ``count`` tasks starting from ``page``. The first page tells
+        the total number of tasks, and the remaining pages are then fetched
+        concurrently.
+        """
+        if max_workers is None:
+            max_workers = self.max_workers
+        first_page = self._req_lixian_task_lists(page)
+        if first_page is None:
+            return []
+        start = (page - 1) * self.num_tasks_per_page
+        count = min(count, max(self._task_count - start, 0))
+        pages = self._task_pages(count, page)
+        rest = threaded_map(self._req_lixian_task_lists, pages, max_workers)
+        req_tasks = list(itertools.chain(first_page,
+                                         *[tasks or [] for tasks in rest]))
+        return [_instantiate_task(self, t) for t in req_tasks[:count]]
+
+    def _task_pages(self, count, page=1):
+        """
+        Return numbers of the pages after ``page`` that hold the rest of
+        ``count`` tasks starting from ``page``
+        """
+        per_page = self.num_tasks_per_page
+        return list(range(page + 1, page + (count + per_page - 1) // per_page))
 
     def _load_directory(self, cid):
         kwargs = self._req_directory(cid)
@@ -1045,9 +2559,37 @@ class API(object):
         r = self._req_lixian_get_id(torrent=False)
         self._downloads_directory = self._load_directory(r['cid'])
 
-    def _load_upload_url(self):
-        res = self._parse_src_js_var('upload_config_h5')
-        return res['url']
+    def _load_upload_info(self, force=False):
+        """Load user ID and key used to sign instant uploads"""
+        if self._upload_info is None or force:
+            self._upload_info = self._req_upload_info()
+
+    def _get_upload_sig(self, user_id, fileid, target):
+        userkey = self._upload_info['userkey']
+        inner = sha1(
+            utf8_encode(user_id + fileid + target + '0')).hexdigest()
+        return sha1(
+            utf8_encode(userkey + inner + '000000')).hexdigest().upper()
+
+    def _get_upload_filename(self, file):
+        if hasattr(file, 'name'):
+            return os.path.basename(file.name)
+        return binascii.b2a_hex(os.urandom(16))
+
+    def _load_upload_url(self, force=False):
+        """
+        Load the upload URL, which is cached for
+        :attr:`.API.upload_url_ttl` seconds
+
+        :param bool force: whether to scrape the source page even if the
+            cached URL has not expired
+        """
+        if force or self._upload_url is None or \
+                self._upload_url_expiry <= time.time():
+            res = self._parse_src_js_var('upload_config_h5')
+            self._upload_url = res['url']
+            self._upload_url_expiry = time.time() + self.upload_url_ttl
+        return self._upload_url
 
     def _load_torrent(self, u):
         res = self._req_lixian_torrent(u)
@@ -1058,15 +2600,22 @@ class API(object):
 
         src_url = 'http://115.com'
         r = self.http.get(src_url)
-        soup = BeautifulSoup(r.content)
-        scripts = [script.text for script in soup.find_all('script')]
-        text = '\n'.join(scripts)
-        pattern = "%s\s*=\s*(.*);" % (variable.upper())
-        m = re.search(pattern, text)
-        if not m:
-            msg = 'Cannot parse source JavaScript for %s.' % variable
-            raise APIError(msg)
-        return json.loads(m.group(1).strip())
+        # Only assignments in script blocks count, not mentions of the
+        # variable in markup
+        pattern = re.compile(r'\b%s\s*=(?!=)\s*' % re.escape(variable.upper()))
+        decoder = json.JSONDecoder()
+        for script in re.findall(r'<script[^>]*>(.*?)</script>', r.content,
+                                 re.S | re.I):
+            m = pattern.search(script)
+            if m is None:
+                continue
+            # Decode the JSON literal only, regardless of what follows it
+            try:
+                return decoder.raw_decode(script, m.end())[0]
+            except ValueError:
+                break
+        msg = 'Cannot parse source JavaScript for %s.' % variable
+        raise APIError(msg)
 
     def _get_username(self):
         return unquote(self.cookies.get('OOFL'))
@@ -1168,24 +2717,7 @@ class BaseFile(Base):
         :raise: :class:`.APIError` if this file or directory is already deleted
 
         """
-        fcid = None
-        pid = None
-
-        if isinstance(self, File):
-            fcid = self.fid
-            pid = self.cid
-        elif isinstance(self, Directory):
-            fcid = self.cid
-            pid = self.pid
-        else:
-            raise APIError('Invalid BaseFile instance.')
-
-        if not self._deleted:
-            if self.api._req_rb_delete(fcid, pid):
-                self._deleted = True
-                return True
-        else:
-            raise APIError('This file or directory is already deleted.')
+        return self.api.delete([self])
 
     def move(self, directory):
         """
@@ -1257,7 +2789,6 @@ class File(BaseFile):
         self.thumbnail = thumbnail
         self.pickcode = pickcode
         self._directory = None
-        self._download_url = None
 
     @property
     def directory(self):
@@ -1266,17 +2797,17 @@ class File(BaseFile):
             self._directory = self.api._load_directory(self.cid)
         return self._directory
 
-    def get_download_url(self, proapi=False):
+    def get_download_url(self, proapi=False, refresh=False):
         """
-        Get this file's download URL
+        Get this file's download URL. URLs are cached by the API until they
+        expire.
 
         :param bool proapi: whether to use pro API
+        :param bool refresh: whether to request a new URL regardless of the
+            cache
 
         """
-        if self._download_url is None:
-            self._download_url = \
-                self.api._req_files_download_url(self.pickcode, proapi)
-        return self._download_url
+        return self.api._get_download_url(self.pickcode, proapi, refresh)
 
     @property
     def url(self):
@@ -1284,10 +2815,10 @@ class File(BaseFile):
         return self.get_download_url()
 
     def download(self, path=None, show_progress=True, resume=True,
-                 auto_retry=True, proapi=False):
-        """Download this file"""
+                 auto_retry=True, proapi=False, connections=1, verify=False):
+        """Download this file, see :meth:`.API.download`"""
         self.api.download(self, path, show_progress, resume, auto_retry,
-                          proapi)
+                          proapi, connections, verify)
 
     @property
     def is_torrent(self):
@@ -1373,12 +2904,12 @@ class Directory(BaseFile):
         * `count`
 
         """
-        r = self.api._req_directory(self.cid)
+        r = self.api._req_directory(self.cid, refresh=True)
         self.pid = r['pid']
         self.name = r['name']
         self._count = r['count']
 
-    def _load_entries(self, func, count, page=1, entries=None, **kwargs):
+    def _load_entries(self, func, count, page=1, max_workers=1, **kwargs):
         """
         Load entries
 
@@ -1387,47 +2918,56 @@ class Directory(BaseFile):
         :param int count: number of entries to load. This value should never
             be greater than self.count
         :param int page: page number (starting from 1)
+        :param int max_workers: number of pages to fetch concurrently
 
         """
-        if entries is None:
-            entries = []
-        res = \
-            func(offset=(page - 1) * self.max_entries_per_load,
-                 limit=self.max_entries_per_load,
-                 **kwargs)
-        loaded_entries = [
-            entry for entry in res['data'][:count]
-        ]
-        #total_count = res['count']
-        total_count = self.count
-        # count should never be greater than total_count
-        if count > total_count:
-            count = total_count
-        if count <= self.max_entries_per_load:
-            return entries + loaded_entries
-        else:
-            cur_count = count - self.max_entries_per_load
-            return self._load_entries(
-                func=func, count=cur_count, page=page + 1,
-                entries=entries + loaded_entries, **kwargs)
+        pages = self._pages(count, page)
 
-    def list(self, count=30, order='user_ptime', asc=False, show_dir=True,
-             natsort=True):
+        def load_page(page):
+            offset, limit = page
+            return self._load_page(func, offset, limit, **kwargs)
+
+        entries = []
+        for loaded_entries in threaded_map(load_page, pages, max_workers):
+            entries.extend(loaded_entries)
+        return entries
+
+    def _iter_pages(self, func, count, page=1, prefetch=True, **kwargs):
         """
-        List directory contents
+        Yield entries page by page. If ``prefetch`` is True, the next page is
+        requested while the current one is being consumed.
+        """
+        pages = self._pages(count, page)
 
-        :param int count: number of entries to be listed
-        :param str order: order of entries, originally named `o`. This value
-            may be one of `user_ptime` (default), `file_size` and `file_name`
-        :param bool asc: whether in ascending order
-        :param bool show_dir: whether to show directories
-        :param bool natsort: whether to use natural sort
+        def load_page(page):
+            offset, limit = page
+            return self._load_page(func, offset, limit, **kwargs)
 
-        Return a list of :class:`.File` or :class:`.Directory` objects
+        if prefetch:
+            return prefetched(load_page, pages)
+        return (load_page(page) for page in pages)
+
+    def _pages(self, count, page=1):
         """
-        if self.cid is None:
-            return False
-        self.reload()
+        Return a list of ``(offset, limit)`` for pages that hold ``count``
+        entries starting from ``page``
+        """
+        # count should never be greater than total count
+        count = min(count, self.count)
+        start = (page - 1) * self.max_entries_per_load
+        end = start + count
+        return [
+            (offset, min(self.max_entries_per_load, end - offset))
+            for offset in range(start, end, self.max_entries_per_load)
+        ]
+
+    def _load_page(self, func, offset, limit, **kwargs):
+        """Load at most ``limit`` entries of the page at ``offset``"""
+        res = func(offset=offset, limit=self.max_entries_per_load, **kwargs)
+        return res['data'][:limit]
+
+    def _list_kwargs(self, order, asc, show_dir, natsort):
+        """Return request kwargs for listing"""
         kwargs = {}
         # `cid` is the only required argument
         kwargs['cid'] = self.cid
@@ -1435,6 +2975,26 @@ class Directory(BaseFile):
         kwargs['show_dir'] = 1 if show_dir is True else 0
         kwargs['natsort'] = 1 if natsort is True else 0
         kwargs['o'] = order
+        return kwargs
+
+    def _load_first_page(self, func, **kwargs):
+        """
+        Load the first page of entries, and update :attr:`count` from its
+        response instead of reloading this directory
+
+        :return: a tuple of the entries and the function that listed them
+        """
+        try:
+            res = func(offset=0, limit=self.max_entries_per_load, **kwargs)
+        # When natsort=1 and order='file_name', API access will fail
+        except RequestFailure as e:
+            if kwargs['natsort'] == 1 and kwargs['o'] == 'file_name':
+                func = self.api._req_aps_natsort_files
+                res = func(offset=0, limit=self.max_entries_per_load,
+                           **kwargs)
+            else:
+                raise e
+        self._count = res['count']
 
         # When the downloads directory exists along with its parent directory,
         # the receiver directory, its parent's count (receiver directory's
@@ -1449,28 +3009,69 @@ class Directory(BaseFile):
 
         if self.is_root or self == self.api.receiver_directory:
             self._count += 1
+        return res['data'][:self.max_entries_per_load], func
 
+    def list(self, count=30, order='user_ptime', asc=False, show_dir=True,
+             natsort=True, max_workers=None):
+        """
+        List directory contents
+
+        :param int count: number of entries to be listed
+        :param str order: order of entries, originally named `o`. This value
+            may be one of `user_ptime` (default), `file_size` and `file_name`
+        :param bool asc: whether in ascending order
+        :param bool show_dir: whether to show directories
+        :param bool natsort: whether to use natural sort
+        :param int max_workers: number of pages to fetch concurrently,
+            defaults to :attr:`.API.max_workers` if None
+
+        Return a list of :class:`.File` or :class:`.Directory` objects
+        """
+        if self.cid is None:
+            return False
+        kwargs = self._list_kwargs(order, asc, show_dir, natsort)
+        if max_workers is None:
+            max_workers = self.api.max_workers
+        entries, func = self._load_first_page(self.api._req_files, **kwargs)
         if self.count <= count:
             # count should never be greater than self.count
             count = self.count
-        try:
-            entries = self._load_entries(func=self.api._req_files,
-                                         count=count, page=1, **kwargs)
-        # When natsort=1 and order='file_name', API access will fail
-        except RequestFailure as e:
-            if natsort is True and order == 'file_name':
-                entries = \
-                    self._load_entries(func=self.api._req_aps_natsort_files,
-                                       count=count, page=1, **kwargs)
-            else:
-                raise e
-        res = []
-        for entry in entries:
-            if 'pid' in entry:
-                res.append(_instantiate_directory(self.api, entry))
-            else:
-                res.append(_instantiate_file(self.api, entry))
-        return res
+        entries = entries[:count]
+        entries += self._load_entries(
+            func=func, count=count - self.max_entries_per_load, page=2,
+            max_workers=max_workers, **kwargs)
+        return [_instantiate_entry(self.api, entry) for entry in entries]
+
+    def iter_entries(self, count=None, order='user_ptime', asc=False,
+                     show_dir=True, natsort=True, prefetch=True):
+        """
+        Iterate over directory contents lazily, page by page
+
+        :param int count: number of entries to be iterated, all entries if
+            None
+        :param str order: order of entries, originally named `o`. This value
+            may be one of `user_ptime` (default), `file_size` and `file_name`
+        :param bool asc: whether in ascending order
+        :param bool show_dir: whether to show directories
+        :param bool natsort: whether to use natural sort
+        :param bool prefetch: whether to request the next page while the
+            current one is being consumed
+
+        Yield :class:`.File` or :class:`.Directory` objects
+        """
+        if self.cid is None:
+            return
+        kwargs = self._list_kwargs(order, asc, show_dir, natsort)
+        first_page, func = self._load_first_page(self.api._req_files,
+                                                 **kwargs)
+        if count is None or self.count <= count:
+            count = self.count
+        pages = self._iter_pages(
+            func=func, count=count - self.max_entries_per_load, page=2,
+            prefetch=prefetch, **kwargs)
+        for entries in itertools.chain([first_page[:count]], pages):
+            for entry in entries:
+                yield _instantiate_entry(self.api, entry)
 
     def mkdir(self, name):
         """
@@ -1666,6 +3267,206 @@ class Task(Base):
         return self.name
 
 
+class TaskEvent(Base):
+    """
+    Change of a task detected by :class:`.TaskWatcher`
+
+    :ivar str type: event type, one of
+
+        * `added`: the task is created
+        * `progress`: the task is updated while downloading or transferring
+        * `transferred`: the task has been transferred
+        * `failed`: the task is failed
+        * `deleted`: the task is deleted
+
+    :ivar task: the :class:`.Task` object (its last snapshot if deleted)
+    :ivar previous: the previous snapshot of the task, or None if added
+    """
+
+    ADDED = 'added'
+    PROGRESS = 'progress'
+    TRANSFERRED = 'transferred'
+    FAILED = 'failed'
+    DELETED = 'deleted'
+
+    def __init__(self, type, task, previous=None):
+        self.type = type
+        self.task = task
+        self.previous = previous
+
+    def __unicode__(self):
+        return '%s %s' % (self.type, self.task.name)
+
+
+class TaskWatcher(object):
+    """
+    Watch tasks and emit :class:`.TaskEvent` objects upon changes
+
+    Tasks are polled with an adaptive interval: :attr:`min_interval` while
+    any task is active (not transferred nor failed), and doubled each time
+    nothing changes, up to :attr:`max_interval`. Snapshots are compared by
+    info hash. Since tasks are ordered by creation time, polling stops at
+    the first page after which all known tasks are finished and unchanged;
+    all pages are fetched every :attr:`full_poll_interval` polls to detect
+    deleted tasks.
+
+    :ivar api: associated :class:`.API` object
+    :ivar dict tasks: last snapshot of tasks by info hash
+    :ivar float interval: current polling interval in seconds
+    :cvar float min_interval: polling interval while tasks are active
+    :cvar float max_interval: maximum polling interval while idle
+    :cvar int full_poll_interval: number of polls between two full polls
+    """
+
+    min_interval = 5
+    max_interval = 300
+    full_poll_interval = 10
+
+    def __init__(self, api, min_interval=None, max_interval=None):
+        """
+        :param api: :class:`.API` object
+        :param float min_interval: overrides :attr:`min_interval`
+        :param float max_interval: overrides :attr:`max_interval`
+        """
+        self.api = api
+        if min_interval is not None:
+            self.min_interval = min_interval
+        if max_interval is not None:
+            self.max_interval = max_interval
+        self.tasks = None
+        self.interval = self.min_interval
+        self.logger = logging.getLogger(conf.LOGGING_API_LOGGER)
+        self._callbacks = []
+        self._polls = 0
+        self._stopped = threading.Event()
+
+    def add_callback(self, callback):
+        """Call ``callback`` with each :class:`.TaskEvent`"""
+        self._callbacks.append(callback)
+
+    def poll(self):
+        """
+        Poll tasks once and return a list of :class:`.TaskEvent` since the
+        last poll. The first poll only takes a snapshot.
+        """
+        full = self.tasks is None or \
+            self._polls % self.full_poll_interval == 0
+        self._polls += 1
+        snapshot = OrderedDict()
+        per_page = self.api.num_tasks_per_page
+        for task in self.api.iter_tasks(prefetch=False):
+            snapshot[task.info_hash] = task
+            if not full and len(snapshot) % per_page == 0 and \
+                    self._is_settled(snapshot):
+                break
+        else:
+            full = True
+        if self.tasks is None:
+            self.tasks = snapshot
+            self._adapt_interval([])
+            return []
+        if not full:
+            # Older tasks are finished and unchanged
+            for info_hash, task in self.tasks.items():
+                if info_hash not in snapshot:
+                    snapshot[info_hash] = task
+        events = self._diff(self.tasks, snapshot)
+        self.tasks = snapshot
+        self._adapt_interval(events)
+        for event in events:
+            for callback in self._callbacks:
+                callback(event)
+        return events
+
+    def events(self, timeout=None):
+        """
+        Poll tasks until :meth:`stop` is called or ``timeout`` seconds have
+        elapsed, and yield :class:`.TaskEvent` objects as they are detected.
+        Nothing is polled if :meth:`stop` has already been called.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while not self._stopped.is_set():
+            try:
+                events = self.poll()
+            except (APIError, requests.RequestException) as e:
+                self.logger.warning('Failed to poll tasks: %s', e)
+                events = []
+            for event in events:
+                yield event
+            wait = self.interval
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    return
+            self._stopped.wait(wait)
+
+    def run(self, timeout=None):
+        """
+        Poll tasks and call the callbacks until :meth:`stop` is called or
+        ``timeout`` seconds have elapsed
+        """
+        for _ in self.events(timeout):
+            pass
+
+    def stop(self):
+        """Stop :meth:`events` or :meth:`run`, possibly from another
+        thread. A stopped watcher cannot be restarted."""
+        self._stopped.set()
+
+    def _is_settled(self, snapshot):
+        """
+        Whether tasks beyond ``snapshot`` can be assumed unchanged: the
+        total count is consistent, and the known tasks on the last fetched
+        page and beyond are finished and unchanged
+        """
+        new = len([h for h in snapshot if h not in self.tasks])
+        if self.api._task_count != len(self.tasks) + new:
+            return False
+        last_page = list(snapshot.values())[-self.api.num_tasks_per_page:]
+        for task in last_page:
+            previous = self.tasks.get(task.info_hash)
+            if previous is None or not _is_task_finished(task) or \
+                    previous.last_update != task.last_update:
+                return False
+        for info_hash, task in self.tasks.items():
+            if info_hash not in snapshot and not _is_task_finished(task):
+                return False
+        return True
+
+    def _diff(self, old, new):
+        events = []
+        for info_hash, task in new.items():
+            previous = old.get(info_hash)
+            if previous is None:
+                events.append(TaskEvent(TaskEvent.ADDED, task))
+                if task.is_transferred:
+                    events.append(TaskEvent(TaskEvent.TRANSFERRED, task))
+                elif task.status == -1:
+                    events.append(TaskEvent(TaskEvent.FAILED, task))
+            elif task.is_transferred and not previous.is_transferred:
+                events.append(TaskEvent(TaskEvent.TRANSFERRED, task,
+                                        previous))
+            elif task.status == -1 and previous.status != -1:
+                events.append(TaskEvent(TaskEvent.FAILED, task, previous))
+            elif (task.status, task.move, task.percent_done,
+                  task.last_update) != (previous.status, previous.move,
+                                        previous.percent_done,
+                                        previous.last_update):
+                events.append(TaskEvent(TaskEvent.PROGRESS, task, previous))
+        for info_hash, task in old.items():
+            if info_hash not in new:
+                task._deleted = True
+                events.append(TaskEvent(TaskEvent.DELETED, task))
+        return events
+
+    def _adapt_interval(self, events):
+        active = any(not _is_task_finished(t) for t in self.tasks.values())
+        if events or active:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+
+
 class Torrent(Base):
     """
     Opened torrent before becoming a task
@@ -1741,6 +3542,11 @@ class TorrentFile(Base):
         return '[%s] %s' % ('*' if self.selected else ' ', self.path)
 
 
+def _is_task_finished(task):
+    """Whether ``task`` is transferred or failed"""
+    return task.is_transferred or task.status == -1
+
+
 def _instantiate_task(api, kwargs):
     """Create a Task object from raw kwargs"""
     file_id = kwargs['file_id']
@@ -1763,6 +3569,43 @@ def _instantiate_task(api, kwargs):
     return task
 
 
+def _is_connect_error(e):
+    """Whether ``e`` is raised before the request is sent"""
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(e, requests.exceptions.ConnectionError) and e.args:
+        return isinstance(getattr(e.args[0], 'reason', None),
+                          NewConnectionError)
+    return False
+
+
+def _parse_retry_after(value):
+    """Return seconds of a ``Retry-After`` header, or None"""
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_tz(value)
+        return max(0, email.utils.mktime_tz(date) - time.time())
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def _split_path(path):
+    """Split a slash-separated remote path into its components"""
+    return [name for name in path.split('/') if name]
+
+
+def _instantiate_entry(api, kwargs):
+    """Create a File or Directory object from a raw listing entry"""
+    if 'pid' in kwargs:
+        return _instantiate_directory(api, kwargs)
+    return _instantiate_file(api, kwargs)
+
+
 def _instantiate_file(api, kwargs):
     kwargs['file_type'] = kwargs['ico']
     kwargs['date_created'] = string_to_datetime(kwargs['t'])
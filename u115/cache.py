@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, absolute_import
+
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from u115 import conf
+from u115.utils import eval_path
+
+
+class BaseCache(object):
+    """
+    Metadata cache interface
+
+    Keys are strings and values are JSON-serializable objects. Subclasses
+    implement :meth:`get`, :meth:`set`, :meth:`delete` and :meth:`clear`.
+
+    :ivar int ttl: default time-to-live in seconds of cached values
+    :ivar int max_entries: maximum number of cached values
+    """
+
+    def __init__(self, ttl=conf.CACHE_TTL, max_entries=conf.CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+    def get(self, key):
+        """Return the cached value of ``key``, or None if missing or expired"""
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        """
+        Cache ``value`` with ``key``
+
+        :param int ttl: time-to-live in seconds, defaults to
+            :attr:`BaseCache.ttl` if None
+        """
+        raise NotImplementedError
+
+    def delete(self, *keys):
+        """Invalidate ``keys``"""
+        raise NotImplementedError
+
+    def clear(self):
+        """Invalidate all cached values"""
+        raise NotImplementedError
+
+    def _expires(self, ttl):
+        return time.time() + (self.ttl if ttl is None else ttl)
+
+
+class MemoryCache(BaseCache):
+    """In-memory cache with least-recently-used eviction"""
+
+    def __init__(self, ttl=conf.CACHE_TTL, max_entries=conf.CACHE_MAX_ENTRIES):
+        super(MemoryCache, self).__init__(ttl, max_entries)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.time():
+                return None
+            # Re-insert to mark as most recently used
+            self._data[key] = item
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (self._expires(ttl), value)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteCache(BaseCache):
+    """
+    On-disk cache backed by SQLite, which persists across sessions
+
+    When the number of cached values exceeds :attr:`max_entries`, the
+    least recently stored values are evicted.
+
+    :ivar str filename: path to the database file
+    """
+
+    #: Number of :meth:`set` calls between two eviction checks
+    eviction_interval = 64
+
+    def __init__(self, filename=None, ttl=conf.CACHE_TTL,
+                 max_entries=conf.CACHE_MAX_ENTRIES):
+        """
+        :param str filename: path to the database file, use default path
+            (`~/.115cache`) if None
+        """
+        super(SQLiteCache, self).__init__(ttl, max_entries)
+        self.filename = eval_path(filename or conf.CACHE_FILENAME)
+        self._lock = threading.Lock()
+        self._num_sets = 0
+        self._conn = sqlite3.connect(self.filename, check_same_thread=False,
+                                     isolation_level=None)
+        with self._lock:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'key TEXT PRIMARY KEY, value TEXT, '
+                'expires REAL, stored REAL)')
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS cache_stored ON cache (stored)')
+            self._evict()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value, expires FROM cache WHERE key = ?',
+                (key,)).fetchone()
+            if row is None:
+                return None
+            value, expires = row
+            if expires < time.time():
+                self._conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+                return None
+        return json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        value = json.dumps(value)
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+                (key, value, self._expires(ttl), time.time()))
+            self._num_sets += 1
+            if self._num_sets % self.eviction_interval == 0:
+                self._evict()
+
+    def delete(self, *keys):
+        with self._lock:
+            self._conn.executemany('DELETE FROM cache WHERE key = ?',
+                                   [(key,) for key in keys])
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM cache')
+
+    def close(self):
+        """Close the database connection"""
+        with self._lock:
+            self._conn.close()
+
+    def _evict(self):
+        """Remove expired values and values beyond :attr:`max_entries`"""
+        self._conn.execute('DELETE FROM cache WHERE expires < ?',
+                           (time.time(),))
+        count = self._conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute(
+                'DELETE FROM cache WHERE key IN ('
+                'SELECT key FROM cache ORDER BY stored LIMIT ?)',
+                (count - self.max_entries,))
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(
+                'SELECT COUNT(*) FROM cache').fetchone()[0]
+
+
+class PathCache(object):
+    """
+    In-memory trie of resolved remote directory paths
+
+    Each node is a directory keyed by its cid, and holds the cids of its
+    known subdirectories by name. Nodes are added from directory listings,
+    and from the ancestor path that every listing returns, so that a path
+    can be resolved down to its deepest known directory without requests.
+    Only directories are cached; files are always listed.
+    """
+
+    root_cid = '0'
+
+    def __init__(self):
+        self._nodes = {}
+        self._children = {self.root_cid: {}}
+        self._lock = threading.Lock()
+
+    def add(self, cid, name, pid):
+        """Add or update directory ``cid`` named ``name`` in ``pid``"""
+        cid, pid = str(cid), str(pid)
+        if cid == self.root_cid or cid == pid:
+            return
+        with self._lock:
+            node = self._nodes.get(cid)
+            if node is not None:
+                old_name, old_pid = node
+                siblings = self._children.get(old_pid, {})
+                if siblings.get(old_name) == cid:
+                    del siblings[old_name]
+            self._nodes[cid] = (name, pid)
+            self._children.setdefault(pid, {})[name] = cid
+            self._children.setdefault(cid, {})
+
+    def resolve(self, names):
+        """
+        Resolve a list of path components from the root
+
+        :return: a tuple ``(cid, n)`` where ``cid`` is the deepest known
+            directory and ``n`` is the number of resolved components
+        """
+        cid = self.root_cid
+        with self._lock:
+            for n, name in enumerate(names):
+                child = self._children.get(cid, {}).get(name)
+                if child is None:
+                    return cid, n
+                cid = child
+        return cid, len(names)
+
+    def get(self, cid):
+        """Return ``(name, pid)`` of directory ``cid``, or None"""
+        with self._lock:
+            return self._nodes.get(str(cid))
+
+    def discard(self, cid):
+        """Remove directory ``cid`` and its known subdirectories"""
+        with self._lock:
+            stack = [str(cid)]
+            while stack:
+                cid = stack.pop()
+                node = self._nodes.pop(cid, None)
+                if node is not None:
+                    name, pid = node
+                    siblings = self._children.get(pid, {})
+                    if siblings.get(name) == cid:
+                        del siblings[name]
+                stack.extend(self._children.pop(cid, {}).values())
+            self._children.setdefault(self.root_cid, {})
+
+    def clear(self):
+        with self._lock:
+            self._nodes.clear()
+            self._children = {self.root_cid: {}}
+
+    def __len__(self):
+        return len(self._nodes)
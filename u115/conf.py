@@ -16,6 +16,9 @@ PROJECT_CREDENTIALS = pjoin(PROJECT_PATH, '.credentials')
 USER_CREDENTIALS = pjoin(user_dir, '.115')
 CREDENTIALS = None
 COOKIES_FILENAME = pjoin(user_dir, '.115cookies')
+CACHE_FILENAME = pjoin(user_dir, '.115cache')
+CACHE_TTL = 600
+CACHE_MAX_ENTRIES = 100000
 
 LOGGING_API_LOGGER = 'API'
 LOGGING_FORMAT = "%(levelname)s:%(name)s:%(funcName)s: %(message)s"
@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, absolute_import
+
+import hashlib
+import humanize
+import json
+import logging
+import os
+import requests
+import threading
+import time
+from contextlib import contextmanager
+from six.moves.urllib.parse import urlparse
+from u115 import conf
+from u115.utils import STREAM, threaded_map, hash_file, atomic_write_json
+
+
+class SegmentedDownloader(object):
+    """
+    Download a file over multiple connections with HTTP range requests
+
+    The file is split into byte ranges (segments) that are fetched in
+    parallel and written into a preallocated file at their offsets. Progress
+    of each segment is saved to a sidecar state file (``path`` +
+    :attr:`state_suffix`), so that an interrupted download resumes per
+    segment.
+
+    If the server ignores range requests (200 instead of 206), the file is
+    downloaded with a single request from its first byte, without saving
+    resumable state.
+
+    If ``sha1`` is given, the SHA1 of the file is computed incrementally:
+    bytes of the first segment are hashed as they are written, and only the
+    bytes that were not streamed through the hasher (those resumed from a
+    previous run and those of other segments) are read back from disk.
+
+    :ivar str url: download URL
+    :ivar str path: local path of the file
+    :ivar int size: file size in bytes
+    :ivar int connections: number of parallel connections
+    :cvar int chunk_size: size of chunks read from the response stream
+    :cvar int min_segment_size: minimum size of a segment
+    :cvar int max_retries: maximum number of retries of a segment upon
+        connection errors
+    :cvar int max_url_refreshes: maximum number of times the URL is
+        refreshed upon expired links
+    :cvar str state_suffix: suffix of the sidecar state file
+    """
+
+    chunk_size = 64 * 1024
+    min_segment_size = 1024 * 1024
+    max_retries = 5
+    max_url_refreshes = 3
+    state_suffix = '.115part'
+    state_save_interval = 1.0
+    progress_interval = 0.5
+
+    def __init__(self, url, path, size, session=None, connections=4,
+                 show_progress=True, resume=True, auto_retry=True,
+                 rate_limiter=None, host_limiter=None,
+                 progress_callback=None, url_refresher=None, sha1=None):
+        """
+        :param str url: download URL
+        :param str path: local path of the file
+        :param int size: file size in bytes
+        :param session: :class:`requests.Session` object that carries
+            cookies, a new session is created if None
+        :param int connections: number of parallel connections
+        :param bool show_progress: whether to show download progress
+        :param bool resume: whether to resume from the sidecar state file,
+            or to keep an existing file that matches ``sha1``
+        :param bool auto_retry: whether to retry a segment automatically
+            upon connection errors
+        :param rate_limiter: :class:`u115.utils.RateLimiter` object that
+            limits bytes per second, possibly shared by multiple downloads
+        :param host_limiter: :class:`.HostLimiter` object that limits
+            connections per host, possibly shared by multiple downloads
+        :param function progress_callback: a function called with the
+            number of bytes every time a chunk is written
+        :param function url_refresher: a function that returns a new URL
+            when the server rejects the current one (e.g. 403 on an expired
+            link)
+        :param str sha1: expected SHA1 hex digest of the file. If not None,
+            the download is verified and :class:`.ChecksumError` is raised
+            on mismatch
+        """
+        self.url = url
+        self.path = path
+        self.size = size
+        self.session = session or requests.Session()
+        self.connections = max(1, connections)
+        self.show_progress = show_progress
+        self.resume = resume
+        self.auto_retry = auto_retry
+        self.rate_limiter = rate_limiter
+        self.host_limiter = host_limiter or HostLimiter()
+        self.progress_callback = progress_callback
+        self.url_refresher = url_refresher
+        self.sha1 = sha1
+        self.state_path = path + self.state_suffix
+        self.segments = None
+        self.logger = logging.getLogger(conf.LOGGING_API_LOGGER)
+        self._lock = threading.Lock()
+        self._refreshes = 0
+        self._hasher = hashlib.sha1() if sha1 is not None else None
+        self._hashed = 0
+        self._downloaded = 0
+        self._start_time = None
+        self._last_saved = 0
+        self._last_reported = 0
+        # Open file handles of segments in progress, flushed before the
+        # state is saved
+        self._files = set()
+        # Whether the server honours range requests
+        self._ranged = True
+
+    def start(self):
+        """Start or resume the download and block until it finishes"""
+        if not self._load_state():
+            if (self.resume and self._hasher is not None and
+                    not os.path.exists(self.state_path) and
+                    os.path.exists(self.path) and
+                    os.path.getsize(self.path) == self.size):
+                # Finished in a previous run, unless the file of the same
+                # size has other content
+                try:
+                    self._verify()
+                    return
+                except ChecksumError:
+                    self.logger.info('Downloading %s again', self.path)
+                    self._hasher = hashlib.sha1()
+                    self._hashed = 0
+            self._init_state()
+        self._start_time = time.time()
+        if self._hasher is not None:
+            # Hash the resumed part of the first segment, which is then
+            # hashed as it is written
+            self._hash_until(self.segments[0][2])
+        pending = [s for s in self.segments if s[2] < s[1] - s[0]]
+        threaded_map(self._download_segment, pending, self.connections)
+        if not self._ranged and len(self.segments) > 1:
+            self.logger.warning('Range requests are not supported, '
+                                'downloading %s in one piece', self.path)
+            self.segments = [[0, self.size, 0]]
+            self._download_segment(self.segments[0])
+        if self.show_progress:
+            self._report(force=True)
+            print(file=STREAM)
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+        self._verify()
+
+    def _hash_until(self, end):
+        """Hash bytes on disk from the hashed offset to ``end``"""
+        if end > self._hashed:
+            hash_file(self._hasher, self.path, self._hashed, end)
+            self._hashed = end
+
+    def _verify(self):
+        if self._hasher is None:
+            return
+        self._hash_until(self.size)
+        digest = self._hasher.hexdigest()
+        if digest.upper() != self.sha1.upper():
+            msg = 'SHA1 of %s is %s, expected %s.' % (
+                self.path, digest, self.sha1)
+            raise ChecksumError(msg)
+
+    @property
+    def downloaded(self):
+        """Number of bytes downloaded, including resumed bytes"""
+        return sum(s[2] for s in self.segments)
+
+    def _split(self):
+        """Split the file into segments of ``[start, end, done]``"""
+        n = min(self.connections,
+                max(1, self.size // self.min_segment_size))
+        step = self.size // n
+        bounds = [i * step for i in range(n)] + [self.size]
+        return [[bounds[i], bounds[i + 1], 0] for i in range(n)]
+
+    def _init_state(self):
+        self.segments = self._split()
+        with open(self.path, 'wb') as f:
+            f.truncate(self.size)
+        self._save_state(force=True)
+
+    def _load_state(self):
+        """Load segments from the sidecar state file, if it is usable"""
+        if not self.resume or not os.path.exists(self.state_path):
+            return False
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except ValueError:
+            return False
+        if state.get('size') != self.size:
+            return False
+        self.segments = state['segments']
+        return True
+
+    def _save_state(self, force=False):
+        if not self._ranged:
+            # Progress cannot be resumed without range requests
+            return
+        now = time.time()
+        if not force and now - self._last_saved < self.state_save_interval:
+            return
+        self._last_saved = now
+        # Progress of a segment must not be recorded before its bytes leave
+        # the write buffer, or a resumed download would skip them
+        for f in self._files:
+            f.flush()
+        state = {'size': self.size, 'segments': self.segments}
+        atomic_write_json(state, self.state_path)
+
+    def _download_segment(self, segment):
+        retries = 0
+        while True:
+            url = self.url
+            try:
+                self._fetch_segment(segment)
+                return
+            except requests.HTTPError as e:
+                status = e.response.status_code
+                if status not in (403, 404, 410) or \
+                        not self._refresh_url(url):
+                    raise
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if not self.auto_retry or retries >= self.max_retries:
+                    raise
+                retries += 1
+                self.logger.warning('Retrying segment %d-%d: %s',
+                                    segment[0], segment[1], e)
+                time.sleep(min(2 ** retries, 30))
+
+    def _refresh_url(self, stale_url):
+        """
+        Replace an expired URL, unless another segment has already done so
+        :return: whether a new URL is available
+        """
+        with self._lock:
+            if self.url != stale_url:
+                return True
+            if (self.url_refresher is None or
+                    self._refreshes >= self.max_url_refreshes):
+                return False
+            self._refreshes += 1
+            self.logger.info('Refreshing download URL of %s', self.path)
+            self.url = self.url_refresher()
+            return True
+
+    def _fetch_segment(self, segment):
+        start, end, done = segment
+        if done >= end - start:
+            return
+        headers = {'Range': 'bytes=%d-%d' % (start + done, end - 1)}
+        with self.host_limiter.limit(self.url):
+            r = self.session.get(self.url, headers=headers, stream=True)
+            try:
+                r.raise_for_status()
+                if r.status_code != 206:
+                    if not self._restart(segment):
+                        # Fall back to a single request after the other
+                        # segments give up as well
+                        return
+                    done = 0
+                with open(self.path, 'r+b') as f:
+                    f.seek(start + done)
+                    with self._lock:
+                        self._files.add(f)
+                    try:
+                        for chunk in r.iter_content(self.chunk_size):
+                            if not chunk:
+                                continue
+                            chunk = chunk[:end - start - segment[2]]
+                            if self.rate_limiter is not None:
+                                self.rate_limiter.consume(len(chunk))
+                            f.write(chunk)
+                            self._update(segment, chunk)
+                            if segment[2] >= end - start:
+                                break
+                    finally:
+                        with self._lock:
+                            self._files.discard(f)
+            finally:
+                r.close()
+        with self._lock:
+            self._save_state(force=True)
+        if segment[2] < end - start:
+            raise requests.ConnectionError('Segment transfer closed.')
+
+    def _restart(self, segment):
+        """
+        Prepare ``segment`` to receive the whole file, once the server has
+        ignored a range request
+
+        :return: False if the file has other segments, which cannot be
+            downloaded without range requests
+        """
+        with self._lock:
+            self._ranged = False
+            if len(self.segments) > 1:
+                return False
+            segment[2] = 0
+            if self._hasher is not None:
+                self._hasher = hashlib.sha1()
+                self._hashed = 0
+            if os.path.exists(self.state_path):
+                os.remove(self.state_path)
+            return True
+
+    def _update(self, segment, chunk):
+        """Record ``chunk`` written to ``segment``"""
+        n = len(chunk)
+        with self._lock:
+            if self._hasher is not None and \
+                    segment[0] + segment[2] == self._hashed:
+                # The chunk is contiguous with the hashed bytes
+                self._hasher.update(chunk)
+                self._hashed += n
+            segment[2] += n
+            self._downloaded += n
+            self._save_state()
+        if self.progress_callback is not None:
+            self.progress_callback(n)
+        self._report()
+
+    def _report(self, force=False):
+        if not self.show_progress:
+            return
+        now = time.time()
+        if not force and now - self._last_reported < self.progress_interval:
+            return
+        self._last_reported = now
+        downloaded = self.downloaded
+        percent = 100 * downloaded // self.size if self.size else 100
+        elapsed = max(now - self._start_time, 1e-6)
+        rate = self._downloaded / elapsed
+        msg = '\r%5d%%  %12s  %12s/s' % (
+            percent, humanize.naturalsize(downloaded, binary=True),
+            humanize.naturalsize(rate, binary=True))
+        STREAM.write(msg)
+        STREAM.flush()
+
+
+class HostLimiter(object):
+    """
+    Limit the number of concurrent connections per host
+
+    :ivar int max_connections: maximum connections per host, no limit if
+        None
+    """
+
+    def __init__(self, max_connections=None):
+        self.max_connections = max_connections
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def limit(self, url):
+        """Context manager that holds a connection slot of the host of
+        ``url``"""
+        if self.max_connections is None:
+            yield
+            return
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = \
+                    threading.BoundedSemaphore(self.max_connections)
+            semaphore = self._semaphores[host]
+        with semaphore:
+            yield
+
+
+class DownloadError(Exception):
+    """Download error"""
+    pass
+
+
+class ChecksumError(DownloadError):
+    """Downloaded file does not match the expected checksum"""
+    pass
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, absolute_import
+
+import logging
+import os
+import requests
+import threading
+from six.moves import queue
+from u115 import conf
+from u115.api import File, Directory, APIError
+from u115.downloader import SegmentedDownloader, HostLimiter
+from u115.utils import (STREAM, RateLimiter, TransferStats, eval_path,
+                        mkdir_p)
+
+
+class DownloadJob(object):
+    """
+    A file queued in :class:`.DownloadManager`
+
+    :ivar file: :class:`u115.File` object to download
+    :ivar str path: local file path
+    :ivar tag: arbitrary object attached by the caller
+    :ivar bool done: whether the job is finished (successfully or not)
+    :ivar error: exception raised by the download, if failed
+    """
+
+    def __init__(self, file, path, tag=None):
+        self.file = file
+        self.path = path
+        self.tag = tag
+        self.done = False
+        self.error = None
+
+    @property
+    def ok(self):
+        """Whether the download is finished successfully"""
+        return self.done and self.error is None
+
+    def __repr__(self):
+        return '<DownloadJob: %s>' % self.path
+
+
+class DownloadManager(object):
+    """
+    Download many files concurrently
+
+    Files are downloaded by a bounded number of worker threads, sharing a
+    global bandwidth limit and a per-host connection limit. Jobs can be
+    added before or while the manager is running.
+
+    :ivar api: associated :class:`u115.API` object
+    :ivar int max_workers: number of files downloaded concurrently
+    :ivar int connections: number of connections per file
+    :ivar stats: :class:`u115.utils.TransferStats` object of aggregate
+        throughput
+    :ivar list jobs: all added :class:`.DownloadJob` objects
+    :cvar list pool_endpoints: endpoints of :class:`u115.api.RequestHandler`
+        whose connection pools are grown to hold the connections of all
+        workers, i.e. download servers and download URL APIs
+    """
+
+    pool_endpoints = ['default', 'web.api', 'proapi']
+
+    def __init__(self, api, max_workers=4, connections=1, max_rate=None,
+                 max_host_connections=None, show_progress=True, resume=True,
+                 proapi=False, verify=False, on_done=None):
+        """
+        :param api: :class:`u115.API` object
+        :param int max_workers: number of files downloaded concurrently
+        :param int connections: number of connections per file
+        :param int max_rate: global bandwidth limit in bytes per second, no
+            limit if None
+        :param int max_host_connections: maximum connections per host, no
+            limit if None
+        :param bool show_progress: whether to show aggregate progress
+        :param bool resume: whether to resume unfinished downloads
+        :param bool proapi: whether to use pro API for download URLs
+        :param bool verify: whether to verify downloaded files against their
+            SHA1 on the server
+        :param function on_done: a function called with each
+            :class:`.DownloadJob` when it is finished
+        """
+        self.api = api
+        self.max_workers = max_workers
+        self.connections = connections
+        # Connections beyond the pool size are not kept alive
+        api.http.resize_pools(max_workers * connections, self.pool_endpoints)
+        self.show_progress = show_progress
+        self.resume = resume
+        self.proapi = proapi
+        self.verify = verify
+        self.on_done = on_done
+        self.rate_limiter = RateLimiter(max_rate) if max_rate else None
+        self.host_limiter = HostLimiter(max_host_connections)
+        self.stats = TransferStats()
+        self.jobs = []
+        self.logger = logging.getLogger(conf.LOGGING_API_LOGGER)
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def add(self, entry, path=None, flat=False, tag=None):
+        """
+        Add a file or a whole directory to download
+
+        :param entry: :class:`u115.File` or :class:`u115.Directory` object
+        :param str path: local directory (or file path for a file) to
+            download to, defaults to the current working directory
+        :param bool flat: whether to flatten the directory structure
+        :param tag: arbitrary object attached to the added jobs
+        :return: a list of added :class:`.DownloadJob` objects
+        """
+        if isinstance(entry, File):
+            return [self._add_file(entry, path, tag)]
+        elif isinstance(entry, Directory):
+            jobs = []
+            root = eval_path(path or os.getcwd())
+            for dirpath, dirs, files in self.api.walk(entry):
+                dpath = root
+                if not flat:
+                    dpath = os.path.join(root, *dirpath.split('/'))
+                mkdir_p(dpath)
+                for f in files:
+                    jobs.append(self._add_file(f, dpath, tag))
+            return jobs
+        raise APIError('Invalid BaseFile instance for an entry.')
+
+    def start(self):
+        """Start worker threads"""
+        with self._lock:
+            while len(self._threads) < self.max_workers:
+                t = threading.Thread(target=self._work)
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+
+    def join(self):
+        """Block until all added jobs are finished"""
+        self._queue.join()
+        if self.show_progress:
+            self.stats.report(len(self.jobs), force=True)
+            print(file=STREAM)
+
+    def close(self):
+        """Stop worker threads after they finish the remaining jobs"""
+        with self._lock:
+            for _ in self._threads:
+                self._queue.put(None)
+            for t in self._threads:
+                t.join()
+            self._threads = []
+
+    def run(self):
+        """
+        Download all added jobs and block until they are finished. Download
+        URLs of the jobs are resolved concurrently before downloads start.
+
+        :return: :attr:`.DownloadManager.stats`
+        """
+        pending = [job.file for job in self.jobs if not job.done]
+        try:
+            self.api.prefetch_download_urls(pending, self.proapi,
+                                            self.max_workers)
+        except (APIError, requests.RequestException) as e:
+            # URLs are requested again by each job
+            self.logger.warning('Failed to prefetch download URLs: %s', e)
+        self.start()
+        self.join()
+        self.close()
+        return self.stats
+
+    @property
+    def failed_jobs(self):
+        """List of failed :class:`.DownloadJob` objects"""
+        return [job for job in self.jobs if job.done and not job.ok]
+
+    def _add_file(self, f, path, tag):
+        job = DownloadJob(f, self.api._get_download_path(f, path), tag)
+        with self._lock:
+            self.jobs.append(job)
+        self._queue.put(job)
+        return job
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                self._download(job)
+            finally:
+                self._queue.task_done()
+
+    def _download(self, job):
+        try:
+            url = job.file.get_download_url(self.proapi)
+            downloader = SegmentedDownloader(
+                url, job.path, job.file.size, session=self.api.http.session,
+                connections=self.connections, show_progress=False,
+                resume=self.resume, rate_limiter=self.rate_limiter,
+                host_limiter=self.host_limiter,
+                progress_callback=self._progress,
+                url_refresher=lambda: job.file.get_download_url(
+                    self.proapi, refresh=True),
+                sha1=job.file.sha if self.verify else None)
+            downloader.start()
+        except Exception as e:
+            self.logger.error('Failed to download %s: %s', job.path, e)
+            job.error = e
+        job.done = True
+        self.stats.add_file(job.ok)
+        if self.on_done is not None:
+            self.on_done(job)
+
+    def _progress(self, n):
+        self.stats.add_bytes(n)
+        if self.show_progress:
+            self.stats.report(len(self.jobs))
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, absolute_import
+
+import binascii
+import os
+import six
+from u115.utils import utf8_encode
+
+
+class MultipartEncoder(object):
+    """
+    Streaming ``multipart/form-data`` encoder
+
+    Unlike the ``files`` argument of Requests, which builds the whole body
+    in memory, the encoder is a file-like object that reads file fields from
+    disk in fixed-size chunks as the body is sent, so that memory usage does
+    not grow with file size. It is passed as ``data`` of a request, along
+    with :attr:`content_type` as the ``Content-Type`` header.
+
+    If the sizes of all file fields are known (i.e. they are seekable), the
+    body is sent with a ``Content-Length``; otherwise it is sent chunked.
+
+    :ivar str boundary: multipart boundary
+    :ivar str content_type: value of the ``Content-Type`` header
+    :ivar int len: length of the body in bytes, or None if unknown
+    :cvar int chunk_size: size of chunks read from files
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, fields, boundary=None, callback=None):
+        """
+        :param list fields: a list of ``(name, value)`` tuples, where
+            ``value`` is either a string, or a ``(filename, fileobj,
+            content_type)`` tuple for a file field
+        :param str boundary: multipart boundary, a random one is generated
+            if None
+        :param function callback: a function called with the number of bytes
+            read so far and :attr:`len` every time a chunk of the body is
+            read
+        """
+        self.boundary = boundary or binascii.b2a_hex(
+            os.urandom(16)).decode('ascii')
+        self.content_type = 'multipart/form-data; boundary=%s' % \
+            self.boundary
+        self.callback = callback
+        self.bytes_read = 0
+        self._parts = self._encode(fields)
+        self.len = self._total_length()
+        self._index = 0
+        self._buffer = bytearray(self.chunk_size)
+
+    def _encode(self, fields):
+        """Split the body into a list of byte strings and file objects"""
+        boundary = self.boundary.encode('ascii')
+        parts = []
+        for name, value in fields:
+            header = b'--' + boundary + b'\r\n'
+            if isinstance(value, tuple):
+                filename, fileobj, content_type = value
+                header += (
+                    b'Content-Disposition: form-data; name="' +
+                    utf8_encode(name) + b'"; filename="' +
+                    utf8_encode(filename) + b'"\r\n' +
+                    b'Content-Type: ' +
+                    utf8_encode(content_type or 'application/octet-stream') +
+                    b'\r\n\r\n')
+                parts.extend([header, fileobj, b'\r\n'])
+            else:
+                header += (
+                    b'Content-Disposition: form-data; name="' +
+                    utf8_encode(name) + b'"\r\n\r\n' +
+                    utf8_encode(value) + b'\r\n')
+                parts.append(header)
+        parts.append(b'--' + boundary + b'--\r\n')
+        # Merge adjacent byte strings
+        merged = []
+        for part in parts:
+            if isinstance(part, bytes) and merged and \
+                    isinstance(merged[-1], bytes):
+                merged[-1] += part
+            else:
+                merged.append(part)
+        return merged
+
+    def _total_length(self):
+        total = 0
+        for part in self._parts:
+            if isinstance(part, bytes):
+                total += len(part)
+                continue
+            try:
+                pos = part.tell()
+                part.seek(0, os.SEEK_END)
+                end = part.tell()
+                part.seek(pos)
+            except (AttributeError, IOError, OSError, ValueError):
+                return None
+            total += end - pos
+        return total
+
+    def read(self, size=-1):
+        """Read at most ``size`` bytes of the body, or all if negative"""
+        if size is None or size < 0:
+            chunks = []
+            while True:
+                chunk = self.read(self.chunk_size)
+                if not chunk:
+                    return b''.join(chunks)
+                chunks.append(chunk)
+        chunks = []
+        while size > 0 and self._index < len(self._parts):
+            chunk = self._read_part(size)
+            if not chunk:
+                self._index += 1
+                continue
+            chunks.append(chunk)
+            size -= len(chunk)
+        data = b''.join(chunks)
+        if data:
+            self.bytes_read += len(data)
+            if self.callback is not None:
+                self.callback(self.bytes_read, self.len)
+        return data
+
+    def _read_part(self, size):
+        part = self._parts[self._index]
+        if isinstance(part, bytes):
+            chunk = part[:size]
+            self._parts[self._index] = part[size:]
+            return chunk
+        size = min(size, self.chunk_size)
+        if hasattr(part, 'readinto'):
+            # Read into the reusable buffer instead of allocating one per
+            # chunk
+            view = memoryview(self._buffer)[:size]
+            n = part.readinto(view)
+            return view[:n or 0].tobytes()
+        chunk = part.read(size)
+        if isinstance(chunk, six.text_type):
+            chunk = chunk.encode('utf-8')
+        return chunk
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                return
+            yield chunk
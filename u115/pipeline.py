@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, absolute_import
+
+import json
+import logging
+import os
+import threading
+from u115 import conf
+from u115.api import File, TaskEvent, APIError
+from u115.manager import DownloadManager
+from u115.utils import eval_path, mkdir_p, atomic_write_json
+
+
+class Journal(object):
+    """
+    Persistent journal of tasks handled by :class:`.TaskFollower`, stored
+    as JSON
+
+    Each entry is keyed by the info hash of a task, and records its
+    ``name``, ``status`` (`pending` while the task is not transferred yet,
+    then `queued`, `done` or `failed`), and the numbers of ``files``,
+    ``done`` and ``failed`` files.
+
+    :ivar str filename: path to the journal file
+    :ivar dict tasks: journal entries
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.tasks = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.tasks = json.load(f)
+
+    def save(self):
+        atomic_write_json(self.tasks, self.filename)
+
+
+class TaskFollower(object):
+    """
+    Download the contents of tasks as soon as they are transferred
+
+    Task events are consumed from a :class:`u115.TaskWatcher`, and the
+    directory or file of each transferred task is added to a
+    :class:`u115.manager.DownloadManager`. Progress is recorded in a
+    :class:`.Journal`, along with tasks that are not transferred yet, so
+    that tasks transferred while the follower is stopped, or not finished
+    downloading, are queued after a restart. Partially downloaded files are
+    resumed.
+
+    :ivar api: associated :class:`u115.API` object
+    :ivar str path: local directory to download to
+    :ivar manager: :class:`u115.manager.DownloadManager` object
+    :ivar watcher: :class:`u115.TaskWatcher` object
+    :ivar journal: :class:`.Journal` object
+    :cvar int max_resolve_entries: maximum number of newest entries of the
+        downloads directory searched for the file of a file task
+    """
+
+    journal_name = '.115journal'
+    max_resolve_entries = 1000
+
+    def __init__(self, api, path=None, manager=None, journal=None,
+                 **kwargs):
+        """
+        :param api: :class:`u115.API` object
+        :param str path: local directory, defaults to the current working
+            directory
+        :param manager: :class:`u115.manager.DownloadManager` object, a
+            default one is created if None
+        :param str journal: path to the journal file, defaults to
+            `.115journal` in ``path``
+        :param kwargs: arguments of :class:`u115.TaskWatcher`
+        """
+        self.api = api
+        self.path = eval_path(path or os.getcwd())
+        self.manager = manager or DownloadManager(api)
+        self.watcher = api.watch_tasks(**kwargs)
+        mkdir_p(self.path)
+        self.journal = Journal(
+            eval_path(journal or os.path.join(self.path, self.journal_name)))
+        self.logger = logging.getLogger(conf.LOGGING_API_LOGGER)
+        self._lock = threading.Lock()
+        self._on_done = self.manager.on_done
+        self.manager.on_done = self._job_done
+
+    def run(self, timeout=None):
+        """
+        Follow tasks until :meth:`stop` is called or ``timeout`` seconds
+        have elapsed, then wait for the queued downloads to finish
+        """
+        self.manager.start()
+        self.watcher.poll()
+        self._resume()
+        for task in list(self.watcher.tasks.values()):
+            self._watch(task)
+        for event in self.watcher.events(timeout):
+            if event.type == TaskEvent.TRANSFERRED:
+                self.follow(event.task)
+            elif event.type == TaskEvent.FAILED:
+                self.logger.warning('Task failed: %s', event.task.name)
+                self._update_pending(event.task, 'failed')
+            elif event.type == TaskEvent.DELETED:
+                self._update_pending(event.task, None)
+            else:
+                self._watch(event.task)
+        self.manager.join()
+        self.manager.close()
+
+    def stop(self):
+        """Stop following tasks, possibly from another thread"""
+        self.watcher.stop()
+
+    def follow(self, task):
+        """Add the contents of a transferred ``task`` to download"""
+        info_hash = task.info_hash
+        with self._lock:
+            self.journal.tasks[info_hash] = {
+                'name': task.name, 'status': 'queued', 'files': None,
+                'done': 0, 'failed': 0}
+            self.journal.save()
+        try:
+            jobs = self.manager.add(self._resolve(task), self.path,
+                                    tag=info_hash)
+        except APIError as e:
+            self.logger.error('Failed to resolve task %s: %s', task.name, e)
+            jobs = None
+        with self._lock:
+            entry = self.journal.tasks[info_hash]
+            if jobs is None:
+                entry['status'] = 'failed'
+            else:
+                entry['files'] = len(jobs)
+                self._update_status(entry)
+            self.journal.save()
+
+    def _watch(self, task):
+        """Record a task that is not transferred yet as pending"""
+        if task.is_transferred or task.status == -1:
+            return
+        with self._lock:
+            if task.info_hash not in self.journal.tasks:
+                self.journal.tasks[task.info_hash] = {
+                    'name': task.name, 'status': 'pending', 'files': None,
+                    'done': 0, 'failed': 0}
+                self.journal.save()
+
+    def _update_pending(self, task, status):
+        """Set the status of a pending task, or remove it if None"""
+        with self._lock:
+            entry = self.journal.tasks.get(task.info_hash)
+            if entry is None or entry['status'] != 'pending':
+                return
+            if status is None:
+                del self.journal.tasks[task.info_hash]
+            else:
+                entry['status'] = status
+            self.journal.save()
+
+    def _resume(self):
+        """
+        Queue transferred tasks that were pending or not finished in the
+        journal
+        """
+        for info_hash, entry in list(self.journal.tasks.items()):
+            if entry['status'] == 'done':
+                continue
+            task = self.watcher.tasks.get(info_hash)
+            if task is not None and task.is_transferred:
+                self.logger.info('Resuming task %s', task.name)
+                self.follow(task)
+
+    def _resolve(self, task):
+        """Return the directory or file of ``task``"""
+        if task.is_directory:
+            return task.directory
+        # A file task only refers to the downloads directory, so look for the
+        # newest file with its name, which is usually on the first page
+        entries = self.api.downloads_directory.iter_entries(
+            order='user_ptime', asc=False, prefetch=False)
+        for i, entry in enumerate(entries):
+            if i >= self.max_resolve_entries:
+                break
+            if isinstance(entry, File) and entry.name == task.name:
+                return entry
+        raise APIError('No file associated with this task.')
+
+    def _job_done(self, job):
+        with self._lock:
+            entry = self.journal.tasks.get(job.tag)
+            if entry is not None:
+                entry['done' if job.ok else 'failed'] += 1
+                self._update_status(entry)
+                self.journal.save()
+        if self._on_done is not None:
+            self._on_done(job)
+
+    def _update_status(self, entry):
+        if entry['files'] is None:
+            # Jobs are still being added
+            return
+        if entry['done'] + entry['failed'] >= entry['files']:
+            entry['status'] = 'failed' if entry['failed'] else 'done'
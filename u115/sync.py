@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, absolute_import
+
+import json
+import os
+from u115.downloader import SegmentedDownloader
+from u115.manager import DownloadManager
+from u115.utils import (eval_path, mkdir_p, sha1_file, atomic_write_json,
+                        replace_file)
+
+
+class Manifest(object):
+    """
+    Local manifest of synchronized files, stored as JSON in the local root
+
+    Each entry is keyed by the slash-separated path relative to the root,
+    and records the remote ``fid``, ``sha``, ``size`` and ``date_created``
+    along with the local ``mtime`` at the time of synchronization.
+
+    :ivar str filename: path to the manifest file
+    :ivar dict entries: manifest entries
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.entries = json.load(f)
+
+    def get(self, relpath):
+        return self.entries.get(relpath)
+
+    def set(self, relpath, f, path):
+        """Record remote file ``f`` synchronized to local ``path``"""
+        self.entries[relpath] = {
+            'fid': f.fid,
+            'sha': f.sha,
+            'size': f.size,
+            'date_created': str(f.date_created),
+            'mtime': os.path.getmtime(path),
+        }
+
+    def remove(self, relpath):
+        self.entries.pop(relpath, None)
+
+    def save(self):
+        atomic_write_json(self.entries, self.filename)
+
+    def is_unchanged(self, relpath, f, path):
+        """
+        Whether the local file at ``path`` is identical to remote file ``f``
+        according to the manifest, without reading the local file
+        """
+        entry = self.get(relpath)
+        if entry is None:
+            return False
+        return (entry['sha'] == f.sha and entry['size'] == f.size and
+                entry['date_created'] == str(f.date_created) and
+                os.path.getsize(path) == f.size and
+                os.path.getmtime(path) == entry['mtime'])
+
+
+class SyncReport(object):
+    """
+    Result of a synchronization, each attribute being a list of local
+    paths relative to the root
+
+    :ivar list new: files that did not exist locally
+    :ivar list changed: files that differ from the remote ones
+    :ivar list unchanged: files that are identical to the remote ones
+    :ivar list extras: local files that do not exist remotely
+    :ivar list deleted: extras that are deleted
+    :ivar list failed: files that failed to download
+    """
+
+    def __init__(self):
+        self.new = []
+        self.changed = []
+        self.unchanged = []
+        self.extras = []
+        self.deleted = []
+        self.failed = []
+
+    def to_dict(self):
+        return dict((k, getattr(self, k)) for k in (
+            'new', 'changed', 'unchanged', 'extras', 'deleted', 'failed'))
+
+    def __str__(self):
+        return ('%d new, %d changed, %d unchanged, %d extras, %d deleted, '
+                '%d failed' % (len(self.new), len(self.changed),
+                               len(self.unchanged), len(self.extras),
+                               len(self.deleted), len(self.failed)))
+
+
+class SyncDown(object):
+    """
+    Incrementally mirror a remote directory to a local directory
+
+    The remote tree is compared with the local tree and the manifest, and
+    only new or changed files are downloaded. A local file is considered
+    unchanged without being hashed if its size and modification time match
+    the manifest, and the manifest matches the remote size, SHA1 and
+    creation date. Local files without a manifest entry are hashed once and
+    recorded.
+
+    Files are downloaded to a temporary sibling (with
+    :attr:`temp_suffix`), which replaces the local file only when the
+    download succeeds.
+
+    :ivar api: associated :class:`u115.API` object
+    :ivar directory: remote :class:`u115.Directory` to mirror
+    :ivar str path: local directory that mirrors the contents of
+        ``directory``
+    :ivar manifest: :class:`.Manifest` object
+    :ivar manager: :class:`u115.manager.DownloadManager` object that
+        downloads files
+    """
+
+    manifest_name = '.115manifest'
+    temp_suffix = '.115tmp'
+
+    def __init__(self, api, directory, path, delete=False, dry_run=False,
+                 manager=None):
+        """
+        :param api: :class:`u115.API` object
+        :param directory: remote :class:`u115.Directory` to mirror
+        :param str path: local directory
+        :param bool delete: whether to delete local files that do not exist
+            remotely
+        :param bool dry_run: whether to only report without downloading or
+            deleting
+        :param manager: :class:`u115.manager.DownloadManager` object, a
+            default one is created if None
+        """
+        self.api = api
+        self.directory = directory
+        self.path = eval_path(path)
+        self.delete = delete
+        self.dry_run = dry_run
+        self.manager = manager or DownloadManager(api)
+        self.manifest = Manifest(os.path.join(self.path, self.manifest_name))
+
+    def run(self):
+        """
+        Synchronize and block until downloads are finished
+
+        :return: :class:`.SyncReport` object
+        """
+        report = SyncReport()
+        remote = set()
+        jobs = {}
+        if not self.dry_run:
+            mkdir_p(self.path)
+        for dirpath, dirs, files in self.api.walk(self.directory):
+            reldir = dirpath.split('/')[1:]
+            for f in files:
+                relpath = '/'.join(reldir + [f.name])
+                remote.add(relpath)
+                local = os.path.join(self.path, *relpath.split('/'))
+                status = self._compare(relpath, f, local)
+                getattr(report, status).append(relpath)
+                if status == 'unchanged' or self.dry_run:
+                    continue
+                temp = local + self.temp_suffix
+                if os.path.exists(temp) and not os.path.exists(
+                        temp + SegmentedDownloader.state_suffix):
+                    # Left over from an interrupted replacement
+                    os.remove(temp)
+                mkdir_p(os.path.dirname(local))
+                jobs[relpath] = self.manager.add(f, temp)[0]
+        if jobs:
+            self.manager.run()
+        for relpath, job in jobs.items():
+            if job.ok:
+                local = job.path[:-len(self.temp_suffix)]
+                replace_file(job.path, local)
+                self.manifest.set(relpath, job.file, local)
+            else:
+                report.failed.append(relpath)
+        self._handle_extras(remote, report)
+        if not self.dry_run:
+            self.manifest.save()
+        return report
+
+    def _compare(self, relpath, f, local):
+        """Return `new`, `changed` or `unchanged`"""
+        if not os.path.exists(local):
+            return 'new'
+        if self.manifest.is_unchanged(relpath, f, local):
+            return 'unchanged'
+        if os.path.getsize(local) == f.size and sha1_file(local) == \
+                f.sha.upper():
+            self.manifest.set(relpath, f, local)
+            return 'unchanged'
+        return 'changed'
+
+    def _handle_extras(self, remote, report):
+        for relpath in list(self.manifest.entries):
+            if relpath not in remote:
+                self.manifest.remove(relpath)
+        for root, dirs, files in os.walk(self.path):
+            for name in files:
+                local = os.path.join(root, name)
+                relpath = os.path.relpath(local, self.path).replace(
+                    os.sep, '/')
+                if relpath in remote or self._is_own_file(relpath):
+                    continue
+                report.extras.append(relpath)
+                if self.delete and not self.dry_run:
+                    os.remove(local)
+                    report.deleted.append(relpath)
+
+    def _is_own_file(self, relpath):
+        """
+        Whether the file is the manifest, a temporary download or a download
+        state file
+        """
+        suffix = SegmentedDownloader.state_suffix
+        return (relpath.startswith(self.manifest_name) or
+                relpath.endswith((self.temp_suffix, suffix, suffix + '.tmp')))
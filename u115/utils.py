@@ -1,10 +1,18 @@
 from __future__ import print_function, absolute_import
+import base64
+import binascii
 import datetime
 import errno
+import hashlib
+import humanize
+import json
 import os
+import re
 import six
 import sys
+import threading
 import time
+from multiprocessing.pool import ThreadPool
 from requests.utils import quote as _quote
 from requests.utils import unquote as _unquote
 
@@ -87,3 +95,246 @@ def mkdir_p(path):
             pass
         else:
             raise
+
+
+def replace_file(src, dst):
+    """Rename ``src`` to ``dst``, replacing ``dst`` if it exists"""
+    # os.rename does not overwrite existing files on Windows
+    if os.name == 'nt' and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+
+def atomic_write_json(obj, path):
+    """
+    Write ``obj`` as JSON to ``path`` through a temporary file, so that
+    ``path`` is never left half-written
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(obj, f)
+    replace_file(tmp, path)
+
+
+def get_magnet_info_hash(url):
+    """
+    Return the lowercase hexadecimal BitTorrent info hash of a magnet link,
+    or None if ``url`` is not a magnet link with one
+    """
+    m = re.search(r'xt=urn:btih:([0-9a-zA-Z]+)', url)
+    if m is None:
+        return None
+    h = m.group(1)
+    if len(h) == 32:
+        # Base32-encoded
+        try:
+            h = binascii.b2a_hex(base64.b32decode(h.upper()))
+        except (TypeError, ValueError, binascii.Error):
+            return None
+        h = h.decode('ascii')
+    return h.lower() if len(h) == 40 else None
+
+
+def hash_stream(hasher, fileobj, size=None, buffer_size=4 * 1024 * 1024,
+                head_hasher=None, head_size=0):
+    """
+    Update ``hasher`` with at most ``size`` bytes (until end of file if
+    None) read from the current position of ``fileobj``, reading into a
+    reusable buffer without creating intermediate bytes objects
+
+    If ``head_hasher`` is given, it is updated with the first ``head_size``
+    bytes in the same pass.
+
+    :return: number of bytes read
+    """
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    total = 0
+    while size is None or total < size:
+        n = fileobj.readinto(buf)
+        if not n:
+            break
+        if size is not None:
+            n = min(n, size - total)
+        if head_hasher is not None and total < head_size:
+            head_hasher.update(view[:min(n, head_size - total)])
+        hasher.update(view[:n])
+        total += n
+    return total
+
+
+def hash_file(hasher, path, start=0, end=None, buffer_size=4 * 1024 * 1024):
+    """
+    Update ``hasher`` with bytes of the file ``path`` from ``start`` to
+    ``end`` (exclusive, end of file if None)
+    """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        size = None if end is None else end - start
+        hash_stream(hasher, f, size, buffer_size)
+    return hasher
+
+
+def sha1_file(path, buffer_size=4 * 1024 * 1024):
+    """Return the uppercase hexadecimal SHA1 digest of the file ``path``"""
+    hasher = hash_file(hashlib.sha1(), path, buffer_size=buffer_size)
+    return hasher.hexdigest().upper()
+
+
+def threaded_map(func, iterable, max_workers=1):
+    """
+    Map ``func`` over ``iterable`` with a pool of at most ``max_workers``
+    threads. Results are returned in the order of ``iterable``.
+    """
+    items = list(iterable)
+    if max_workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    pool = ThreadPool(min(max_workers, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def threaded_imap(func, iterable, max_workers=1):
+    """
+    Lazy version of :func:`threaded_map`: yield results in the order of
+    ``iterable`` as soon as each of them is available
+    """
+    items = list(iterable)
+    if max_workers <= 1 or len(items) <= 1:
+        for item in items:
+            yield func(item)
+        return
+    pool = ThreadPool(min(max_workers, len(items)))
+    try:
+        for res in pool.imap(func, items):
+            yield res
+    finally:
+        pool.terminate()
+
+
+def prefetched(func, iterable):
+    """
+    Yield ``func(item)`` for each item in ``iterable``, while the result of
+    the next item is computed in a background thread
+    """
+    items = list(iterable)
+    if len(items) <= 1:
+        for item in items:
+            yield func(item)
+        return
+    pool = ThreadPool(1)
+    try:
+        pending = pool.apply_async(func, (items[0],))
+        for item in items[1:]:
+            res = pending.get()
+            pending = pool.apply_async(func, (item,))
+            yield res
+        yield pending.get()
+    finally:
+        pool.close()
+
+
+class RateLimiter(object):
+    """
+    Thread-safe token bucket that limits the average rate of consumption to
+    ``rate`` units (e.g. bytes or requests) per second
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        :param float rate: units per second
+        :param float burst: maximum units that can be consumed at once
+            without waiting, defaults to ``rate``
+        """
+        self.rate = float(rate)
+        self.capacity = float(burst or rate)
+        self._tokens = self.capacity
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, n=1):
+        """Consume ``n`` units, blocking until they are available"""
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.capacity,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # Tokens may become negative, which reserves future tokens
+            self._tokens -= n
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class TransferStats(object):
+    """
+    Thread-safe aggregate statistics of transfers
+
+    :ivar int bytes: number of bytes transferred
+    :ivar int files: number of finished files
+    :ivar int failed: number of failed files
+    :ivar float start_time: timestamp of creation
+    """
+
+    report_interval = 0.5
+
+    def __init__(self):
+        self.bytes = 0
+        self.files = 0
+        self.failed = 0
+        self.start_time = time.time()
+        self._lock = threading.Lock()
+        self._last_reported = 0
+
+    def add_bytes(self, n):
+        with self._lock:
+            self.bytes += n
+
+    def add_file(self, success=True):
+        with self._lock:
+            if success:
+                self.files += 1
+            else:
+                self.failed += 1
+
+    @property
+    def elapsed(self):
+        """Seconds elapsed since creation"""
+        return time.time() - self.start_time
+
+    @property
+    def rate(self):
+        """Average throughput in bytes per second"""
+        return self.bytes / max(self.elapsed, 1e-6)
+
+    def report(self, total=None, force=False):
+        """Print the statistics to :data:`STREAM` at most every
+        :attr:`report_interval` seconds"""
+        now = time.time()
+        if not force and now - self._last_reported < self.report_interval:
+            return
+        self._last_reported = now
+        done = self.files + self.failed
+        files = '%d/%d' % (done, total) if total is not None else str(done)
+        STREAM.write('\r[%s files] %s  %s/s' % (
+            files, humanize.naturalsize(self.bytes, binary=True),
+            humanize.naturalsize(self.rate, binary=True)))
+        STREAM.flush()
+
+    def to_dict(self):
+        return {
+            'bytes': self.bytes,
+            'files': self.files,
+            'failed': self.failed,
+            'elapsed': self.elapsed,
+            'rate': self.rate,
+        }
+
+    def __str__(self):
+        return '%d files (%d failed), %s in %.1fs (%s/s)' % (
+            self.files, self.failed,
+            humanize.naturalsize(self.bytes, binary=True), self.elapsed,
+            humanize.naturalsize(self.rate, binary=True))